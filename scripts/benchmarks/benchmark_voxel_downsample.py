@@ -0,0 +1,72 @@
+"""Script to benchmark the voxel downsampling backends on random pointclouds."""
+import argparse
+import time
+from typing import List
+
+import numpy as np
+import torch
+
+from opr.pipelines.registration.pointcloud import DOWNSAMPLE_BACKENDS, voxel_downsample_pointcloud
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse input CLI arguments.
+
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_points", type=int, nargs="+", default=[10000, 100000, 1000000], help="Pointcloud sizes."
+    )
+    parser.add_argument("--voxel_size", type=float, default=0.3, help="Voxel size in meters.")
+    parser.add_argument("--extent", type=float, default=50.0, help="Pointcloud extent in meters.")
+    parser.add_argument("--num_runs", type=int, default=20, help="Number of timed runs for each setting.")
+    parser.add_argument("--device", type=str, default="cpu", help="Device for the torch backend.")
+    return parser.parse_args()
+
+
+def benchmark(pc: torch.Tensor, voxel_size: float, backend: str, num_runs: int) -> List[float]:
+    """Time the downsampling of the pointcloud.
+
+    Args:
+        pc (torch.Tensor): Pointcloud. Coordinates array of shape (N, 3).
+        voxel_size (float): Voxel size.
+        backend (str): Downsampling backend.
+        num_runs (int): Number of timed runs.
+
+    Returns:
+        List[float]: Times of the runs in seconds.
+    """
+    voxel_downsample_pointcloud(pc, voxel_size, backend)  # warm-up
+    times = []
+    for _ in range(num_runs):
+        if pc.is_cuda:
+            torch.cuda.synchronize()
+        t_start = time.perf_counter()
+        voxel_downsample_pointcloud(pc, voxel_size, backend)
+        if pc.is_cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - t_start)
+    return times
+
+
+def main() -> None:
+    """Print the median downsampling time of each backend for each pointcloud size."""
+    args = parse_args()
+    rng = np.random.default_rng(42)
+    print(f"{'points':>10} {'backend':>8} {'device':>8} {'output':>9} {'median, ms':>11}")
+    for num_points in args.num_points:
+        pc = torch.from_numpy(rng.uniform(-args.extent, args.extent, (num_points, 3)).astype(np.float32))
+        for backend in DOWNSAMPLE_BACKENDS:
+            device_pc = pc.to(args.device) if backend == "torch" else pc
+            times = benchmark(device_pc, args.voxel_size, backend, args.num_runs)
+            num_output = len(voxel_downsample_pointcloud(device_pc, args.voxel_size, backend))
+            print(
+                f"{num_points:>10} {backend:>8} {str(device_pc.device):>8} {num_output:>9} "
+                f"{np.median(times) * 1e3:>11.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
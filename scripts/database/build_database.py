@@ -0,0 +1,45 @@
+"""Script to build a Place Recognition database ("track.csv" and "index.faiss" files)."""
+import json
+import pprint
+
+import hydra
+from hydra.utils import instantiate
+from loguru import logger
+from omegaconf import DictConfig, OmegaConf
+from opr.pipelines.place_recognition.database import build_database
+from opr.utils import init_model
+
+
+@logger.catch
+@hydra.main(config_path="../../configs", config_name="build_database", version_base=None)
+def main(cfg: DictConfig) -> None:
+    """Database building code.
+
+    Args:
+        cfg (DictConfig): config to build the database with
+    """
+    config_dict = OmegaConf.to_container(cfg, resolve=True, throw_on_missing=True)
+    logger.info(f"Config:\n{pprint.pformat(config_dict, compact=True)}")
+
+    logger.debug("=> Instantiating model...")
+    model = init_model(instantiate(cfg.model), cfg.weights_path, cfg.device)
+
+    logger.debug("=> Instantiating dataset...")
+    dataset = instantiate(cfg.dataset, subset=cfg.subset)
+
+    logger.info(f"=====> Building {cfg.index.index_type!r} database with {len(dataset)} places.")
+    report = build_database(
+        model=model,
+        dataset=dataset,
+        database_dir=cfg.database_dir,
+        batch_size=cfg.batch_size,
+        num_workers=cfg.num_workers,
+        device=cfg.device,
+        recall_k=cfg.recall_k,
+        **cfg.index,
+    )
+    logger.info(f"Recall report against the exact flat index:\n{json.dumps(report, indent=2)}")
+
+
+if __name__ == "__main__":
+    main()
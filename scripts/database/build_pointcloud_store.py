@@ -0,0 +1,31 @@
+"""Script to build a packed store of downsampled database pointclouds for the LocalizationPipeline."""
+import pprint
+
+import hydra
+from hydra.utils import instantiate
+from loguru import logger
+from omegaconf import DictConfig, OmegaConf
+from opr.pipelines.localization import PointcloudStore
+
+
+@logger.catch
+@hydra.main(config_path="../../configs", config_name="build_pointcloud_store", version_base=None)
+def main(cfg: DictConfig) -> None:
+    """Pointcloud store building code.
+
+    Args:
+        cfg (DictConfig): config to build the pointcloud store with
+    """
+    config_dict = OmegaConf.to_container(cfg, resolve=True, throw_on_missing=True)
+    logger.info(f"Config:\n{pprint.pformat(config_dict, compact=True)}")
+
+    logger.debug("=> Instantiating dataset...")
+    dataset = instantiate(cfg.dataset, subset=cfg.subset)
+
+    logger.info(f"=====> Building pointcloud store with {len(dataset)} pointclouds.")
+    store = PointcloudStore.build(dataset, cfg.store_dir, voxel_downsample_size=cfg.voxel_downsample_size)
+    logger.info(f"Pointcloud store with {len(store)} pointclouds saved to {cfg.store_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -516,6 +516,26 @@ class ITLPCampus(Dataset):
             data["soc"] = soc
         return data
 
+    def get_pointcloud_and_pose(self, idx: int) -> Tuple[Tensor, Tensor]:
+        """Load only the lidar pointcloud and the pose of the sample, skipping images, masks and SOC.
+
+        Args:
+            idx (int): Sample index.
+
+        Returns:
+            Tuple[Tensor, Tensor]: Pointcloud coordinates of shape (N, 3) and pose
+                in the format [tx, ty, tz, qx, qy, qz, qw], the same as in the "__getitem__" output.
+        """
+        if self.exclude_dynamic_classes and self.indoor and self.load_semantics:
+            # dynamic points removal requires the semantic masks, load the full sample
+            data = self[idx]
+            return data["pointcloud_lidar_coords"], data["pose"]
+        pose = torch.tensor(
+            self.dataset_df.iloc[idx][["tx", "ty", "tz", "qx", "qy", "qz", "qw"]].to_numpy(dtype=np.float32)
+        )
+        pc = self._load_pc(idx, self._get_track_subdir(idx), self._get_floor_subdir(idx))
+        return pc, pose
+
     def _remove_dynamic_points(self, pointcloud: np.ndarray, semantic_map: np.ndarray, lidar2sensor: np.ndarray,
                                sensor_intrinsics: np.ndarray, sensor_dist: np.ndarray) -> np.ndarray:
         pc_values = np.concatenate([pointcloud, np.ones((pointcloud.shape[0], 1))],axis=1).T
@@ -4,7 +4,7 @@ Paper: https://arxiv.org/abs/2202.06688
 
 Code is adopted from original repository: https://github.com/qinzheng93/GeoTransformer, MIT License
 """
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 import torch
 import torch.nn.functional as F
@@ -30,6 +30,7 @@ try:
     from geotransformer.modules.sinkhorn import LearnableLogOptimalTransport
     from geotransformer.utils.data import (
         calibrate_neighbors_stack_mode,
+        precompute_data_stack_mode,
         registration_collate_fn_stack_mode,
     )
     from geotransformer.utils.torch import to_cuda
@@ -256,16 +257,24 @@ class GeoTransformer(nn.Module):
 
         self.optimal_transport = LearnableLogOptimalTransport(model.num_sinkhorn_iterations)
 
+        # KPConv neighbor limits of each stage, zeros if not calibrated; saved with the model weights
+        self.register_buffer("neighbor_limits", torch.zeros(backbone.num_stages, dtype=torch.long))
+
+    def _load_from_state_dict(  # noqa: D102
+        self, state_dict: Dict[str, Any], prefix: str, *args: Any, **kwargs: Any
+    ) -> None:
+        # weights saved before the neighbor limits were introduced load as not calibrated
+        state_dict.setdefault(prefix + "neighbor_limits", torch.zeros_like(self.neighbor_limits))
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @property
-    def _is_cuda(self) -> bool:
-        for param in self.parameters():
-            if param.is_cuda:
-                return True
-        return False
+    def is_calibrated(self) -> bool:
+        """Whether the KPConv neighbor limits are calibrated."""
+        return bool((self.neighbor_limits > 0).all())
 
-    def _preprocess_input(
+    def _make_data_dict(
         self, query_pc: Tensor, db_pc: Tensor, gt_transform: Optional[Tensor] = None
-    ) -> Dict[str, Any]:
+    ) -> Dict[str, Tensor]:
         data_dict = {}
         data_dict["ref_points"] = db_pc
         data_dict["src_points"] = query_pc
@@ -275,15 +284,58 @@ class GeoTransformer(nn.Module):
             data_dict["transform"] = gt_transform
         else:
             data_dict["transform"] = torch.eye(4, dtype=torch.float32)
+        return data_dict
+
+    def _calibrate_neighbors(self, data_dicts: List[Dict[str, Tensor]]) -> Tensor:
         neighbor_limits = calibrate_neighbors_stack_mode(
-            [data_dict],
+            data_dicts,
             registration_collate_fn_stack_mode,
             self.backbone_cfg.num_stages,
             self.backbone_cfg.init_voxel_size,
             self.backbone_cfg.init_radius,
         )
+        return torch.as_tensor(neighbor_limits, dtype=torch.long)
+
+    def calibrate_neighbors(self, pointcloud_pairs: Sequence[Tuple[Tensor, Tensor]]) -> Tensor:
+        """Calibrate the KPConv neighbor limits once on a representative set of pointclouds.
+
+        Without calibration, the neighbor limits are computed for every registered pair, which takes about
+        as long as the input preprocessing itself. The limits are stored in the "neighbor_limits" buffer,
+        so they are saved and loaded with the model weights.
+
+        Args:
+            pointcloud_pairs (Sequence[Tuple[Tensor, Tensor]]): Query and database pointclouds pairs,
+                downsampled as in inference. Coordinates arrays of shape (N, 3).
+
+        Returns:
+            Tensor: Neighbor limits of each backbone stage.
+
+        Raises:
+            ValueError: If no pointcloud pairs are given.
+        """
+        if len(pointcloud_pairs) == 0:
+            raise ValueError("At least one pointcloud pair is required for calibration.")
+        data_dicts = [
+            self._make_data_dict(query_pc.cpu(), db_pc.cpu()) for query_pc, db_pc in pointcloud_pairs
+        ]
+        neighbor_limits = self._calibrate_neighbors(data_dicts)
+        self.neighbor_limits.copy_(neighbor_limits)
+        return neighbor_limits
+
+    @property
+    def _is_cuda(self) -> bool:
+        for param in self.parameters():
+            if param.is_cuda:
+                return True
+        return False
+
+    def _collate(self, data_dicts: List[Dict[str, Tensor]]) -> Dict[str, Any]:
+        if self.is_calibrated:
+            neighbor_limits = self.neighbor_limits.tolist()
+        else:
+            neighbor_limits = self._calibrate_neighbors(data_dicts).tolist()
         data_dict = registration_collate_fn_stack_mode(
-            [data_dict],
+            data_dicts,
             self.backbone_cfg.num_stages,
             self.backbone_cfg.init_voxel_size,
             self.backbone_cfg.init_radius,
@@ -293,102 +345,118 @@ class GeoTransformer(nn.Module):
             data_dict = to_cuda(data_dict)
         return data_dict
 
-    def forward(  # noqa: D102
+    def _preprocess_input(
         self, query_pc: Tensor, db_pc: Tensor, gt_transform: Optional[Tensor] = None
     ) -> Dict[str, Any]:
-        data_dict = self._preprocess_input(query_pc, db_pc, gt_transform)
-        output_dict = {}
-
-        # Downsample point clouds
-        feats = data_dict["features"].detach()
-        transform = data_dict["transform"].detach()
-
-        ref_length_c = data_dict["lengths"][-1][0].item()
-        ref_length_f = data_dict["lengths"][1][0].item()
-        # ref_length = data_dict["lengths"][0][0].item()
+        return self._collate([self._make_data_dict(query_pc, db_pc, gt_transform)])
+
+    @staticmethod
+    def _pair_slices(lengths: Tensor, i: int, batch_size: int) -> Tuple[slice, slice]:
+        # the stack-mode collate stacks the reference points of all pairs first, then the source points
+        offsets = [0] + torch.cumsum(lengths, dim=0).tolist()
+        return slice(offsets[i], offsets[i + 1]), slice(offsets[batch_size + i], offsets[batch_size + i + 1])
+
+    def _encode_side(
+        self, points_f: Tensor, points_c: Tensor, feats_f: Tensor, feats_c: Tensor
+    ) -> Dict[str, Tensor]:
+        """Group the backbone output of one pointcloud into superpoint patches for matching."""
+        _, node_masks, node_knn_indices, node_knn_masks = point_to_node_partition(
+            points_f, points_c, self.num_points_in_patch
+        )
+        padded_points_f = torch.cat([points_f, torch.zeros_like(points_f[:1])], dim=0)
+        padded_feats_f = torch.cat([feats_f, torch.zeros_like(feats_f[:1])], dim=0)
+        return {
+            "points_c": points_c,
+            "feats_c": feats_c,
+            "padded_feats_f": padded_feats_f,
+            "node_masks": node_masks,
+            "node_knn_indices": node_knn_indices,
+            "node_knn_masks": node_knn_masks,
+            "node_knn_points": index_select(padded_points_f, node_knn_indices, dim=0),
+        }
+
+    def _split_pair(
+        self, data_dict: Dict[str, Any], feats_list: List[Tensor], i: int, batch_size: int
+    ) -> Tuple[Dict[str, Tensor], Dict[str, Tensor]]:
+        """Reference and source encodings of the i-th pair of the collated batch."""
+        ref_c, src_c = self._pair_slices(data_dict["lengths"][-1], i, batch_size)
+        ref_f, src_f = self._pair_slices(data_dict["lengths"][1], i, batch_size)
         points_c = data_dict["points"][-1].detach()
         points_f = data_dict["points"][1].detach()
-        # points = data_dict["points"][0].detach()
-
-        ref_points_c = points_c[:ref_length_c]
-        src_points_c = points_c[ref_length_c:]
-        ref_points_f = points_f[:ref_length_f]
-        src_points_f = points_f[ref_length_f:]
-        # ref_points = points[:ref_length]
-        # src_points = points[ref_length:]
-
-        # output_dict["ref_points_c"] = ref_points_c
-        # output_dict["src_points_c"] = src_points_c
-        # output_dict["ref_points_f"] = ref_points_f
-        # output_dict["src_points_f"] = src_points_f
-        # output_dict["ref_points"] = ref_points
-        # output_dict["src_points"] = src_points
-
-        # 1. Generate ground truth node correspondences
-        _, ref_node_masks, ref_node_knn_indices, ref_node_knn_masks = point_to_node_partition(
-            ref_points_f, ref_points_c, self.num_points_in_patch
+        feats_c = feats_list[-1]
+        feats_f = feats_list[0]
+        ref = self._encode_side(points_f[ref_f], points_c[ref_c], feats_f[ref_f], feats_c[ref_c])
+        src = self._encode_side(points_f[src_f], points_c[src_c], feats_f[src_f], feats_c[src_c])
+        return ref, src
+
+    def _encode_pointcloud(self, pc: Tensor) -> Dict[str, Tensor]:
+        """Run the backbone on a single pointcloud and group its output into superpoint patches."""
+        points = pc.detach().cpu().float()
+        if self.is_calibrated:
+            neighbor_limits = self.neighbor_limits.tolist()
+        else:
+            neighbor_limits = self._calibrate_neighbors([self._make_data_dict(points, points)]).tolist()
+        data_dict = precompute_data_stack_mode(
+            points,
+            torch.LongTensor([points.shape[0]]),
+            self.backbone_cfg.num_stages,
+            self.backbone_cfg.init_voxel_size,
+            self.backbone_cfg.init_radius,
+            neighbor_limits,
         )
-        _, src_node_masks, src_node_knn_indices, src_node_knn_masks = point_to_node_partition(
-            src_points_f, src_points_c, self.num_points_in_patch
+        data_dict["features"] = torch.ones((points.shape[0], 1), dtype=torch.float32)
+        if self._is_cuda:
+            data_dict = to_cuda(data_dict)
+        feats_list = self.backbone(data_dict["features"], data_dict)
+        points_c = data_dict["points"][-1].detach()
+        points_f = data_dict["points"][1].detach()
+        return self._encode_side(points_f, points_c, feats_list[0], feats_list[-1])
+
+    def _transform_feats(self, ref: Dict[str, Tensor], src: Dict[str, Tensor]) -> Tuple[Tensor, Tensor]:
+        """Run the conditional transformer, reusing the cached reference geometric embeddings if any."""
+        if "embeddings" not in ref:
+            return self.transformer(
+                ref["points_c"].unsqueeze(0),
+                src["points_c"].unsqueeze(0),
+                ref["feats_c"].unsqueeze(0),
+                src["feats_c"].unsqueeze(0),
+            )
+        # the same steps as in GeometricTransformer.forward
+        src_embeddings = self.transformer.embedding(src["points_c"].unsqueeze(0))
+        ref_feats_c = self.transformer.in_proj(ref["feats_c"].unsqueeze(0))
+        src_feats_c = self.transformer.in_proj(src["feats_c"].unsqueeze(0))
+        ref_feats_c, src_feats_c = self.transformer.transformer(
+            ref_feats_c, src_feats_c, ref["embeddings"], src_embeddings
         )
+        return self.transformer.out_proj(ref_feats_c), self.transformer.out_proj(src_feats_c)
 
-        ref_padded_points_f = torch.cat([ref_points_f, torch.zeros_like(ref_points_f[:1])], dim=0)
-        src_padded_points_f = torch.cat([src_points_f, torch.zeros_like(src_points_f[:1])], dim=0)
-        ref_node_knn_points = index_select(ref_padded_points_f, ref_node_knn_indices, dim=0)
-        src_node_knn_points = index_select(src_padded_points_f, src_node_knn_indices, dim=0)
-
+    def _match(self, ref: Dict[str, Tensor], src: Dict[str, Tensor], transform: Tensor) -> Dict[str, Tensor]:
+        """Match the reference and source encodings, estimate the transform and keep the correspondences."""
+        # 1. Generate ground truth node correspondences
         gt_node_corr_indices, gt_node_corr_overlaps = get_node_correspondences(
-            ref_points_c,
-            src_points_c,
-            ref_node_knn_points,
-            src_node_knn_points,
+            ref["points_c"],
+            src["points_c"],
+            ref["node_knn_points"],
+            src["node_knn_points"],
             transform,
             self.matching_radius,
-            ref_masks=ref_node_masks,
-            src_masks=src_node_masks,
-            ref_knn_masks=ref_node_knn_masks,
-            src_knn_masks=src_node_knn_masks,
+            ref_masks=ref["node_masks"],
+            src_masks=src["node_masks"],
+            ref_knn_masks=ref["node_knn_masks"],
+            src_knn_masks=src["node_knn_masks"],
         )
 
-        # output_dict["gt_node_corr_indices"] = gt_node_corr_indices
-        # output_dict["gt_node_corr_overlaps"] = gt_node_corr_overlaps
-
-        # 2. KPFCNN Encoder
-        feats_list = self.backbone(feats, data_dict)
-
-        feats_c = feats_list[-1]
-        feats_f = feats_list[0]
-
         # 3. Conditional Transformer
-        ref_feats_c = feats_c[:ref_length_c]
-        src_feats_c = feats_c[ref_length_c:]
-        ref_feats_c, src_feats_c = self.transformer(
-            ref_points_c.unsqueeze(0),
-            src_points_c.unsqueeze(0),
-            ref_feats_c.unsqueeze(0),
-            src_feats_c.unsqueeze(0),
-        )
+        ref_feats_c, src_feats_c = self._transform_feats(ref, src)
         ref_feats_c_norm = F.normalize(ref_feats_c.squeeze(0), p=2, dim=1)
         src_feats_c_norm = F.normalize(src_feats_c.squeeze(0), p=2, dim=1)
 
-        # output_dict["ref_feats_c"] = ref_feats_c_norm
-        # output_dict["src_feats_c"] = src_feats_c_norm
-
-        # 5. Head for fine level matching
-        ref_feats_f = feats_f[:ref_length_f]
-        src_feats_f = feats_f[ref_length_f:]
-        # output_dict["ref_feats_f"] = ref_feats_f
-        # output_dict["src_feats_f"] = src_feats_f
-
         # 6. Select topk nearest node correspondences
         with torch.no_grad():
             ref_node_corr_indices, src_node_corr_indices, node_corr_scores = self.coarse_matching(
-                ref_feats_c_norm, src_feats_c_norm, ref_node_masks, src_node_masks
+                ref_feats_c_norm, src_feats_c_norm, ref["node_masks"], src["node_masks"]
             )
 
-            # output_dict["ref_node_corr_indices"] = ref_node_corr_indices
-            # output_dict["src_node_corr_indices"] = src_node_corr_indices
-
             # 7 Random select ground truth node correspondences during training
             if self.training:
                 ref_node_corr_indices, src_node_corr_indices, node_corr_scores = self.coarse_target(
@@ -396,38 +464,29 @@ class GeoTransformer(nn.Module):
                 )
 
         # 7.2 Generate batched node points & feats
-        ref_node_corr_knn_indices = ref_node_knn_indices[ref_node_corr_indices]  # (P, K)
-        src_node_corr_knn_indices = src_node_knn_indices[src_node_corr_indices]  # (P, K)
-        ref_node_corr_knn_masks = ref_node_knn_masks[ref_node_corr_indices]  # (P, K)
-        src_node_corr_knn_masks = src_node_knn_masks[src_node_corr_indices]  # (P, K)
-        ref_node_corr_knn_points = ref_node_knn_points[ref_node_corr_indices]  # (P, K, 3)
-        src_node_corr_knn_points = src_node_knn_points[src_node_corr_indices]  # (P, K, 3)
-
-        ref_padded_feats_f = torch.cat([ref_feats_f, torch.zeros_like(ref_feats_f[:1])], dim=0)
-        src_padded_feats_f = torch.cat([src_feats_f, torch.zeros_like(src_feats_f[:1])], dim=0)
+        ref_node_corr_knn_indices = ref["node_knn_indices"][ref_node_corr_indices]  # (P, K)
+        src_node_corr_knn_indices = src["node_knn_indices"][src_node_corr_indices]  # (P, K)
+        ref_node_corr_knn_masks = ref["node_knn_masks"][ref_node_corr_indices]  # (P, K)
+        src_node_corr_knn_masks = src["node_knn_masks"][src_node_corr_indices]  # (P, K)
+        ref_node_corr_knn_points = ref["node_knn_points"][ref_node_corr_indices]  # (P, K, 3)
+        src_node_corr_knn_points = src["node_knn_points"][src_node_corr_indices]  # (P, K, 3)
+
         ref_node_corr_knn_feats = index_select(
-            ref_padded_feats_f, ref_node_corr_knn_indices, dim=0
+            ref["padded_feats_f"], ref_node_corr_knn_indices, dim=0
         )  # (P, K, C)
         src_node_corr_knn_feats = index_select(
-            src_padded_feats_f, src_node_corr_knn_indices, dim=0
+            src["padded_feats_f"], src_node_corr_knn_indices, dim=0
         )  # (P, K, C)
 
-        # output_dict["ref_node_corr_knn_points"] = ref_node_corr_knn_points
-        # output_dict["src_node_corr_knn_points"] = src_node_corr_knn_points
-        # output_dict["ref_node_corr_knn_masks"] = ref_node_corr_knn_masks
-        # output_dict["src_node_corr_knn_masks"] = src_node_corr_knn_masks
-
         # 8. Optimal transport
         matching_scores = torch.einsum(
             "bnd,bmd->bnm", ref_node_corr_knn_feats, src_node_corr_knn_feats
         )  # (P, K, K)
-        matching_scores = matching_scores / feats_f.shape[1] ** 0.5
+        matching_scores = matching_scores / ref["padded_feats_f"].shape[1] ** 0.5
         matching_scores = self.optimal_transport(
             matching_scores, ref_node_corr_knn_masks, src_node_corr_knn_masks
         )
 
-        # output_dict["matching_scores"] = matching_scores
-
         # 9. Generate final correspondences during testing
         with torch.no_grad():
             if not self.fine_matching.use_dustbin:
@@ -442,9 +501,94 @@ class GeoTransformer(nn.Module):
                 node_corr_scores,
             )
 
-            # output_dict["ref_corr_points"] = ref_corr_points
-            # output_dict["src_corr_points"] = src_corr_points
-            # output_dict["corr_scores"] = corr_scores
-            output_dict["estimated_transform"] = estimated_transform
+        return {
+            "estimated_transform": estimated_transform,
+            "ref_corr_points": ref_corr_points,
+            "src_corr_points": src_corr_points,
+            "corr_scores": corr_scores,
+        }
+
+    def forward(  # noqa: D102
+        self, query_pc: Tensor, db_pc: Tensor, gt_transform: Optional[Tensor] = None
+    ) -> Dict[str, Any]:
+        data_dict = self._preprocess_input(query_pc, db_pc, gt_transform)
+        feats_list = self.backbone(data_dict["features"].detach(), data_dict)
+        ref, src = self._split_pair(data_dict, feats_list, 0, 1)
+        return self._match(ref, src, data_dict["transform"].detach())
+
+    def forward_batch(self, query_pcs: Sequence[Tensor], db_pcs: Sequence[Tensor]) -> Dict[str, Tensor]:
+        """Register several query and database pointclouds pairs at once.
+
+        All pairs are collated into one stack-mode batch, so the input preprocessing and the KPConv backbone
+        run once for the batch. The transformer and the matching heads then run for each pair. The backbone
+        group normalization statistics are computed over the whole stacked batch, as they are over
+        the stacked pair in the "forward" method, so the transforms may slightly differ from the ones
+        of the pairs registered one by one.
+
+        Args:
+            query_pcs (Sequence[Tensor]): Query pointclouds. Coordinates arrays of shape (N_i, 3).
+            db_pcs (Sequence[Tensor]): Database pointclouds. Coordinates arrays of shape (M_i, 3).
+
+        Returns:
+            Dict[str, Tensor]: Dictionary with the "estimated_transform" key for the transforms of the pairs,
+                tensor of shape (B, 4, 4).
+
+        Raises:
+            ValueError: If the numbers of query and database pointclouds differ or no pairs are given.
+        """
+        if len(query_pcs) != len(db_pcs) or len(query_pcs) == 0:
+            raise ValueError(
+                f"Expected equal non-zero numbers of pointclouds, but {len(query_pcs)} query and "
+                f"{len(db_pcs)} database pointclouds given."
+            )
+        batch_size = len(query_pcs)
+        data_dict = self._collate(
+            [self._make_data_dict(query_pc, db_pc) for query_pc, db_pc in zip(query_pcs, db_pcs)]
+        )
+        # the collate function unwraps the per-pair values for a single pair
+        transforms = [data_dict["transform"]] if batch_size == 1 else data_dict["transform"]
+        feats_list = self.backbone(data_dict["features"].detach(), data_dict)
+        pair_outputs = [
+            self._match(*self._split_pair(data_dict, feats_list, i, batch_size), transforms[i].detach())
+            for i in range(batch_size)
+        ]
+        return {
+            "estimated_transform": torch.stack([output["estimated_transform"] for output in pair_outputs])
+        }
+
+    def encode_reference(self, db_pc: Tensor) -> Dict[str, Tensor]:
+        """Encode the reference (database) pointcloud once to register many queries with it.
+
+        The output contains the KPConv backbone features, the superpoint patches and the geometric structure
+        embeddings of the reference superpoints. It can be cached, e.g. by database index, and passed to
+        the "forward_with_reference" method, which then encodes only the query pointcloud.
+
+        Unlike in the "forward" method, the reference and the query pointclouds are encoded separately,
+        so the backbone group normalization statistics are computed for each pointcloud, and the transforms
+        may slightly differ from the "forward" method ones.
+
+        Args:
+            db_pc (Tensor): Database pointcloud. Coordinates array of shape (M, 3).
+
+        Returns:
+            Dict[str, Tensor]: Reference encoding tensors on the model device.
+        """
+        ref = self._encode_pointcloud(db_pc)
+        ref["embeddings"] = self.transformer.embedding(ref["points_c"].unsqueeze(0))
+        return ref
+
+    def forward_with_reference(self, query_pc: Tensor, reference: Dict[str, Tensor]) -> Dict[str, Tensor]:
+        """Register the query pointcloud with the reference encoded with the "encode_reference" method.
 
-        return output_dict
+        Args:
+            query_pc (Tensor): Query pointcloud. Coordinates array of shape (N, 3).
+            reference (Dict[str, Tensor]): Reference pointcloud encoding.
+
+        Returns:
+            Dict[str, Tensor]: Dictionary with the "estimated_transform" key for the transform of shape (4, 4)
+                and the "ref_corr_points", "src_corr_points" and "corr_scores" keys for the correspondences,
+                as in the "forward" method output.
+        """
+        src = self._encode_pointcloud(query_pc)
+        transform = torch.eye(4, dtype=torch.float32, device=src["points_c"].device)
+        return self._match(reference, src, transform)
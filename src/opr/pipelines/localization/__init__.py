@@ -1,3 +1,5 @@
 """Hierarchical localization pipelines."""
 from .base import LocalizationPipeline
 from .aruco import ArucoLocalizationPipeline
+from .pointcloud_store import PointcloudStore
+from .streaming import StreamingLocalizationRunner
@@ -1,5 +1,8 @@
 """ArucoPlaceRecognitionPipeline pipeline."""
-from typing import Dict
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Dict, Literal, Optional, Sequence, Tuple
 
 import cv2
 import numpy as np
@@ -10,6 +13,12 @@ from opr.datasets.itlp import ITLPCampus
 from opr.pipelines.localization import LocalizationPipeline
 from opr.pipelines.place_recognition import PlaceRecognitionPipeline
 from opr.pipelines.registration import PointcloudRegistrationPipeline
+from opr.profiling import StageProfiler
+
+logger = logging.getLogger(__name__)
+
+ArucoPolicy = Literal["always", "short_circuit", "race"]
+ARUCO_POLICIES = ("always", "short_circuit", "race")
 
 
 def pose_to_matrix(pose):
@@ -22,6 +31,43 @@ def pose_to_matrix(pose):
     pose_matrix[:3,3] = position
     return pose_matrix
 
+
+def estimate_markers_poses(
+    corners: Sequence[np.ndarray], marker_size: float, camera_matrix: np.ndarray, dist_coeffs: np.ndarray
+) -> np.ndarray:
+    """Estimate the poses of all detected markers in the camera frame.
+
+    The markers are solved with the IPPE square method, as in "cv2.aruco.estimatePoseSingleMarkers"
+    (removed from the recent OpenCV versions), and the pose matrices are assembled at once.
+
+    Args:
+        corners (Sequence[np.ndarray]): Corners of the detected markers, arrays of shape (1, 4, 2).
+        marker_size (float): Marker side length.
+        camera_matrix (np.ndarray): Camera intrinsics matrix of shape (3, 3).
+        dist_coeffs (np.ndarray): Camera distortion coefficients.
+
+    Returns:
+        np.ndarray: Marker to camera transformation matrices, array of shape (N, 4, 4).
+    """
+    half_size = marker_size / 2
+    object_points = np.array(
+        [[-half_size, half_size, 0], [half_size, half_size, 0], [half_size, -half_size, 0], [-half_size, -half_size, 0]],
+        dtype=np.float32,
+    )
+    rvecs = np.zeros((len(corners), 3))
+    tvecs = np.zeros((len(corners), 3))
+    for i, marker_corners in enumerate(corners):
+        _, rvec, tvec = cv2.solvePnP(object_points, np.asarray(marker_corners, dtype=np.float32).reshape(4, 2),
+                                     camera_matrix, dist_coeffs, flags=cv2.SOLVEPNP_IPPE_SQUARE)
+        rvecs[i] = rvec.ravel()
+        tvecs[i] = tvec.ravel()
+    transforms = np.tile(np.eye(4), (len(corners), 1, 1))
+    if len(corners) > 0:
+        transforms[:, :3, :3] = R.from_rotvec(rvecs).as_matrix()
+        transforms[:, :3, 3] = tvecs
+    return transforms
+
+
 class ArucoLocalizationPipeline(LocalizationPipeline):
     """ArucoLocalizationPipeline pipeline."""
 
@@ -31,26 +77,130 @@ class ArucoLocalizationPipeline(LocalizationPipeline):
         registration_pipeline: PointcloudRegistrationPipeline,
         db_dataset: ITLPCampus,  # TODO: replace with a generic "inference" dataset
         aruco_metadata: Dict,
-        camera_metadata: Dict
+        camera_metadata: Dict,
+        profiler: Optional[StageProfiler] = None,
+        num_workers: int = 2,
+        policy: ArucoPolicy = "always",
+        max_marker_distance: float = 3.0,
+        deadline: Optional[float] = None,
     ) -> None:
         """ArucoLocalization Pipeline.
 
         The task of localiation is solved in two branch:
-        1. Find the best match for the query in the database (Place Recognition) and 
+        1. Find the best match for the query in the database (Place Recognition) and
         Refine the pose estimate using the query and the database match (Registration).
         2. Detect Aruco Marker (Place Recognition) and find transformation from encoded in marker pose (Registration)
 
+        The ArUco detectors, the cameras parameters and the markers poses are prepared once here.
+
         Args:
             place_recognition_pipeline (PlaceRecognitionPipeline): Place Recognition pipeline.
             registration_pipeline (PointcloudRegistrationPipeline): Registration pipeline.
             db_dataset (ITLPCampus): Database dataset.
             aruco_metadata (Dict): Required information about aruco markers.
             camera_metadata (Dict): Required information about camera parameters.
+            profiler (StageProfiler, optional): Stages profiler, see LocalizationPipeline. The ArUco branch
+                is recorded as the "aruco/detection" stage. Defaults to None.
+            num_workers (int): Number of threads to detect the markers on the cameras images in parallel.
+                The threads live for the duration of a detection only. If 1, the cameras are processed
+                sequentially. Defaults to 2.
+            policy (ArucoPolicy): When to run the Place Recognition and Registration branch:
+                "always" to run both branches one after another,
+                "short_circuit" to skip the learned branch if a marker nearer than max_marker_distance is found,
+                "race" to run the learned branch in the background while the ArUco branch runs in the calling
+                thread and return as soon as a marker nearer than max_marker_distance is found or the learned
+                branch finishes. The learned branch that did not finish in time is not cancelled: it keeps
+                running in a background thread and its pose is discarded. While it is running, the learned
+                branch is not started for the new frames. Call the "close" method or use the pipeline as
+                a context manager to wait for it and release the thread. Defaults to "always".
+            max_marker_distance (float): Maximum distance from the camera to the marker in meters to trust
+                the ArUco pose without the learned branch. Defaults to 3.0.
+            deadline (float, optional): Maximum time in seconds to wait for the branches with the "race" policy.
+                The poses of the branches that did not finish in time are None. If None, waits for the first
+                trusted pose. Defaults to None.
+
+        Raises:
+            ValueError: If the policy is unknown.
         """
-        super().__init__(place_recognition_pipeline, registration_pipeline, db_dataset)
+        if policy not in ARUCO_POLICIES:
+            raise ValueError(f"Unknown policy: {policy!r}. Valid policies: {ARUCO_POLICIES!r}")
+        super().__init__(place_recognition_pipeline, registration_pipeline, db_dataset, profiler=profiler)
         self.aruco_metadata = aruco_metadata
         self.camera_metadata = camera_metadata
 
+        self._aruco2world = {
+            marker_id: pose_to_matrix(np.array(pose))
+            for marker_id, pose in aruco_metadata["aruco_gt_pose_by_id"].items()
+        }
+        camera_names = [key[:-len("_intrinsics")] for key in camera_metadata if key.endswith("_intrinsics")]
+        self._intrinsics = {name: np.array(camera_metadata[f"{name}_intrinsics"]) for name in camera_names}
+        self._distortion = {name: np.array(camera_metadata[f"{name}_distortion"]) for name in camera_names}
+        self._baselink2sensor = {
+            name: np.linalg.inv(pose_to_matrix(np.array(camera_metadata[f"{name}2baselink"])))
+            for name in camera_names
+        }
+        # the detectors are not shared between the threads
+        self._detectors = {name: self._create_detector() for name in camera_names}
+        self.num_detection_workers = num_workers
+        self.policy = policy
+        self.max_marker_distance = max_marker_distance
+        self.deadline = deadline
+        # a single thread for the learned branch, the ArUco branch runs in the calling thread
+        self._branch_executor = None
+        self._place_recognition_future = None
+
+    def close(self) -> None:
+        """Wait for the running learned branch of the "race" policy and release its thread.
+
+        The pipeline may be used after closing, the thread is started again on the next "race" inference.
+        """
+        if self._branch_executor is not None:
+            self._branch_executor.shutdown(wait=True)
+            self._branch_executor = None
+        self._place_recognition_future = None
+
+    def __enter__(self) -> "ArucoLocalizationPipeline":
+        """Use the pipeline as a context manager that closes it on exit."""
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        """Close the pipeline, see the "close" method."""
+        self.close()
+
+    def _create_detector(self) -> cv2.aruco.ArucoDetector:
+        arucoDict = cv2.aruco.getPredefinedDictionary(self.aruco_metadata["aruco_type"])
+        arucoParams = cv2.aruco.DetectorParameters()
+        arucoParams.useAruco3Detection = True
+        arucoParams.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_SUBPIX
+        return cv2.aruco.ArucoDetector(arucoDict, arucoParams)
+
+    def _detect_camera(self, camera_name: str, image: Tensor) -> Tuple[np.ndarray, np.ndarray]:
+        """Detect the known markers on the camera image.
+
+        Args:
+            camera_name (str): Camera name, e.g. "front_cam".
+            image (Tensor): Camera image of shape (3, H, W).
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Distances from the camera to the markers, array of shape (N,),
+                and the base link poses estimated by the markers, array of shape (N, 4, 4).
+        """
+        frame = image.permute(1, 2, 0).numpy()
+        corners, ids, _ = self._detectors[camera_name].detectMarkers(frame)
+        ids = [] if ids is None else np.asarray(ids).reshape(-1)  # (N, 1) before OpenCV 5
+        known = []
+        for i, marker_id in enumerate(ids):
+            if marker_id in self._aruco2world:
+                logger.debug(f"Detect Aruco with id {marker_id} on {camera_name}")
+                known.append(i)
+            else:
+                logger.warning(f"Can't find Aruco with id {marker_id} in aruco_metadata !")
+        aruco2sensor = estimate_markers_poses([corners[i] for i in known], self.aruco_metadata["aruco_size"],
+                                              self._intrinsics[camera_name], self._distortion[camera_name])
+        aruco2world = np.array([self._aruco2world[ids[i]] for i in known]).reshape(-1, 4, 4)
+        baselink2world = aruco2world @ np.linalg.inv(aruco2sensor) @ self._baselink2sensor[camera_name]
+        return np.linalg.norm(aruco2sensor[:, :3, 3], axis=1), baselink2world
+
     def infer(self, input_data: Dict[str, Tensor]) -> Dict[str, np.ndarray]:
         """Single sample inference.
 
@@ -71,52 +221,63 @@ class ArucoLocalizationPipeline(LocalizationPipeline):
                 "pose_by_aruco": "pose" for predicted pose in the format [tx, ty, tz, qx, qy, qz, qw],
 
                 "pose_by_place_recognition": "pose" for predicted pose in the format [tx, ty, tz, qx, qy, qz, qw].
+
+                A pose is None if no marker was found or its branch was skipped by the policy.
         """
         poses = {"pose_by_aruco": None, "pose_by_place_recognition": None}
-        min_dist = np.inf
+        if self.policy == "race":
+            t_deadline = None if self.deadline is None else time.perf_counter() + self.deadline
+            # do not queue the learned branch behind a still running one of the previous frames
+            place_recognition_future = None
+            if self._place_recognition_future is None or self._place_recognition_future.done():
+                if self._branch_executor is None:
+                    self._branch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="opr_aruco_race")
+                place_recognition_future = self._branch_executor.submit(self._infer_place_recognition, input_data)
+                self._place_recognition_future = place_recognition_future
+            else:
+                logger.debug("Place Recognition branch of the previous frame is still running, skip it")
+            # the ArUco branch runs in the calling thread, so it never waits for the learned one
+            poses["pose_by_aruco"], dist = self._infer_aruco(input_data)
+            if place_recognition_future is not None:
+                # with a trusted marker take the learned pose only if it is ready already
+                if dist < self.max_marker_distance:
+                    timeout = 0.0
+                else:
+                    timeout = None if t_deadline is None else max(t_deadline - time.perf_counter(), 0.0)
+                done, _ = wait([place_recognition_future], timeout=timeout)
+                if done:
+                    poses["pose_by_place_recognition"] = place_recognition_future.result()
+            return poses
 
-        arucoDict = cv2.aruco.getPredefinedDictionary(self.aruco_metadata["aruco_type"])
-        arucoParams = cv2.aruco.DetectorParameters()
-        arucoParams.useAruco3Detection = True
-        arucoParams.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_SUBPIX
-
-        detector = cv2.aruco.ArucoDetector(arucoDict, arucoParams)
-        camera_names = [key for key in input_data.keys() if key.startswith("image_")]
-        for camera_name_ in camera_names:
-            frame = input_data[camera_name_].permute(1, 2, 0).numpy()
-            corners, ids, _ = detector.detectMarkers(frame)
-
-            sensor2baselink = pose_to_matrix(np.array(self.camera_metadata[f"{camera_name_[6:]}2baselink"]))
-
-            if len(corners) > 0:
-                for i in range(0, len(ids)):
-                    print(f"Detect Aruco with id {ids[i]} on {camera_name_}")
-                    try:
-                        aruco2world = pose_to_matrix(self.aruco_metadata["aruco_gt_pose_by_id"][ids[i][0]])
-                    except:
-                        print(f"Can't find Aruco with id {ids[i]} in aruco_metadata !")
-                        continue
-                    rvec, tvec, _ = cv2.aruco.estimatePoseSingleMarkers(corners=corners[i],
-                                                        markerLength=self.aruco_metadata["aruco_size"],
-                                                        cameraMatrix=np.array(self.camera_metadata[f"{camera_name_[6:]}_intrinsics"]),
-                                                        distCoeffs=np.array(self.camera_metadata[f"{camera_name_[6:]}_distortion"]))
-
-                    rvec = cv2.Rodrigues(rvec)[0].reshape(3, 3)
-                    tvec = np.squeeze(tvec)
-                    aruco2sensor = np.eye(4)
-                    aruco2sensor[:3, :3] = rvec
-                    aruco2sensor[:3, 3] = tvec
-
-                    dist = sum([t ** 2 for t in tvec]) ** 0.5
-                    baselink2world = aruco2world @ np.linalg.inv(aruco2sensor) @ np.linalg.inv(sensor2baselink)
-
-                    if dist < min_dist:
-                        print(f"Utilize Aruco with id {ids[i]} on {camera_name_} for pose estimation due min distanse")
-                        min_dist = dist
-                        rot, trans = get_rotation_translation_from_transform(baselink2world)
-                        rot = R.from_matrix(rot).as_quat()
-                        poses["pose_by_aruco"] = np.concatenate([trans, rot])
-
-        poses["pose_by_place_recognition"] = super().infer(input_data)["estimated_pose"]
+        poses["pose_by_aruco"], dist = self._infer_aruco(input_data)
+        if self.policy == "short_circuit" and dist < self.max_marker_distance:
+            return poses
+        poses["pose_by_place_recognition"] = self._infer_place_recognition(input_data)
 
         return poses
+
+    def _infer_aruco(self, input_data: Dict[str, Tensor]) -> Tuple[Optional[np.ndarray], float]:
+        """Estimate the pose by the nearest marker on the cameras images and the distance to the marker."""
+        pose, min_dist = None, np.inf
+        t_start = time.perf_counter()
+
+        camera_names = [key[6:] for key in input_data.keys() if key.startswith("image_")]
+        images = [input_data[f"image_{camera_name}"] for camera_name in camera_names]
+        if self.num_detection_workers <= 1 or len(camera_names) < 2:
+            detections = list(map(self._detect_camera, camera_names, images))
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.num_detection_workers, len(camera_names))) as executor:
+                detections = list(executor.map(self._detect_camera, camera_names, images))
+        dists = np.concatenate([np.zeros(0)] + [dist for dist, _ in detections])
+        if len(dists) > 0:
+            min_dist = float(dists.min())
+            baselink2world = np.concatenate([poses_ for _, poses_ in detections])[np.argmin(dists)]
+            rot, trans = get_rotation_translation_from_transform(baselink2world)
+            rot = R.from_matrix(rot).as_quat()
+            pose = np.concatenate([trans, rot])
+        self.profiler.record("aruco/detection", time.perf_counter() - t_start, start=t_start)
+        return pose, min_dist
+
+    def _infer_place_recognition(self, input_data: Dict[str, Tensor]) -> np.ndarray:
+        """Estimate the pose with the Place Recognition and Registration branch."""
+        return super().infer(input_data)["estimated_pose"]
@@ -1,5 +1,7 @@
 """Hierarchical Localization Pipeline."""
-from typing import Dict
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 from geotransformer.utils.pointcloud import (
@@ -10,8 +12,11 @@ from scipy.spatial.transform import Rotation
 from torch import Tensor
 
 from opr.datasets.itlp import ITLPCampus
+from opr.pipelines.localization.pointcloud_store import PointcloudStore
 from opr.pipelines.place_recognition import PlaceRecognitionPipeline
 from opr.pipelines.registration import PointcloudRegistrationPipeline
+from opr.profiling import StageProfiler
+from opr.utils import LRUCache
 
 
 class LocalizationPipeline:
@@ -27,6 +32,13 @@ class LocalizationPipeline:
         place_recognition_pipeline: PlaceRecognitionPipeline,
         registration_pipeline: PointcloudRegistrationPipeline,
         db_dataset: ITLPCampus,  # TODO: replace with a generic "inference" dataset
+        db_cache_size: int = 128,
+        db_pointcloud_store: Optional[PointcloudStore] = None,
+        num_candidates: int = 1,
+        num_workers: int = 1,
+        db_feature_cache_size: int = 0,
+        profiler: Optional[StageProfiler] = None,
+        batch_candidates: bool = False,
     ) -> None:
         """Hierarchical Localization Pipeline.
 
@@ -38,48 +50,290 @@ class LocalizationPipeline:
             place_recognition_pipeline (PlaceRecognitionPipeline): Place Recognition pipeline.
             registration_pipeline (PointcloudRegistrationPipeline): Registration pipeline.
             db_dataset (ITLPCampus): Database dataset.
+            db_cache_size (int): Number of downsampled database pointclouds to keep in the LRU cache.
+                Matched places repeat along a route, so the cache saves loading and downsampling them.
+                If 0, the cache is disabled. Defaults to 128.
+            db_pointcloud_store (PointcloudStore, optional): Store of the database pointclouds precomputed
+                with the registration pipeline voxel size. If given, the database pointclouds are read from
+                it zero-copy instead of the database dataset, and the cache is not used. Defaults to None.
+            num_candidates (int): Number of top Place Recognition candidates to register the query with.
+                The candidate with the best registration score (overlap) is selected. Defaults to 1.
+            num_workers (int): Number of threads to register the candidates in parallel. The threads live
+                for the duration of an inference only. Defaults to 1.
+            db_feature_cache_size (int): Number of database pointcloud encodings to keep in the LRU cache,
+                if the registration model supports the reference encoding (GeoTransformer). Then only
+                the query pointcloud is encoded for the cached database places. If 0, the cache is disabled
+                and the pairs are registered jointly. Defaults to 0.
+            profiler (StageProfiler, optional): Profiler of the "localization/place_recognition",
+                "localization/load_candidate" and "localization/register_candidate" stages. Pass the same
+                profiler to the Place Recognition and registration pipelines to break these stages down.
+                If None, a disabled profiler is created. Defaults to None.
+            batch_candidates (bool): Whether to register the candidates in one batch if "num_workers" is 1
+                and the registration model supports batching. The GeoTransformer backbone then computes
+                the group normalization statistics over the whole batch, so the transforms differ from
+                the per-pair ones (no tolerance is guaranteed) and may select another candidate.
+                Defaults to False.
+
+        Raises:
+            ValueError: If the store voxel size differs from the registration pipeline one.
         """
+        self.profiler = profiler if profiler is not None else StageProfiler(enabled=False)
         self.pr_pipe = place_recognition_pipeline
         self.reg_pipeline = registration_pipeline
         self.db_dataset = db_dataset
+        self.db_cache = LRUCache(max_size=db_cache_size)
+        if (
+            db_pointcloud_store is not None
+            and db_pointcloud_store.voxel_downsample_size != registration_pipeline.voxel_downsample_size
+        ):
+            raise ValueError(
+                f"Pointcloud store voxel size {db_pointcloud_store.voxel_downsample_size} differs from "
+                f"the registration pipeline one {registration_pipeline.voxel_downsample_size}."
+            )
+        self.db_pointcloud_store = db_pointcloud_store
+        self.num_candidates = num_candidates
+        self.batch_candidates = batch_candidates
+        self.db_feature_cache = LRUCache(max_size=db_feature_cache_size)
+        self._use_db_feature_cache = (
+            db_feature_cache_size > 0 and registration_pipeline.supports_reference_encoding
+        )
+        self.num_workers = num_workers
 
-    def infer(self, input_data: Dict[str, Tensor]) -> Dict[str, np.ndarray]:
-        """Single sample inference.
+    def _load_db_pointcloud(self, idx: int) -> Tuple[Tensor, Tensor]:
+        """Load the database pointcloud downsampled for registration and the database pose."""
+        if hasattr(self.db_dataset, "get_pointcloud_and_pose"):
+            db_pc, db_pose = self.db_dataset.get_pointcloud_and_pose(idx)
+        else:
+            data = self.db_dataset[idx]
+            db_pc, db_pose = data["pointcloud_lidar_coords"], data["pose"]
+        return self.reg_pipeline._downsample_pointcloud(db_pc), db_pose
+
+    def _get_db_pointcloud(self, idx: int) -> Tuple[Tensor, Tensor]:
+        """Get the downsampled database pointcloud and the database pose, using the store or the cache.
+
+        The Place Recognition database place ids are the rows of the database dataset it was built from.
+        They stay stable when places are removed, but the places added with the "add_places" method
+        have no pointclouds in the dataset.
 
         Args:
-            input_data (Dict[str, Tensor]): Input data. Dictionary with keys in the following format:
+            idx (int): Database place id.
 
-                "image_{camera_name}" for images from cameras,
+        Returns:
+            Tuple[Tensor, Tensor]: Downsampled database pointcloud and database pose.
 
-                "mask_{camera_name}" for semantic segmentation masks,
+        Raises:
+            ValueError: If there is no pointcloud for the place id in the database dataset or store.
+        """
+        num_places = len(
+            self.db_pointcloud_store if self.db_pointcloud_store is not None else self.db_dataset
+        )
+        if not 0 <= idx < num_places:
+            raise ValueError(
+                f"Database place {idx} has no pointcloud among the {num_places} database dataset places. "
+                "Places added to the Place Recognition database with 'add_places' can not be registered."
+            )
+        if self.db_pointcloud_store is not None:
+            return self.db_pointcloud_store[idx]
+        return self.db_cache.get_or_compute(int(idx), lambda: self._load_db_pointcloud(idx))
 
-                "pointcloud_lidar_coords" for pointcloud coordinates from lidar,
+    def _load_candidate(self, idx: int) -> Tuple[Tensor, Tensor, float]:
+        """Get the database candidate pointcloud and pose, and the time it took in seconds."""
+        t_start = time.perf_counter()
+        with self.profiler.stage("localization/load_candidate"):
+            db_pc, db_pose = self._get_db_pointcloud(idx)
+        return db_pc, db_pose, time.perf_counter() - t_start
 
-                "pointcloud_lidar_feats" for pointcloud features from lidar.
+    def _register_candidate(
+        self,
+        query_pc: Tensor,
+        idx: int,
+        db_data: Optional[Tuple[Tensor, Tensor, float]] = None,
+        compute_score: bool = True,
+    ) -> Tuple[Tensor, np.ndarray, float, Tuple[float, float, float]]:
+        """Register the downsampled query pointcloud with the database candidate.
+
+        Args:
+            query_pc (Tensor): Downsampled query pointcloud.
+            idx (int): Database candidate index.
+            db_data (Tuple[Tensor, Tensor, float], optional): Already loaded candidate, the "_load_candidate"
+                method output. If None, the candidate is loaded. Defaults to None.
+            compute_score (bool): Whether to compute the registration score. If False, the score is NaN,
+                e.g. for a single candidate there is nothing to select from. Defaults to True.
 
         Returns:
-            Dict[str, np.ndarray]: Inference results. Dictionary with keys:
+            Tuple[Tensor, np.ndarray, float, Tuple[float, float, float]]: Database pose, estimated transform,
+                registration score and the database pointcloud loading, registration and scoring times.
+        """
+        db_pc, db_pose, load_time = self._load_candidate(idx) if db_data is None else db_data
+        with self.profiler.stage("localization/register_candidate"):
+            t_start = time.perf_counter()
+            if self._use_db_feature_cache:
+                reference = self.db_feature_cache.get_or_compute(
+                    int(idx), lambda: self.reg_pipeline.encode_reference(db_pc, downsample_db_pc=False)
+                )
+                transform = self.reg_pipeline.infer_with_reference(
+                    query_pc, reference, downsample_query_pc=False
+                )
+            else:
+                transform = self.reg_pipeline.infer(
+                    query_pc, db_pc, downsample_db_pc=False, downsample_query_pc=False
+                )
+            t_registered = time.perf_counter()
+            score = self.reg_pipeline.compute_overlap(query_pc, db_pc, transform) if compute_score else np.nan
+            t_scored = time.perf_counter()
+        return db_pose, transform, score, (load_time, t_registered - t_start, t_scored - t_registered)
 
-                "db_match_pose" for database match pose in the format [tx, ty, tz, qx, qy, qz, qw],
+    def _register_candidates_batch(
+        self,
+        query_pc: Tensor,
+        candidate_idxs: np.ndarray,
+        db_data_list: List[Optional[Tuple[Tensor, Tensor, float]]],
+    ) -> List[Tuple[Tensor, np.ndarray, float, Tuple[float, float, float]]]:
+        """Register the query with all candidates in one batch, see the "_register_candidate" method.
+
+        Args:
+            query_pc (Tensor): Downsampled query pointcloud.
+            candidate_idxs (np.ndarray): Database candidates indices.
+            db_data_list (List[Optional[Tuple[Tensor, Tensor, float]]]): Already loaded candidates
+                or None for the candidates to load.
 
-                "estimated_pose" for estimated pose in the format [tx, ty, tz, qx, qy, qz, qw].
+        Returns:
+            List[Tuple[Tensor, np.ndarray, float, Tuple[float, float, float]]]: Results of the candidates
+                in the "_register_candidate" method output format. The registration time of a single
+                candidate is not known, so it is NaN. The batch registration time is recorded by the profiler
+                "localization/register_candidate" stage.
         """
-        out_dict = {}
+        db_data_list = [
+            self._load_candidate(idx) if db_data is None else db_data
+            for idx, db_data in zip(candidate_idxs, db_data_list)
+        ]
+        with self.profiler.stage("localization/register_candidate"):
+            t_start = time.perf_counter()
+            transforms = self.reg_pipeline.infer_batch(
+                [query_pc] * len(db_data_list),
+                [db_data[0] for db_data in db_data_list],
+                downsample_db_pc=False,
+                downsample_query_pc=False,
+            )
+            results = []
+            for (db_pc, db_pose, load_time), transform in zip(db_data_list, transforms):
+                t_start = time.perf_counter()
+                score = self.reg_pipeline.compute_overlap(query_pc, db_pc, transform)
+                times = (load_time, np.nan, time.perf_counter() - t_start)
+                results.append((db_pose, transform, score, times))
+        return results
 
-        pr_output = self.pr_pipe.infer(input_data)
-        query_pc = input_data["pointcloud_lidar_coords"]
-        db_pc = self.db_dataset[pr_output["idx"]]["pointcloud_lidar_coords"]
-        db_pose = self.db_dataset[pr_output["idx"]]["pose"]
-        out_dict["db_match_pose"] = db_pose
+    def _localize(
+        self,
+        query_pc: Tensor,
+        candidate_idxs: np.ndarray,
+        db_data_list: Optional[List[Tuple[Tensor, Tensor, float]]] = None,
+    ) -> Dict[str, np.ndarray]:
+        """Register the downsampled query pointcloud with the candidates and select the best one.
+
+        Args:
+            query_pc (Tensor): Downsampled query pointcloud.
+            candidate_idxs (np.ndarray): Database candidates indices.
+            db_data_list (List[Tuple[Tensor, Tensor, float]], optional): Already loaded candidates.
+                If None, the candidates are loaded. Defaults to None.
+
+        Returns:
+            Dict[str, np.ndarray]: Inference results, see the "infer" method.
+        """
+        if len(candidate_idxs) == 0:
+            return {
+                "db_match_pose": np.full(7, np.nan),
+                "estimated_pose": np.full(7, np.nan),
+                "db_match_idx": -1,
+                "candidate_idxs": candidate_idxs,
+                "candidate_scores": np.empty(0),
+                "candidate_times": np.empty((0, 3)),
+            }
+        if db_data_list is None:
+            db_data_list = [None] * len(candidate_idxs)
+        if (
+            self.batch_candidates
+            and self.num_workers <= 1
+            and len(candidate_idxs) > 1
+            and self.reg_pipeline.supports_batching
+            and not self._use_db_feature_cache
+        ):
+            results = self._register_candidates_batch(query_pc, candidate_idxs, db_data_list)
+        elif len(candidate_idxs) == 1:
+            # nothing to select from, so the overlap scoring is skipped
+            results = [
+                self._register_candidate(query_pc, candidate_idxs[0], db_data_list[0], compute_score=False)
+            ]
+        elif self.num_workers <= 1:
+            results = [
+                self._register_candidate(query_pc, idx, db_data)
+                for idx, db_data in zip(candidate_idxs, db_data_list)
+            ]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.num_workers, len(candidate_idxs))) as executor:
+                results = list(
+                    executor.map(
+                        lambda idx, db_data: self._register_candidate(query_pc, idx, db_data),
+                        candidate_idxs,
+                        db_data_list,
+                    )
+                )
+        scores = np.array([result[2] for result in results])
+        best = int(np.argmax(scores))
+        db_pose, estimated_transform = results[best][0], results[best][1]
 
+        out_dict = {}
+        out_dict["db_match_pose"] = db_pose
         db_pose = get_transform_from_rotation_translation(
             Rotation.from_quat(db_pose[3:]).as_matrix(), db_pose[:3]
         )
-        estimated_transform = self.reg_pipeline.infer(query_pc, db_pc)
         estimated_pose = db_pose @ estimated_transform
         rot, trans = get_rotation_translation_from_transform(estimated_pose)
         rot = Rotation.from_matrix(rot).as_quat()
         pose = np.concatenate([trans, rot])
         out_dict["estimated_pose"] = pose
-
+        out_dict["db_match_idx"] = candidate_idxs[best]
+        out_dict["candidate_idxs"] = candidate_idxs
+        out_dict["candidate_scores"] = scores
+        out_dict["candidate_times"] = np.array([result[3] for result in results])
         return out_dict
+
+    def infer(self, input_data: Dict[str, Tensor]) -> Dict[str, np.ndarray]:
+        """Single sample inference.
+
+        Args:
+            input_data (Dict[str, Tensor]): Input data. Dictionary with keys in the following format:
+
+                "image_{camera_name}" for images from cameras,
+
+                "mask_{camera_name}" for semantic segmentation masks,
+
+                "pointcloud_lidar_coords" for pointcloud coordinates from lidar,
+
+                "pointcloud_lidar_feats" for pointcloud features from lidar.
+
+        Returns:
+            Dict[str, np.ndarray]: Inference results. If the Place Recognition pipeline returned no
+                candidates, the query is not localized: the poses are NaN, the selected candidate index is -1
+                and the candidates arrays are empty. Dictionary with keys:
+
+                "db_match_pose" for database match pose in the format [tx, ty, tz, qx, qy, qz, qw],
+
+                "estimated_pose" for estimated pose in the format [tx, ty, tz, qx, qy, qz, qw],
+
+                "db_match_idx" for the selected database candidate index,
+
+                "candidate_idxs" for the registered candidates indices, array of shape (k,),
+
+                "candidate_scores" for the candidates registration scores (overlap), array of shape (k,).
+                NaN for a single candidate, as it is not scored,
+
+                "candidate_times" for the candidates database pointcloud loading, registration and scoring
+                times in seconds, array of shape (k, 3). The registration times are NaN for the candidates
+                registered in one batch.
+        """
+        with self.profiler.stage("localization/place_recognition"):
+            pr_output = self.pr_pipe.infer(input_data, k=self.num_candidates)
+        candidate_idxs = pr_output["topk_idxs"][pr_output["topk_idxs"] >= 0]
+        query_pc = self.reg_pipeline._downsample_pointcloud(input_data["pointcloud_lidar_coords"])
+        return self._localize(query_pc, candidate_idxs)
@@ -0,0 +1,132 @@
+"""Packed store of precomputed database pointclouds for registration."""
+import json
+import logging
+from os import PathLike
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import numpy as np
+import torch
+from torch import Tensor
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from opr.pipelines.place_recognition.database import atomic_write, save_npy_atomic
+from opr.pipelines.registration.pointcloud import voxel_downsample_pointcloud
+
+logger = logging.getLogger(__name__)
+
+POINTS_FILENAME = "pointclouds.bin"
+OFFSETS_FILENAME = "pointclouds_offsets.npy"
+POSES_FILENAME = "pointclouds_poses.npy"
+META_FILENAME = "pointclouds_meta.json"
+
+
+class PointcloudStore:
+    """Memory-mapped packed store of database pointclouds downsampled for registration.
+
+    The store directory contains the following files:
+
+        "pointclouds.bin" with the float32 coordinates of all pointclouds concatenated, shape (P, 3),
+
+        "pointclouds_offsets.npy" with the offsets table, pointcloud i is points[offsets[i]:offsets[i + 1]],
+
+        "pointclouds_poses.npy" with the database poses in the format [tx, ty, tz, qx, qy, qz, qw],
+
+        "pointclouds_meta.json" with the voxel downsample size the pointclouds were built with.
+    """
+
+    def __init__(self, store_dir: Union[str, PathLike]) -> None:
+        """Memory-mapped packed store of database pointclouds downsampled for registration.
+
+        Args:
+            store_dir (Union[str, PathLike]): Store directory created with the "build" method.
+
+        Raises:
+            FileNotFoundError: If the store is missing or incomplete.
+        """
+        self.store_dir = Path(store_dir)
+        meta_filepath = self.store_dir / META_FILENAME
+        if not meta_filepath.exists():
+            raise FileNotFoundError(f"Pointcloud store not found: {meta_filepath}. Build it first.")
+        with open(meta_filepath) as f:
+            meta = json.load(f)
+        self.voxel_downsample_size: Optional[float] = meta["voxel_downsample_size"]
+        self._offsets = np.load(self.store_dir / OFFSETS_FILENAME)
+        self.poses = np.load(self.store_dir / POSES_FILENAME, mmap_mode="r")
+        num_points = int(self._offsets[-1])
+        if num_points > 0:
+            # copy-on-write mode gives writable zero-copy views that torch.from_numpy accepts without warnings
+            self._points = np.memmap(
+                self.store_dir / POINTS_FILENAME, dtype=np.float32, mode="c", shape=(num_points, 3)
+            )
+        else:
+            self._points = np.zeros((0, 3), dtype=np.float32)
+
+    def __len__(self) -> int:  # noqa: D105
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx: int) -> Tuple[Tensor, Tensor]:
+        """Get the database pointcloud and pose.
+
+        Args:
+            idx (int): Database index.
+
+        Returns:
+            Tuple[Tensor, Tensor]: Downsampled pointcloud coordinates of shape (N, 3), a zero-copy view
+                of the memory-mapped file, and pose in the format [tx, ty, tz, qx, qy, qz, qw].
+        """
+        start, end = self._offsets[idx], self._offsets[idx + 1]
+        return torch.from_numpy(self._points[start:end]), torch.from_numpy(np.array(self.poses[idx]))
+
+    @staticmethod
+    def build(
+        db_dataset: Dataset,
+        store_dir: Union[str, PathLike],
+        voxel_downsample_size: Optional[float] = 0.3,
+    ) -> "PointcloudStore":
+        """Downsample all database pointclouds and write them to the packed store.
+
+        Args:
+            db_dataset (Dataset): Database dataset, e.g. ITLPCampus. The pointclouds are loaded with the
+                "get_pointcloud_and_pose" method if the dataset has it, otherwise with "__getitem__".
+            store_dir (Union[str, PathLike]): Output store directory.
+            voxel_downsample_size (float, optional): Voxel downsample size, it must be equal to
+                the registration pipeline one. If None, the pointclouds are not downsampled. Defaults to 0.3.
+
+        Returns:
+            PointcloudStore: Built store.
+        """
+        store_dir = Path(store_dir)
+        store_dir.mkdir(parents=True, exist_ok=True)
+        offsets = np.zeros(len(db_dataset) + 1, dtype=np.int64)
+        poses = np.zeros((len(db_dataset), 7), dtype=np.float32)
+
+        def _write_points(path: str) -> None:
+            with open(path, "wb") as f:
+                for idx in tqdm(range(len(db_dataset)), desc="Building pointcloud store", leave=False):
+                    if hasattr(db_dataset, "get_pointcloud_and_pose"):
+                        pc, pose = db_dataset.get_pointcloud_and_pose(idx)
+                    else:
+                        data = db_dataset[idx]
+                        pc, pose = data["pointcloud_lidar_coords"], data["pose"]
+                    if voxel_downsample_size is not None:
+                        pc = voxel_downsample_pointcloud(pc, voxel_downsample_size)
+                    pc = np.ascontiguousarray(torch.as_tensor(pc).cpu().numpy(), dtype=np.float32)
+                    f.write(pc.tobytes())
+                    offsets[idx + 1] = offsets[idx] + len(pc)
+                    poses[idx] = torch.as_tensor(pose).cpu().numpy()
+
+        # the meta file is written last, so an interrupted build leaves no valid store
+        (store_dir / META_FILENAME).unlink(missing_ok=True)
+        atomic_write(store_dir / POINTS_FILENAME, _write_points)
+        save_npy_atomic(store_dir / OFFSETS_FILENAME, offsets)
+        save_npy_atomic(store_dir / POSES_FILENAME, poses)
+
+        def _write_meta(path: str) -> None:
+            with open(path, "w") as f:
+                json.dump({"voxel_downsample_size": voxel_downsample_size}, f)
+
+        atomic_write(store_dir / META_FILENAME, _write_meta)
+        logger.info(f"Built pointcloud store with {len(db_dataset)} pointclouds and {offsets[-1]} points")
+        return PointcloudStore(store_dir)
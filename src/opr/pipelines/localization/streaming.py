@@ -0,0 +1,208 @@
+"""Streaming runner for the localization pipelines."""
+import logging
+import queue
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Literal, NamedTuple, Tuple
+
+import numpy as np
+from torch import Tensor
+
+from opr.pipelines.localization.base import LocalizationPipeline
+
+logger = logging.getLogger(__name__)
+
+DropPolicy = Literal["block", "drop_oldest", "drop_newest"]
+DROP_POLICIES = ("block", "drop_oldest", "drop_newest")
+
+_END_OF_STREAM = object()
+
+
+class _StageError(NamedTuple):
+    """Exception raised in a stage thread, passed downstream to the consumer."""
+
+    exception: BaseException
+
+
+class StreamingLocalizationRunner:
+    """Runs the LocalizationPipeline over a stream of frames as a pipeline of concurrent stages.
+
+    The stages are connected with bounded queues and run in separate threads:
+
+        1. Place Recognition: model forward pass and database index search,
+
+        2. Loading: database candidates pointclouds loading and query pointcloud downsampling,
+
+        3. Registration: candidates registration and pose estimation.
+
+    So the database pointcloud loading for frame t overlaps the descriptor computation for frame t+1.
+    Full queues block the upstream stages (backpressure). If frames arrive faster than the slowest stage
+    processes them, the drop policy decides which frames are skipped.
+    """
+
+    def __init__(
+        self,
+        pipeline: LocalizationPipeline,
+        queue_size: int = 2,
+        drop_policy: DropPolicy = "block",
+    ) -> None:
+        """Runs the LocalizationPipeline over a stream of frames as a pipeline of concurrent stages.
+
+        Args:
+            pipeline (LocalizationPipeline): Localization pipeline.
+            queue_size (int): Capacity of the queues between the stages. Defaults to 2.
+            drop_policy (DropPolicy): What to do with a new frame if the input queue is full:
+                "block" waits for a free slot (for recorded streams, no frames are dropped),
+                "drop_oldest" drops the oldest queued frame (for live streams, lowest latency),
+                "drop_newest" drops the new frame. Defaults to "block".
+
+        Raises:
+            ValueError: If the queue size is not positive or the drop policy is unknown.
+        """
+        if queue_size < 1:
+            raise ValueError(f"queue_size must be positive, but {queue_size!r} given.")
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop_policy: {drop_policy!r}. Valid policies: {DROP_POLICIES!r}")
+        self.pipeline = pipeline
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+        self.num_dropped = 0
+        self._stop_event = threading.Event()
+
+    def _put(self, out_queue: queue.Queue, item: Any) -> bool:
+        """Put the item into the queue, waiting for a free slot. Returns False if the runner was stopped."""
+        while not self._stop_event.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, in_queue: queue.Queue) -> Any:
+        """Get the item from the queue, waiting for it. Returns the end of stream if the runner was stopped."""
+        while not self._stop_event.is_set():
+            try:
+                return in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END_OF_STREAM
+
+    def _put_frame(self, in_queue: queue.Queue, item: Tuple[int, Dict[str, Tensor]]) -> None:
+        """Put the new frame into the input queue according to the drop policy."""
+        if self.drop_policy == "block":
+            self._put(in_queue, item)
+            return
+        while True:
+            try:
+                in_queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            if self.drop_policy == "drop_newest":
+                self.num_dropped += 1
+                return
+            try:
+                in_queue.get_nowait()
+                self.num_dropped += 1
+            except queue.Empty:
+                pass
+
+    def _feed(self, frames: Iterable[Dict[str, Tensor]], in_queue: queue.Queue) -> None:
+        """Feed the frames into the input queue."""
+        try:
+            for frame_idx, frame in enumerate(frames):
+                if self._stop_event.is_set():
+                    return
+                self._put_frame(in_queue, (frame_idx, frame))
+        except Exception as e:  # noqa: B902
+            self._put(in_queue, _StageError(e))
+        self._put(in_queue, _END_OF_STREAM)
+
+    def _run_stage(
+        self, stage_fn: Callable[[Any], Any], in_queue: queue.Queue, out_queue: queue.Queue
+    ) -> None:
+        """Apply the stage function to the items from the input queue until the end of the stream."""
+        while True:
+            item = self._get(in_queue)
+            if item is _END_OF_STREAM or isinstance(item, _StageError):
+                self._put(out_queue, item)
+                if item is _END_OF_STREAM:
+                    return
+                continue
+            frame_idx, payload = item
+            try:
+                result = stage_fn(payload)
+            except Exception as e:  # noqa: B902
+                result = _StageError(e)
+            self._put(out_queue, result if isinstance(result, _StageError) else (frame_idx, result))
+
+    def _place_recognition_stage(
+        self, input_data: Dict[str, Tensor]
+    ) -> Tuple[Dict[str, Tensor], Dict[str, np.ndarray]]:
+        with self.pipeline.profiler.stage("localization/place_recognition"):
+            pr_output = self.pipeline.pr_pipe.infer(input_data, k=self.pipeline.num_candidates)
+        return input_data, pr_output
+
+    def _loading_stage(
+        self, payload: Tuple[Dict[str, Tensor], Dict[str, np.ndarray]]
+    ) -> Tuple[Tensor, np.ndarray, List[Tuple[Tensor, Tensor, float]]]:
+        input_data, pr_output = payload
+        candidate_idxs = pr_output["topk_idxs"][pr_output["topk_idxs"] >= 0]
+        db_data_list = [self.pipeline._load_candidate(idx) for idx in candidate_idxs]
+        query_pc = self.pipeline.reg_pipeline._downsample_pointcloud(input_data["pointcloud_lidar_coords"])
+        return query_pc, candidate_idxs, db_data_list
+
+    def _registration_stage(
+        self, payload: Tuple[Tensor, np.ndarray, List[Tuple[Tensor, Tensor, float]]]
+    ) -> Dict[str, np.ndarray]:
+        query_pc, candidate_idxs, db_data_list = payload
+        return self.pipeline._localize(query_pc, candidate_idxs, db_data_list)
+
+    def run(self, frames: Iterable[Dict[str, Tensor]]) -> Iterator[Dict[str, Any]]:
+        """Localize the frames of the stream.
+
+        Args:
+            frames (Iterable[Dict[str, Tensor]]): Stream of frames in the LocalizationPipeline "infer" method
+                input format. It is consumed in a separate thread.
+
+        Yields:
+            Dict[str, Any]: Inference results in the LocalizationPipeline "infer" method output format
+                with the additional "frame_idx" key, the index of the frame in the stream. The results
+                are yielded in the stream order, dropped frames are skipped.
+
+        Raises:
+            RuntimeError: If any of the stages or the frames iterator failed. The stream is stopped.
+        """
+        self._stop_event.clear()
+        self.num_dropped = 0
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(4)]
+        stages = [self._place_recognition_stage, self._loading_stage, self._registration_stage]
+        threads = [threading.Thread(target=self._feed, args=(frames, queues[0]), daemon=True)]
+        for i, stage_fn in enumerate(stages):
+            threads.append(
+                threading.Thread(
+                    target=self._run_stage, args=(stage_fn, queues[i], queues[i + 1]), daemon=True
+                )
+            )
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if item is _END_OF_STREAM:
+                    break
+                if isinstance(item, _StageError):
+                    raise RuntimeError("Streaming localization failed") from item.exception
+                frame_idx, output = item
+                output["frame_idx"] = frame_idx
+                yield output
+        finally:
+            self._stop_event.set()
+            for thread in threads[1:]:  # the feeder thread may be blocked by the frames iterator
+                thread.join()
+            if self.num_dropped > 0:
+                logger.info(f"Dropped {self.num_dropped} frames")
+
+    def stop(self) -> None:
+        """Stop the running stream from another thread. The "run" generator then finishes."""
+        self._stop_event.set()
@@ -1,3 +1,5 @@
 """Place Recognition pipelines."""
 from .base import PlaceRecognitionPipeline
+from .sequence import SequencePlaceRecognitionPipeline
+from .sharded import ShardedPlaceRecognitionPipeline
 from .text_labels import TextLabelsPlaceRecognitionPipeline
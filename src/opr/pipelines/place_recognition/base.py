@@ -1,14 +1,28 @@
 """Basic Place Recognition pipelines."""
+import threading
 from os import PathLike
 from pathlib import Path
-from typing import Dict, Optional, Union
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
 import MinkowskiEngine as ME
 import numpy as np
 import pandas as pd
 import torch
+from scipy.spatial import cKDTree
 from torch import Tensor, nn
 
+from opr.pipelines.place_recognition.cache import QueryCache, input_checksum
+from opr.pipelines.place_recognition.database import (
+    IDS_FILENAME,
+    POSE_COLUMNS,
+    POSES_FILENAME,
+    atomic_write,
+    load_poses,
+    read_index,
+    save_npy_atomic,
+    set_search_params,
+)
+from opr.profiling import StageProfiler
 from opr.utils import init_model, parse_device
 
 try:
@@ -30,6 +44,13 @@ class PlaceRecognitionPipeline:
         model_weights_path: Optional[Union[str, PathLike]] = None,
         device: Union[str, int, torch.device] = "cpu",
         pointcloud_quantization_size: float = 0.5,
+        index_nprobe: Optional[int] = None,
+        index_ef_search: Optional[int] = None,
+        mmap_database: bool = False,
+        query_cache_size: int = 0,
+        query_cache_tolerance: float = 1e-3,
+        query_cache_inputs: bool = False,
+        profiler: Optional[StageProfiler] = None,
     ) -> None:
         """Basic Place Recognition pipeline.
 
@@ -42,59 +63,380 @@ class PlaceRecognitionPipeline:
                 If None, the weights are not loaded. Defaults to None.
             device (Union[str, int, torch.device]): Device to use. Defaults to "cpu".
             pointcloud_quantization_size (float): Pointcloud quantization size. Defaults to 0.5.
+            index_nprobe (int, optional): Number of clusters to visit for IVF-based indexes.
+                If None, the value stored in the index file is used. Defaults to None.
+            index_ef_search (int, optional): Search queue size for HNSW indexes.
+                If None, the value stored in the index file is used. Defaults to None.
+            mmap_database (bool): Whether to memory-map the database index and the "track_poses.npy"
+                poses file instead of reading them into RAM. The "track.csv" file is then parsed lazily,
+                only when "database_df" is accessed. Memory-mapped databases start up in constant time
+                and share pages between processes on the same host. Defaults to False.
+            query_cache_size (int): Number of recent queries to cache in the "infer" method, e.g. for
+                a robot that stands still. If 0, the cache is disabled. Defaults to 0.
+            query_cache_tolerance (float): Maximum L2 distance between the descriptors of a new and
+                a cached query to reuse the cached search result. Defaults to 1e-3.
+            query_cache_inputs (bool): Whether to also cache the input checksums to skip the model forward
+                pass for identical inputs. Defaults to False.
+            profiler (StageProfiler, optional): Profiler of the "place_recognition/preprocess",
+                "place_recognition/forward" and "place_recognition/search" stages. If None, a disabled
+                profiler is created. Defaults to None.
         """
+        self.profiler = profiler if profiler is not None else StageProfiler(enabled=False)
         self.device = parse_device(device)
         self.model = init_model(model, model_weights_path, self.device)
+        self._index_nprobe = index_nprobe
+        self._index_ef_search = index_ef_search
+        self._mmap_database = mmap_database
         self._init_database(database_dir)
         self._pointcloud_quantization_size = pointcloud_quantization_size
+        self.query_cache: Optional[QueryCache] = None
+        if query_cache_size > 0:
+            self.query_cache = QueryCache(max_size=query_cache_size, tolerance=query_cache_tolerance)
+        self._query_cache_inputs = query_cache_inputs
 
     def _init_database(self, database_dir: Union[str, PathLike]) -> None:
         """Initialize database."""
-        self.database_df = pd.read_csv(Path(database_dir) / "track.csv", index_col=0)
-        database_index_filepath = Path(database_dir) / "index.faiss"
+        self._database_dir = Path(database_dir)
+        self._database_df: Optional[pd.DataFrame] = None
+        self._database_lock = threading.RLock()
+        self._database_index_is_mutable = False
+        self._translations_tree: Optional[cKDTree] = None
+        ids_filepath = self._database_dir / IDS_FILENAME
+        # None means that the place ids are equal to the row numbers in "track.csv"
+        self._database_ids: Optional[np.ndarray] = np.load(ids_filepath) if ids_filepath.exists() else None
+        if self._mmap_database:
+            self._database_poses = load_poses(self._database_dir, mmap=True)
+        else:
+            self._database_poses = np.ascontiguousarray(
+                self.database_df[POSE_COLUMNS].to_numpy(dtype=np.float64)
+            )
+        database_index_filepath = self._database_dir / "index.faiss"
         if not database_index_filepath.exists():
             raise FileNotFoundError(f"Database index not found: {database_index_filepath}. Create it first.")
-        self.database_index = faiss.read_index(str(database_index_filepath))
+        database_index = read_index(database_index_filepath, mmap=self._mmap_database)
+        set_search_params(database_index, nprobe=self._index_nprobe, ef_search=self._index_ef_search)
+        self._set_database_index(database_index)
+
+    def _set_database_index(self, cpu_index: faiss.Index) -> None:
+        """Set the database index and transfer it to the pipeline device."""
+        self._database_index_cpu = cpu_index
+        self.database_index = cpu_index
         if self.device.type == "cuda":
             res = faiss.StandardGpuResources()
             idx = self.device.index if self.device.index is not None else 0
-            self.database_index = faiss.index_cpu_to_gpu(res, idx, self.database_index)
+            self.database_index = faiss.index_cpu_to_gpu(res, idx, cpu_index)
 
-    def _preprocess_input(self, input_data: Dict[str, Tensor]) -> Dict[str, Tensor]:
-        """Preprocess input data."""
+    @property
+    def database_df(self) -> pd.DataFrame:
+        """Database "track.csv" table."""
+        if self._database_df is None:
+            self._database_df = pd.read_csv(self._database_dir / "track.csv", index_col=0)
+        return self._database_df
+
+    def _collate_input(self, input_data: List[Dict[str, Tensor]]) -> Dict[str, Tensor]:
+        """Collate a list of samples into a single batch in the model input format."""
         out_dict: Dict[str, Tensor] = {}
-        for key in input_data:
+        for key in input_data[0]:
             if key.startswith("image_"):
-                out_dict[f"images_{key[6:]}"] = input_data[key].unsqueeze(0).to(self.device)
+                out_dict[f"images_{key[6:]}"] = torch.stack([sample[key] for sample in input_data])
             elif key.startswith("mask_"):
-                out_dict[f"masks_{key[5:]}"] = input_data[key].unsqueeze(0).to(self.device)
+                out_dict[f"masks_{key[5:]}"] = torch.stack([sample[key] for sample in input_data])
             elif key == "pointcloud_lidar_coords":
-                quantized_coords, quantized_feats = ME.utils.sparse_quantize(
-                    coordinates=input_data["pointcloud_lidar_coords"],
-                    features=input_data["pointcloud_lidar_feats"],
-                    quantization_size=self._pointcloud_quantization_size,
-                )
-                out_dict["pointclouds_lidar_coords"] = ME.utils.batched_coordinates([quantized_coords]).to(
-                    self.device
-                )
-                out_dict["pointclouds_lidar_feats"] = quantized_feats.to(self.device)
+                quantized_coords_list = []
+                quantized_feats_list = []
+                for sample in input_data:
+                    quantized_coords, quantized_feats = ME.utils.sparse_quantize(
+                        coordinates=sample["pointcloud_lidar_coords"],
+                        features=sample["pointcloud_lidar_feats"],
+                        quantization_size=self._pointcloud_quantization_size,
+                    )
+                    quantized_coords_list.append(quantized_coords)
+                    quantized_feats_list.append(quantized_feats)
+                out_dict["pointclouds_lidar_coords"] = ME.utils.batched_coordinates(quantized_coords_list)
+                out_dict["pointclouds_lidar_feats"] = torch.cat(quantized_feats_list)
             elif key == "soc":
-                out_dict["soc"] = input_data[key].unsqueeze(0).to(self.device)
-        return out_dict
+                out_dict["soc"] = torch.stack([sample["soc"] for sample in input_data])
+        return {key: value.to(self.device) for key, value in out_dict.items()}
 
-    def infer(self, input_data: Dict[str, Tensor]) -> Dict[str, np.ndarray]:
-        """Single sample inference.
+    def _preprocess_input(self, input_data: Dict[str, Tensor]) -> Dict[str, Tensor]:
+        """Preprocess input data."""
+        return self._collate_input([input_data])
+
+    def _preprocess_batch(
+        self, input_data: Union[List[Dict[str, Tensor]], Dict[str, Tensor]]
+    ) -> Dict[str, Tensor]:
+        """Preprocess a list of samples or an already collated batch."""
+        if isinstance(input_data, dict):
+            return {
+                key: value.to(self.device)
+                for key, value in input_data.items()
+                if key.startswith(("images_", "masks_", "pointclouds_lidar_")) or key == "soc"
+            }
+        if len(input_data) == 0:
+            raise ValueError("Empty input_data list given.")
+        return self._collate_input(input_data)
+
+    def _search(
+        self, descriptors: np.ndarray, k: int, rows: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Search the database for the k nearest neighbors of each descriptor.
 
         Args:
-            input_data (Dict[str, Tensor]): Input data. Dictionary with keys in the following format:
+            descriptors (np.ndarray): Query descriptors array of shape (B, D).
+            k (int): Number of nearest neighbors to retrieve.
+            rows (np.ndarray, optional): Database rows to restrict the search to.
+                If None, the whole database is searched. Defaults to None.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Distances and indices arrays of shape (B, k).
+                For L2 indexes the distances are Euclidean (faiss returns squared ones).
+                Missing results have index -1 and infinite distance.
+        """
+        descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+        with self._database_lock:
+            if rows is None:
+                distances, indices = self.database_index.search(descriptors, k)
+            else:
+                distances, indices = self._search_subset(descriptors, k, rows)
+        distances[indices < 0] = np.inf
+        if self.database_index.metric_type == faiss.METRIC_L2:
+            distances = np.sqrt(np.maximum(distances, 0.0))
+        return distances, indices
+
+    def _get_row_storage(self) -> Optional[faiss.IndexFlatCodes]:
+        """Get the storage of the database index with the (possibly compressed) vectors in the rows order.
+
+        Flat, scalar and product quantizer indexes (also wrapped into faiss.IndexIDMap) and the HNSW
+        indexes keep the vectors in the database rows order. IVF indexes do not.
+
+        Returns:
+            Optional[faiss.IndexFlatCodes]: The storage index or None for the IVF indexes.
+        """
+        index = self._get_base_index()
+        if isinstance(index, faiss.IndexHNSW):
+            index = faiss.downcast_index(index.storage)
+        return index if isinstance(index, faiss.IndexFlatCodes) else None
+
+    def _get_base_index(self) -> faiss.Index:
+        """Get the CPU database index unwrapped from faiss.IndexIDMap."""
+        index = faiss.downcast_index(self._database_index_cpu)
+        if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+            index = faiss.downcast_index(index.index)
+        return index
 
-                "image_{camera_name}" for images from cameras,
+    def _search_subset(
+        self, descriptors: np.ndarray, k: int, rows: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Search only among the given database rows."""
+        storage = self._get_row_storage()
+        if storage is None:
+            # IVF index: restrict the search with the IDSelector
+            selector = faiss.IDSelectorBatch(self.database_ids[rows])
+            index_ivf = faiss.try_extract_index_ivf(self._database_index_cpu)
+            if index_ivf is not None:
+                params = faiss.SearchParametersIVF(sel=selector, nprobe=index_ivf.nprobe)
+            else:
+                params = faiss.SearchParameters(sel=selector)
+            return self._database_index_cpu.search(descriptors, k, params=params)
+        # brute-force search over the small decoded subset, the cost does not depend on the database size;
+        # it also works for the indexes without the IDSelector support (e.g. PQ), and the decoded vectors
+        # give the same distances as the quantized index search
+        subset_index = faiss.IndexFlat(storage.d, storage.metric_type)
+        subset_index.add(storage.reconstruct_batch(rows.astype(np.int64)))
+        distances, order = subset_index.search(descriptors, k)
+        indices = np.where(order >= 0, self.database_ids[rows][np.maximum(order, 0)], -1)
+        return distances, indices
 
-                "mask_{camera_name}" for semantic segmentation masks,
+    def _get_rows_near(self, prior_pose: np.ndarray, search_radius: float) -> np.ndarray:
+        """Get the database rows with translations within the search radius of the prior pose."""
+        with self._database_lock:
+            if self._translations_tree is None:
+                self._translations_tree = cKDTree(np.asarray(self._database_poses[:, :3]))
+            rows = self._translations_tree.query_ball_point(np.asarray(prior_pose)[:3], r=search_radius)
+        return np.sort(np.asarray(rows, dtype=np.int64))
 
-                "pointcloud_lidar_coords" for pointcloud coordinates from lidar,
+    def _lookup_poses(self, indices: np.ndarray) -> np.ndarray:
+        """Get database poses for the given indices. Missing results (index -1) get NaN poses."""
+        with self._database_lock:
+            if self._database_ids is None:
+                poses = self._database_poses[indices]
+            else:
+                rows = np.searchsorted(self._database_ids, indices)
+                poses = self._database_poses[np.minimum(rows, len(self._database_ids) - 1)]
+        poses[indices < 0] = np.nan
+        return poses
 
+    @property
+    def database_ids(self) -> np.ndarray:
+        """Stable ids of the database places in the "track.csv" rows order."""
+        if self._database_ids is None:
+            return np.arange(len(self._database_poses), dtype=np.int64)
+        return self._database_ids
+
+    def _get_mutable_index(self) -> faiss.Index:
+        """Get the CPU database index that supports adding and removing vectors with stable ids.
+
+        IVF-based indexes support ids natively. Other index types are wrapped into faiss.IndexIDMap.
+
+        Returns:
+            faiss.Index: Mutable CPU database index.
+        """
+        if self._database_index_is_mutable:
+            return self._database_index_cpu
+        index = self._database_index_cpu
+        if self._mmap_database:
+            # memory-mapped data is read-only and faiss.clone_index keeps viewing it, so make a deep copy
+            index = faiss.deserialize_index(faiss.serialize_index(index))
+        is_id_map = isinstance(faiss.downcast_index(index), (faiss.IndexIDMap, faiss.IndexIDMap2))
+        if not is_id_map and faiss.try_extract_index_ivf(index) is None:
+            vectors = index.reconstruct_n(0, index.ntotal)
+            empty_index = faiss.clone_index(index)
+            empty_index.reset()
+            index = faiss.IndexIDMap(empty_index)
+            index.add_with_ids(vectors, self.database_ids)
+        self._set_database_index(index)
+        self._database_index_is_mutable = True
+        return index
+
+    def add_places(
+        self,
+        descriptors: np.ndarray,
+        poses: np.ndarray,
+        metadata: Optional[Union[pd.DataFrame, Sequence[Dict[str, Any]]]] = None,
+    ) -> np.ndarray:
+        """Add new places to the database without rebuilding it.
+
+        The changes are kept in memory, use the "save_database" method to persist them.
+        Note that the added places do not exist in the datasets the database was built from.
+
+        Args:
+            descriptors (np.ndarray): Descriptors of the new places, array of shape (M, D).
+            poses (np.ndarray): Poses of the new places in the format [tx, ty, tz, qx, qy, qz, qw],
+                array of shape (M, 7).
+            metadata (Union[pd.DataFrame, Sequence[Dict[str, Any]]], optional): Additional "track.csv"
+                columns for the new places, M rows. Defaults to None.
+
+        Returns:
+            np.ndarray: Assigned ids of the new places, array of shape (M,).
+
+        Raises:
+            ValueError: If the number of descriptors, poses and metadata rows do not match.
+        """
+        descriptors = np.ascontiguousarray(descriptors, dtype=np.float32).reshape(-1, self.database_index.d)
+        poses = np.asarray(poses, dtype=np.float64).reshape(-1, len(POSE_COLUMNS))
+        new_df = pd.DataFrame(poses, columns=POSE_COLUMNS)
+        if metadata is not None:
+            new_df = pd.concat([pd.DataFrame(metadata).reset_index(drop=True), new_df], axis=1)
+        if not len(descriptors) == len(poses) == len(new_df):
+            raise ValueError("Number of descriptors, poses and metadata rows must be equal.")
+        with self._database_lock:
+            ids = self.database_ids
+            first_id = int(ids[-1]) + 1 if len(ids) > 0 else 0
+            new_ids = np.arange(first_id, first_id + len(descriptors), dtype=np.int64)
+            index = self._get_mutable_index()
+            index.add_with_ids(descriptors, new_ids)
+            index_name = self.database_df.index.name
+            if index_name is not None and index_name in new_df.columns:
+                new_df = new_df.set_index(index_name)
+            else:
+                # the "track.csv" rows are labeled by the places ids
+                new_df.index = pd.Index(new_ids, name=index_name)
+            self._database_df = pd.concat([self.database_df, new_df])
+            self._database_poses = np.concatenate([self._database_poses, poses], axis=0)
+            self._database_ids = np.concatenate([ids, new_ids])
+            self._translations_tree = None
+            self._set_database_index(index)
+            if self.query_cache is not None:
+                self.query_cache.clear()
+        return new_ids
+
+    def remove_places(self, ids: Union[Sequence[int], np.ndarray]) -> int:
+        """Remove places from the database without rebuilding it. Ids of the other places do not change.
+
+        The changes are kept in memory, use the "save_database" method to persist them.
+        Removal is not supported for HNSW indexes.
+
+        Args:
+            ids (Union[Sequence[int], np.ndarray]): Ids of the places to remove.
+
+        Returns:
+            int: Number of removed places.
+
+        Raises:
+            ValueError: If the database index is an HNSW index.
+        """
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        with self._database_lock:
+            if isinstance(self._get_base_index(), faiss.IndexHNSW):
+                raise ValueError("Removing places is not supported for HNSW indexes, rebuild the database instead.")
+            all_ids = self.database_ids
+            keep_mask = ~np.isin(all_ids, ids)
+            index = self._get_mutable_index()
+            index.remove_ids(ids)
+            self._database_df = self.database_df.iloc[keep_mask]
+            self._database_poses = self._database_poses[keep_mask]
+            self._database_ids = all_ids[keep_mask]
+            self._translations_tree = None
+            self._set_database_index(index)
+            if self.query_cache is not None:
+                self.query_cache.clear()
+        return int((~keep_mask).sum())
+
+    def save_database(self, database_dir: Optional[Union[str, PathLike]] = None) -> None:
+        """Persist the database to disk.
+
+        Every file is written to a temporary file first and then atomically renamed, so concurrent
+        readers never see partially written files.
+
+        Args:
+            database_dir (Union[str, PathLike], optional): Output database directory.
+                If None, the database is saved in place. Defaults to None.
+        """
+        database_dir = self._database_dir if database_dir is None else Path(database_dir)
+        database_dir.mkdir(parents=True, exist_ok=True)
+        with self._database_lock:
+            atomic_write(database_dir / "track.csv", self.database_df.to_csv)
+            save_npy_atomic(database_dir / POSES_FILENAME, np.asarray(self._database_poses))
+            save_npy_atomic(database_dir / IDS_FILENAME, self.database_ids)
+            atomic_write(
+                database_dir / "index.faiss", lambda path: faiss.write_index(self._database_index_cpu, path)
+            )
+
+    def _get_search_rows(
+        self, prior_pose: Optional[np.ndarray], search_radius: Optional[float]
+    ) -> Optional[np.ndarray]:
+        """Get the database rows to search given the pose prior. None means the whole database."""
+        if prior_pose is None:
+            return None
+        if search_radius is None:
+            raise ValueError("search_radius must be specified if prior_pose is given.")
+        rows = self._get_rows_near(prior_pose, search_radius)
+        return rows if len(rows) > 0 else None
+
+    def infer(
+        self,
+        input_data: Dict[str, Tensor],
+        k: int = 1,
+        prior_pose: Optional[np.ndarray] = None,
+        search_radius: Optional[float] = None,
+    ) -> Dict[str, np.ndarray]:
+        """Single sample inference.
+
+        If the query cache is enabled and the descriptor is within the cache tolerance of a recent query
+        with the same search parameters, the cached candidates and distances are returned without
+        searching the index.
+
+        Args:
+            input_data (Dict[str, Tensor]): Input data. Dictionary with keys in the following format:
+                "image_{camera_name}" for images from cameras, "mask_{camera_name}" for semantic
+                segmentation masks, "pointcloud_lidar_coords" for pointcloud coordinates from lidar,
                 "pointcloud_lidar_feats" for pointcloud features from lidar.
+            k (int): Number of top candidates to retrieve. Defaults to 1.
+            prior_pose (np.ndarray, optional): Prior pose estimate (e.g. from odometry) in the format
+                [tx, ty, tz, ...]. If given, only the database places within "search_radius" meters
+                are searched. If there are no such places, the whole database is searched. Defaults to None.
+            search_radius (float, optional): Search radius in meters around the prior pose.
+                Required if "prior_pose" is given. Defaults to None.
 
         Returns:
             Dict[str, np.ndarray]: Inference results. Dictionary with keys:
@@ -103,18 +445,104 @@ class PlaceRecognitionPipeline:
 
                 "pose" for predicted pose in the format [tx, ty, tz, qx, qy, qz, qw],
 
-                "descriptor" for predicted descriptor.
+                "descriptor" for predicted descriptor,
+
+                "topk_idxs" for indices of the top-k candidates, array of shape (k,),
+
+                "topk_distances" for L2 distances to the top-k candidates, array of shape (k,),
+
+                "topk_poses" for poses of the top-k candidates, array of shape (k, 7).
         """
-        input_data = self._preprocess_input(input_data)
+        rows = self._get_search_rows(prior_pose, search_radius)
+        descriptor, checksum = None, None
+        if self.query_cache is not None and self._query_cache_inputs:
+            checksum = input_checksum(input_data)
+            descriptor = self.query_cache.get_descriptor(checksum)
+        if descriptor is None:
+            with self.profiler.stage("place_recognition/preprocess"):
+                input_data = self._preprocess_input(input_data)
+            with self.profiler.stage("place_recognition/forward"), torch.no_grad():
+                descriptor = self.model(input_data)["final_descriptor"].cpu().numpy()
+            if checksum is not None:
+                self.query_cache.put_descriptor(checksum, descriptor)
         output = {}
-        with torch.no_grad():
-            descriptor = self.model(input_data)["final_descriptor"].cpu().numpy()
-        _, pred_i = self.database_index.search(descriptor, 1)
-        pred_i = pred_i[0][0]
-        pred_pose = self.database_df.iloc[pred_i][["tx", "ty", "tz", "qx", "qy", "qz", "qw"]].to_numpy(
-            dtype=float
-        )
-        output["idx"] = pred_i
-        output["pose"] = pred_pose
+        with self.profiler.stage("place_recognition/search"):
+            if self.query_cache is None:
+                distances, pred_i = self._search(descriptor, k, rows)
+            else:
+                search_params = (k, None if rows is None else rows.tobytes())
+                cached_result = self.query_cache.get(descriptor[0], search_params)
+                if cached_result is None:
+                    distances, pred_i = self._search(descriptor, k, rows)
+                    self.query_cache.put(
+                        descriptor[0], search_params, {"distances": distances, "idxs": pred_i}
+                    )
+                else:
+                    distances, pred_i = cached_result["distances"].copy(), cached_result["idxs"].copy()
+        pred_poses = self._lookup_poses(pred_i[0])
+        output["idx"] = pred_i[0, 0]
+        output["pose"] = pred_poses[0]
         output["descriptor"] = descriptor[0]
+        output["topk_idxs"] = pred_i[0]
+        output["topk_distances"] = distances[0]
+        output["topk_poses"] = pred_poses
+        return output
+
+    def infer_batch(
+        self,
+        input_data: Union[List[Dict[str, Tensor]], Dict[str, Tensor]],
+        k: int = 1,
+        prior_poses: Optional[np.ndarray] = None,
+        search_radius: Optional[float] = None,
+    ) -> Dict[str, np.ndarray]:
+        """Batched inference for multiple queries with a single forward pass and a single index search.
+
+        Args:
+            input_data (Union[List[Dict[str, Tensor]], Dict[str, Tensor]]): Either a list of samples
+                in the format of the "infer" method input, or an already collated batch in the dataset
+                "collate_fn" output format ("images_{camera_name}", "masks_{camera_name}",
+                "pointclouds_lidar_coords", "pointclouds_lidar_feats", "soc").
+            k (int): Number of top candidates to retrieve for each query. Defaults to 1.
+            prior_poses (np.ndarray, optional): Prior pose estimates for each query, array of shape (B, 3+).
+                See the "prior_pose" argument of the "infer" method. Defaults to None.
+            search_radius (float, optional): Search radius in meters around the prior poses.
+                Required if "prior_poses" is given. Defaults to None.
+
+        Returns:
+            Dict[str, np.ndarray]: Inference results. Dictionary with keys:
+
+                "idx" for predicted indices in the database, array of shape (B,),
+
+                "pose" for predicted poses in the format [tx, ty, tz, qx, qy, qz, qw], array of shape (B, 7),
+
+                "descriptor" for predicted descriptors, array of shape (B, D),
+
+                "topk_idxs" for indices of the top-k candidates, array of shape (B, k),
+
+                "topk_distances" for L2 distances to the top-k candidates, array of shape (B, k),
+
+                "topk_poses" for poses of the top-k candidates, array of shape (B, k, 7).
+        """
+        with self.profiler.stage("place_recognition/preprocess"):
+            input_data = self._preprocess_batch(input_data)
+        output = {}
+        with self.profiler.stage("place_recognition/forward"), torch.no_grad():
+            descriptors = self.model(input_data)["final_descriptor"].cpu().numpy()
+        with self.profiler.stage("place_recognition/search"):
+            if prior_poses is None:
+                distances, pred_i = self._search(descriptors, k)
+            else:
+                results = [
+                    self._search(descriptor[None], k, self._get_search_rows(prior_pose, search_radius))
+                    for descriptor, prior_pose in zip(descriptors, prior_poses)
+                ]
+                distances = np.concatenate([result[0] for result in results], axis=0)
+                pred_i = np.concatenate([result[1] for result in results], axis=0)
+        pred_poses = self._lookup_poses(pred_i)
+        output["idx"] = pred_i[:, 0]
+        output["pose"] = pred_poses[:, 0]
+        output["descriptor"] = descriptors
+        output["topk_idxs"] = pred_i
+        output["topk_distances"] = distances
+        output["topk_poses"] = pred_poses
         return output
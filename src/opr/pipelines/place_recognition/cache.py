@@ -0,0 +1,152 @@
+"""Query results cache for Place Recognition pipelines."""
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+import numpy as np
+from torch import Tensor
+
+
+def input_checksum(input_data: Dict[str, Tensor]) -> str:
+    """Compute the checksum of the input data tensors.
+
+    Args:
+        input_data (Dict[str, Tensor]): Input data dictionary.
+
+    Returns:
+        str: Hex digest of the keys and the contents of the tensors.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    for key in sorted(input_data):
+        value = input_data[key]
+        hasher.update(key.encode())
+        if isinstance(value, Tensor):
+            hasher.update(str(value.dtype).encode())
+            hasher.update(str(tuple(value.shape)).encode())
+            value = value.detach().cpu().numpy()
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    return hasher.hexdigest()
+
+
+class QueryCache:
+    """Bounded LRU cache of the query results keyed on descriptor similarity."""
+
+    def __init__(self, max_size: int = 32, tolerance: float = 1e-3) -> None:
+        """Bounded LRU cache of the query results keyed on descriptor similarity.
+
+        A cached result is reused for a new query descriptor if the L2 distance between the descriptors
+        is within the tolerance and the search parameters are equal. The input checksums of the cached
+        queries are stored as well to skip the model forward pass for identical inputs.
+
+        Args:
+            max_size (int): Maximum number of cached queries. Defaults to 32.
+            tolerance (float): Maximum L2 distance between the descriptors to reuse a result. Defaults to 1e-3.
+
+        Raises:
+            ValueError: If max_size is not positive or tolerance is negative.
+        """
+        if max_size < 1:
+            raise ValueError(f"max_size must be positive, but {max_size!r} given.")
+        if tolerance < 0:
+            raise ValueError(f"tolerance must be non-negative, but {tolerance!r} given.")
+        self.max_size = max_size
+        self.tolerance = tolerance
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._checksums: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.input_hits = 0
+        self.input_misses = 0
+
+    def __len__(self) -> int:  # noqa: D105
+        return len(self._entries)
+
+    def get_descriptor(self, checksum: str) -> Optional[np.ndarray]:
+        """Get the cached descriptor of the input with the given checksum.
+
+        Args:
+            checksum (str): Input checksum, see the "input_checksum" function.
+
+        Returns:
+            Optional[np.ndarray]: Cached descriptor or None if the input was not seen.
+        """
+        with self._lock:
+            descriptor = self._checksums.get(checksum)
+            if descriptor is None:
+                self.input_misses += 1
+                return None
+            self._checksums.move_to_end(checksum)
+            self.input_hits += 1
+            return descriptor
+
+    def put_descriptor(self, checksum: str, descriptor: np.ndarray) -> None:
+        """Cache the descriptor of the input with the given checksum.
+
+        Args:
+            checksum (str): Input checksum, see the "input_checksum" function.
+            descriptor (np.ndarray): Descriptor of the input.
+        """
+        with self._lock:
+            self._checksums[checksum] = descriptor
+            self._checksums.move_to_end(checksum)
+            while len(self._checksums) > self.max_size:
+                self._checksums.popitem(last=False)
+
+    def get(self, descriptor: np.ndarray, params: Hashable) -> Optional[Dict[str, Any]]:
+        """Get the cached result of the closest query within the tolerance.
+
+        Args:
+            descriptor (np.ndarray): Query descriptor.
+            params (Hashable): Search parameters the cached query must have been made with.
+
+        Returns:
+            Optional[Dict[str, Any]]: Cached result or None on cache miss.
+        """
+        with self._lock:
+            candidates = [key for key, entry in self._entries.items() if entry["params"] == params]
+            if len(candidates) > 0:
+                cached_descriptors = np.stack([self._entries[key]["descriptor"] for key in candidates])
+                distances = np.linalg.norm(cached_descriptors - descriptor[None], axis=1)
+                best = int(np.argmin(distances))
+                if distances[best] <= self.tolerance:
+                    self._entries.move_to_end(candidates[best])
+                    self.hits += 1
+                    return self._entries[candidates[best]]["result"]
+            self.misses += 1
+            return None
+
+    def put(self, descriptor: np.ndarray, params: Hashable, result: Dict[str, Any]) -> None:
+        """Cache the query result.
+
+        Args:
+            descriptor (np.ndarray): Query descriptor.
+            params (Hashable): Search parameters of the query.
+            result (Dict[str, Any]): Query result.
+        """
+        with self._lock:
+            self._entries[self._next_key] = {"descriptor": descriptor, "params": params, "result": result}
+            self._next_key += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove all cached results, e.g. after the database was modified.
+
+        The cached input descriptors do not depend on the database and are kept, as well as the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Cache hits and misses counters."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "input_hits": self.input_hits,
+                "input_misses": self.input_misses,
+            }
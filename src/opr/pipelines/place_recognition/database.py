@@ -0,0 +1,424 @@
+"""Tools for building Place Recognition databases."""
+import logging
+import os
+import tempfile
+import time
+from os import PathLike
+from pathlib import Path
+from typing import Callable, Dict, Literal, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+
+from opr.utils import parse_device
+
+try:
+    import faiss
+except ImportError as import_error:
+    raise ImportError(
+        "The 'faiss' package is not installed. Please install it manually. "
+        "Details: https://github.com/facebookresearch/faiss",
+    ) from import_error
+
+logger = logging.getLogger(__name__)
+
+POSE_COLUMNS = ["tx", "ty", "tz", "qx", "qy", "qz", "qw"]
+POSES_FILENAME = "track_poses.npy"
+IDS_FILENAME = "track_ids.npy"
+IndexType = Literal["flat", "ivf_flat", "ivf_pq", "hnsw", "opq", "sq_fp16", "sq_int8", "pq"]
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw", "opq", "sq_fp16", "sq_int8", "pq")
+QUANTIZED_INDEX_TYPES = ("sq_fp16", "sq_int8", "pq")
+
+
+def atomic_write(filepath: Union[str, PathLike], write_fn: Callable[[str], None]) -> None:
+    """Atomically write a file: write it to a temporary file in the same directory and then rename.
+
+    Readers never see a partially written file, even if the writing process crashes.
+
+    Args:
+        filepath (Union[str, PathLike]): Destination file path.
+        write_fn (Callable[[str], None]): Function that writes the file to the given path.
+
+    Raises:
+        BaseException: Any exception raised by write_fn, after the temporary file is removed.
+    """
+    filepath = Path(filepath)
+    fd, tmp_filepath = tempfile.mkstemp(dir=filepath.parent, prefix=f".{filepath.name}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        write_fn(tmp_filepath)
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        Path(tmp_filepath).unlink(missing_ok=True)
+        raise
+
+
+def save_npy_atomic(filepath: Union[str, PathLike], array: np.ndarray) -> None:
+    """Atomically save the array to the ".npy" file.
+
+    Args:
+        filepath (Union[str, PathLike]): Destination file path.
+        array (np.ndarray): Array to save.
+    """
+
+    def _save(path: str) -> None:
+        with open(path, "wb") as f:
+            np.save(f, array)
+
+    atomic_write(filepath, _save)
+
+
+def write_poses_file(database_dir: Union[str, PathLike]) -> Path:
+    """Write the poses from the database "track.csv" file into a binary "track_poses.npy" file.
+
+    Args:
+        database_dir (Union[str, PathLike]): Path to the database directory.
+
+    Returns:
+        Path: Path to the written file.
+    """
+    database_dir = Path(database_dir)
+    track_df = pd.read_csv(database_dir / "track.csv", index_col=0)
+    poses = np.ascontiguousarray(track_df[POSE_COLUMNS].to_numpy(dtype=np.float64))
+    poses_filepath = database_dir / POSES_FILENAME
+    save_npy_atomic(poses_filepath, poses)
+    return poses_filepath
+
+
+def load_poses(database_dir: Union[str, PathLike], mmap: bool = True) -> np.ndarray:
+    """Load the database poses from the "track_poses.npy" file, creating it if it is missing or outdated.
+
+    Args:
+        database_dir (Union[str, PathLike]): Path to the database directory.
+        mmap (bool): Whether to memory-map the file instead of reading it into RAM. Defaults to True.
+
+    Returns:
+        np.ndarray: Poses array of shape (N, 7) in the format [tx, ty, tz, qx, qy, qz, qw].
+    """
+    database_dir = Path(database_dir)
+    poses_filepath = database_dir / POSES_FILENAME
+    track_filepath = database_dir / "track.csv"
+    if not poses_filepath.exists() or poses_filepath.stat().st_mtime < track_filepath.stat().st_mtime:
+        write_poses_file(database_dir)
+    return np.load(poses_filepath, mmap_mode="r" if mmap else None)
+
+
+def read_index(filepath: Union[str, PathLike], mmap: bool = False) -> faiss.Index:
+    """Read the faiss index from disk.
+
+    Args:
+        filepath (Union[str, PathLike]): Path to the index file.
+        mmap (bool): Whether to memory-map the index data instead of reading it into RAM.
+            Memory-mapped indexes share the page cache between processes. Defaults to False.
+
+    Returns:
+        faiss.Index: Index.
+    """
+    if not mmap:
+        return faiss.read_index(str(filepath))
+    # IO_FLAG_MMAP_IFC (faiss>=1.10) maps both flat codes and inverted lists, IO_FLAG_MMAP - inverted lists only
+    io_flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    return faiss.read_index(str(filepath), io_flags)
+
+
+def make_index_factory_string(
+    index_type: IndexType,
+    dim: int,
+    nlist: int = 1024,
+    pq_m: int = 16,
+    pq_nbits: int = 8,
+    hnsw_m: int = 32,
+) -> str:
+    """Make a faiss index factory string for the given index type.
+
+    Args:
+        index_type (IndexType): Index type. See INDEX_TYPES.
+        dim (int): Descriptor dimension.
+        nlist (int): Number of IVF clusters. Defaults to 1024.
+        pq_m (int): Number of PQ sub-quantizers. Defaults to 16.
+        pq_nbits (int): Number of bits per PQ code. Defaults to 8.
+        hnsw_m (int): Number of HNSW graph neighbors. Defaults to 32.
+
+    Returns:
+        str: Index factory string.
+
+    Raises:
+        ValueError: If the index type is unknown or the descriptor dimension is not divisible by pq_m.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index_type: {index_type!r}. Valid types: {INDEX_TYPES!r}")
+    if index_type in ("ivf_pq", "opq", "pq") and dim % pq_m != 0:
+        raise ValueError(f"Descriptor dimension {dim} is not divisible by pq_m={pq_m}.")
+    if index_type == "flat":
+        return "Flat"
+    elif index_type == "ivf_flat":
+        return f"IVF{nlist},Flat"
+    elif index_type == "ivf_pq":
+        return f"IVF{nlist},PQ{pq_m}x{pq_nbits}"
+    elif index_type == "hnsw":
+        return f"HNSW{hnsw_m}"
+    elif index_type == "sq_fp16":
+        return "SQfp16"
+    elif index_type == "sq_int8":
+        return "SQ8"
+    elif index_type == "pq":
+        return f"PQ{pq_m}x{pq_nbits}"
+    return f"OPQ{pq_m},IVF{nlist},PQ{pq_m}x{pq_nbits}"
+
+
+def build_index(
+    descriptors: np.ndarray,
+    index_type: IndexType = "flat",
+    nlist: int = 1024,
+    pq_m: int = 16,
+    pq_nbits: int = 8,
+    hnsw_m: int = 32,
+    train_descriptors: Optional[np.ndarray] = None,
+) -> faiss.Index:
+    """Build a faiss index over the given database descriptors.
+
+    Quantized index types ("sq_fp16", "sq_int8" and "pq") store compressed descriptor codes instead
+    of float32 vectors. The int8 scalar quantizer is calibrated with per-dimension value ranges
+    and the product quantizer learns its codebooks, both from the training descriptors.
+
+    Args:
+        descriptors (np.ndarray): Database descriptors array of shape (N, D).
+        index_type (IndexType): Index type. See INDEX_TYPES.
+            Defaults to "flat".
+        nlist (int): Number of IVF clusters. It is clipped to M // 39 to have enough training points
+            per cluster. Defaults to 1024.
+        pq_m (int): Number of PQ sub-quantizers. Defaults to 16.
+        pq_nbits (int): Number of bits per PQ code. Defaults to 8.
+        hnsw_m (int): Number of HNSW graph neighbors. Defaults to 32.
+        train_descriptors (np.ndarray, optional): Calibration sample of descriptors of shape (M, D) to train
+            the index on. If None, the index is trained on all database descriptors. Defaults to None.
+
+    Returns:
+        faiss.Index: Trained index with all descriptors added.
+    """
+    descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+    n, dim = descriptors.shape
+    n_train = n if train_descriptors is None else len(train_descriptors)
+    max_nlist = max(1, n_train // 39)
+    if nlist > max_nlist and index_type in ("ivf_flat", "ivf_pq", "opq"):
+        logger.warning(f"nlist={nlist} is too large for {n_train} descriptors, using nlist={max_nlist}.")
+        nlist = max_nlist
+    factory_string = make_index_factory_string(index_type, dim, nlist, pq_m, pq_nbits, hnsw_m)
+    index = faiss.index_factory(dim, factory_string, faiss.METRIC_L2)
+    if not index.is_trained:
+        if train_descriptors is not None:
+            index.train(np.ascontiguousarray(train_descriptors, dtype=np.float32))
+        else:
+            index.train(descriptors)
+    index.add(descriptors)
+    return index
+
+
+def set_search_params(
+    index: faiss.Index, nprobe: Optional[int] = None, ef_search: Optional[int] = None
+) -> None:
+    """Set the search-time parameters of the index in-place.
+
+    Parameters that are not applicable to the given index type are ignored.
+
+    Args:
+        index (faiss.Index): Index.
+        nprobe (int, optional): Number of IVF clusters to visit. Defaults to None.
+        ef_search (int, optional): HNSW search queue size. Defaults to None.
+    """
+    params = faiss.ParameterSpace()
+    if nprobe is not None and faiss.try_extract_index_ivf(index) is not None:
+        params.set_index_parameter(index, "nprobe", nprobe)
+    if ef_search is not None and "HNSW" in type(faiss.downcast_index(index)).__name__:
+        params.set_index_parameter(index, "efSearch", ef_search)
+
+
+def evaluate_index_recall(
+    index: faiss.Index,
+    descriptors: np.ndarray,
+    queries: Optional[np.ndarray] = None,
+    k: int = 10,
+) -> Dict[str, float]:
+    """Evaluate the recall of an (approximate) index against the exact flat index.
+
+    Args:
+        index (faiss.Index): Index to evaluate.
+        descriptors (np.ndarray): Database descriptors array of shape (N, D) the index was built from.
+        queries (np.ndarray, optional): Query descriptors array of shape (Q, D).
+            If None, the database descriptors are used as queries. Defaults to None.
+        k (int): Number of neighbors for the Recall@k metric. Defaults to 10.
+
+    Returns:
+        Dict[str, float]: Report with keys "recall@1" (top-1 agreement with the exact search),
+            "recall@k" (mean fraction of the exact top-k found), "search_ms" and "exact_search_ms"
+            (mean per-query search time), "index_bytes" and "exact_index_bytes" (serialized index size).
+    """
+    descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+    queries = descriptors if queries is None else np.ascontiguousarray(queries, dtype=np.float32)
+    k = min(k, descriptors.shape[0])
+    exact_index = faiss.IndexFlatL2(descriptors.shape[1])
+    exact_index.add(descriptors)
+
+    t_start = time.perf_counter()
+    _, exact_indices = exact_index.search(queries, k)
+    exact_time = time.perf_counter() - t_start
+    t_start = time.perf_counter()
+    _, indices = index.search(queries, k)
+    search_time = time.perf_counter() - t_start
+
+    found = (indices[:, :, None] == exact_indices[:, None, :]).any(axis=1)
+    return {
+        "recall@1": float(np.mean(indices[:, 0] == exact_indices[:, 0])),
+        "recall@k": float(found.mean()),
+        "search_ms": 1000 * search_time / len(queries),
+        "exact_search_ms": 1000 * exact_time / len(queries),
+        "index_bytes": int(faiss.serialize_index(index).nbytes),
+        "exact_index_bytes": int(faiss.serialize_index(exact_index).nbytes),
+    }
+
+
+def evaluate_quantization(
+    descriptors: np.ndarray,
+    index_types: Sequence[IndexType] = QUANTIZED_INDEX_TYPES,
+    queries: Optional[np.ndarray] = None,
+    train_descriptors: Optional[np.ndarray] = None,
+    pq_m: int = 16,
+    pq_nbits: int = 8,
+    k: int = 10,
+) -> Dict[str, Dict[str, float]]:
+    """Compare the accuracy and memory of quantized descriptor storage against the float32 baseline.
+
+    Args:
+        descriptors (np.ndarray): Database descriptors array of shape (N, D).
+        index_types (Sequence[IndexType]): Index types to compare. Defaults to QUANTIZED_INDEX_TYPES.
+        queries (np.ndarray, optional): Query descriptors array of shape (Q, D).
+            If None, the database descriptors are used as queries. Defaults to None.
+        train_descriptors (np.ndarray, optional): Calibration sample of descriptors of shape (M, D).
+            If None, all database descriptors are used. Defaults to None.
+        pq_m (int): Number of PQ sub-quantizers. Defaults to 16.
+        pq_nbits (int): Number of bits per PQ code. Defaults to 8.
+        k (int): Number of neighbors for the Recall@k metric. Defaults to 10.
+
+    Returns:
+        Dict[str, Dict[str, float]]: Report for each index type. Besides the "evaluate_index_recall" keys
+            it has "compression" (float32 index size to the index size ratio) and "reconstruction_mse"
+            (mean squared error of the decoded descriptors).
+    """
+    descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+    reports = {}
+    for index_type in index_types:
+        index = build_index(
+            descriptors, index_type, pq_m=pq_m, pq_nbits=pq_nbits, train_descriptors=train_descriptors
+        )
+        report = evaluate_index_recall(index, descriptors, queries=queries, k=k)
+        report["compression"] = report["exact_index_bytes"] / report["index_bytes"]
+        decoded = index.reconstruct_n(0, index.ntotal)
+        report["reconstruction_mse"] = float(np.mean((decoded - descriptors) ** 2))
+        reports[index_type] = report
+    return reports
+
+
+def compute_descriptors(
+    model: nn.Module, dataloader: DataLoader, device: Union[str, int, torch.device] = "cuda"
+) -> np.ndarray:
+    """Compute the model descriptors for all samples in the dataloader.
+
+    Args:
+        model (nn.Module): Model in eval mode.
+        dataloader (DataLoader): Dataloader that yields batches in the dataset "collate_fn" format.
+        device (Union[str, int, torch.device]): Device to use. Defaults to "cuda".
+
+    Returns:
+        np.ndarray: Descriptors array of shape (N, D).
+    """
+    device = parse_device(device)
+    descriptors_list = []
+    with torch.no_grad():
+        for batch in tqdm(dataloader, desc="Calculating database descriptors", leave=False):
+            batch = {key: value.to(device) for key, value in batch.items()}
+            descriptors_list.append(model(batch)["final_descriptor"].cpu().numpy())
+    return np.concatenate(descriptors_list, axis=0)
+
+
+def build_database(
+    model: nn.Module,
+    dataset: Dataset,
+    database_dir: Union[str, PathLike],
+    index_type: IndexType = "flat",
+    batch_size: int = 64,
+    num_workers: int = 0,
+    device: Union[str, int, torch.device] = "cuda",
+    nlist: int = 1024,
+    pq_m: int = 16,
+    pq_nbits: int = 8,
+    hnsw_m: int = 32,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    recall_k: int = 10,
+    train_size: Optional[int] = None,
+) -> Dict[str, float]:
+    """Build a Place Recognition database: "track.csv", "track_poses.npy" and "index.faiss" files.
+
+    Args:
+        model (nn.Module): Model in eval mode located on the given device.
+        dataset (Dataset): Database dataset, e.g. ITLPCampus or NCLTDataset. It must have the
+            "dataset_df" attribute and the "collate_fn" method.
+        database_dir (Union[str, PathLike]): Output database directory.
+        index_type (IndexType): Index type. See INDEX_TYPES.
+            Defaults to "flat".
+        batch_size (int): Batch size for descriptors computation. Defaults to 64.
+        num_workers (int): Number of dataloader workers. Defaults to 0.
+        device (Union[str, int, torch.device]): Device to use. Defaults to "cuda".
+        nlist (int): Number of IVF clusters. Defaults to 1024.
+        pq_m (int): Number of PQ sub-quantizers. Defaults to 16.
+        pq_nbits (int): Number of bits per PQ code. Defaults to 8.
+        hnsw_m (int): Number of HNSW graph neighbors. Defaults to 32.
+        nprobe (int, optional): Number of IVF clusters to visit at search time. Defaults to None.
+        ef_search (int, optional): HNSW search queue size. Defaults to None.
+        recall_k (int): Number of neighbors for the recall report. Defaults to 10.
+        train_size (int, optional): Size of the random descriptors sample to train (calibrate) the index on.
+            If None, all descriptors are used. Defaults to None.
+
+    Returns:
+        Dict[str, float]: Recall report against the exact flat index. See "evaluate_index_recall".
+
+    Raises:
+        ValueError: If the dataset has neither 6D poses nor UTM coordinates.
+    """
+    database_dir = Path(database_dir)
+    database_dir.mkdir(parents=True, exist_ok=True)
+
+    dataloader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+        collate_fn=dataset.collate_fn,
+    )
+    descriptors = compute_descriptors(model, dataloader, device)
+
+    track_df = dataset.dataset_df.copy()
+    if not set(POSE_COLUMNS).issubset(track_df.columns):
+        if not {"northing", "easting"}.issubset(track_df.columns):
+            raise ValueError(f"Dataset has neither {POSE_COLUMNS!r} nor UTM columns.")
+        logger.warning("Dataset has no 6D poses, using UTM coordinates with identity rotation instead.")
+        track_df["tx"], track_df["ty"], track_df["tz"] = track_df["northing"], track_df["easting"], 0.0
+        track_df["qx"], track_df["qy"], track_df["qz"], track_df["qw"] = 0.0, 0.0, 0.0, 1.0
+    track_df.to_csv(database_dir / "track.csv")
+    write_poses_file(database_dir)
+
+    train_descriptors = None
+    if train_size is not None and train_size < len(descriptors):
+        sample_idxs = np.random.default_rng(0).choice(len(descriptors), size=train_size, replace=False)
+        train_descriptors = descriptors[np.sort(sample_idxs)]
+    index = build_index(descriptors, index_type, nlist, pq_m, pq_nbits, hnsw_m, train_descriptors)
+    set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+    faiss.write_index(index, str(database_dir / "index.faiss"))
+
+    report = evaluate_index_recall(index, descriptors, k=recall_k)
+    logger.info(f"Built {index_type!r} database with {index.ntotal} places: {report}")
+    return report
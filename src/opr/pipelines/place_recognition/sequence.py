@@ -0,0 +1,292 @@
+"""Sequence-based Place Recognition pipelines."""
+from os import PathLike
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+from torch import Tensor, nn
+
+from opr.pipelines.place_recognition.base import PlaceRecognitionPipeline
+from opr.profiling import StageProfiler
+
+try:
+    import faiss
+except ImportError as import_error:
+    raise ImportError(
+        "The 'faiss' package is not installed. Please install it manually. "
+        "Details: https://github.com/facebookresearch/faiss",
+    ) from import_error
+
+
+class SequencePlaceRecognitionPipeline(PlaceRecognitionPipeline):
+    """Place Recognition pipeline that matches sequences of queries (SeqSLAM-style)."""
+
+    def __init__(
+        self,
+        database_dir: Union[str, PathLike],
+        model: nn.Module,
+        model_weights_path: Optional[Union[str, PathLike]] = None,
+        device: Union[str, int, torch.device] = "cpu",
+        pointcloud_quantization_size: float = 0.5,
+        sequence_length: int = 5,
+        velocities: Sequence[float] = (1.0,),
+        mmap_database: bool = False,
+        profiler: Optional[StageProfiler] = None,
+        distances_chunk_size: int = 65536,
+    ) -> None:
+        """Place Recognition pipeline that matches sequences of queries (SeqSLAM-style).
+
+        The pipeline keeps a ring buffer with the descriptors of the last "sequence_length" queries
+        and their distances to all database places. Each new query costs one model forward pass and
+        one row of the distance matrix. A database place is scored by the mean descriptor distance along
+        the distance matrix diagonal that ends at this place, i.e. assuming that the query sequence
+        traverses the database track with one of the given velocities.
+
+        Args:
+            database_dir (Union[str, PathLike]): Path to the database directory. The directory must contain
+                "track.csv" and "index.faiss" files. The database places must be ordered along the track.
+            model (nn.Module): Model. The forward method must take a dictionary and return a dictionary
+                in the predefined format. See the "infer" method for details.
+            model_weights_path (Union[str, PathLike], optional): Path to the model weights.
+                If None, the weights are not loaded. Defaults to None.
+            device (Union[str, int, torch.device]): Device to use. Defaults to "cpu".
+            pointcloud_quantization_size (float): Pointcloud quantization size. Defaults to 0.5.
+            sequence_length (int): Number of the last queries to match. Defaults to 5.
+            velocities (Sequence[float]): Database frames per query frame velocities to try.
+                Negative values match the database track traversed in the opposite direction.
+                Defaults to (1.0,).
+            mmap_database (bool): Whether to memory-map the database. Defaults to False.
+            profiler (StageProfiler, optional): Stages profiler, see PlaceRecognitionPipeline.
+                The sequence matching is recorded as the "place_recognition/search" stage. Defaults to None.
+            distances_chunk_size (int): Number of the database descriptors to read from the memory-mapped
+                index at once to compute the query distances. Bounds the extra memory per query.
+                Defaults to 65536.
+
+        Raises:
+            ValueError: If sequence_length is less than 1 or no velocities given.
+        """
+        if sequence_length < 1:
+            raise ValueError(f"sequence_length must be positive, but {sequence_length!r} given.")
+        if len(velocities) == 0:
+            raise ValueError("At least one velocity must be given.")
+        super().__init__(
+            database_dir=database_dir,
+            model=model,
+            model_weights_path=model_weights_path,
+            device=device,
+            pointcloud_quantization_size=pointcloud_quantization_size,
+            mmap_database=mmap_database,
+            profiler=profiler,
+        )
+        self.sequence_length = sequence_length
+        self.distances_chunk_size = distances_chunk_size
+        self.velocities = tuple(velocities)
+        self._ivf_direct_map_type: Optional[int] = None
+        self._init_sequence_state()
+
+    def _reconstruct_rows(self, start: int, end: int) -> np.ndarray:
+        """Read the database descriptors of the given rows range from the index storage."""
+        storage = self._get_row_storage()
+        if storage is not None:
+            return storage.reconstruct_n(start, end - start)
+        return self._database_index_cpu.reconstruct_batch(self.database_ids[start:end])
+
+    def _compute_database_distances(self, descriptor: np.ndarray) -> np.ndarray:
+        """Compute the L2 distances from the descriptor to all database places.
+
+        The descriptors of a database in RAM are decoded once. The descriptors of a memory-mapped database
+        are read from the index storage in chunks of "distances_chunk_size" rows on every call instead of
+        being copied into RAM, so it stays memory-mapped.
+
+        Args:
+            descriptor (np.ndarray): Query descriptor of shape (D,).
+
+        Returns:
+            np.ndarray: Distances to the database places in the rows order, array of shape (N,).
+        """
+        with self._database_lock:
+            if self._database_vectors is not None:
+                distances = faiss.pairwise_distances(descriptor[None], self._database_vectors)[0]
+            else:
+                num_places = len(self.database_ids)
+                distances = np.empty(num_places, dtype=np.float32)
+                for start in range(0, num_places, self.distances_chunk_size):
+                    end = min(start + self.distances_chunk_size, num_places)
+                    vectors = self._reconstruct_rows(start, end)
+                    distances[start:end] = faiss.pairwise_distances(descriptor[None], vectors)[0]
+        return np.sqrt(np.maximum(distances, 0.0))
+
+    def _enable_ivf_reconstruction(self) -> None:
+        """Switch the IVF database index to the hashtable direct map to read the descriptors by ids.
+
+        Unlike the array one, the hashtable direct map supports adding and removing places with ids.
+        The previous direct map type is restored with the "_restore_ivf_direct_map" method.
+        """
+        if self._ivf_direct_map_type is not None or self._get_row_storage() is not None:
+            return
+        index_ivf = faiss.try_extract_index_ivf(self._database_index_cpu)
+        if index_ivf is not None:
+            self._ivf_direct_map_type = index_ivf.direct_map.type
+            index_ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+
+    def _restore_ivf_direct_map(self) -> None:
+        """Restore the IVF database index direct map type changed by "_enable_ivf_reconstruction"."""
+        if self._ivf_direct_map_type is not None:
+            index_ivf = faiss.try_extract_index_ivf(self._database_index_cpu)
+            index_ivf.set_direct_map_type(self._ivf_direct_map_type)
+            self._ivf_direct_map_type = None
+
+    def _init_sequence_state(self) -> None:
+        """Prepare the database descriptors for the distances computation and empty the query buffer."""
+        with self._database_lock:
+            self._enable_ivf_reconstruction()
+            if self._mmap_database:
+                # read by chunks on every query, see the "_compute_database_distances" method
+                self._database_vectors = None
+            else:
+                self._database_vectors = self._reconstruct_rows(0, len(self.database_ids))
+                self._restore_ivf_direct_map()
+        num_places = len(self.database_ids)
+        self._distances_buffer = np.zeros((self.sequence_length, num_places), dtype=np.float32)
+        self._descriptors_buffer = np.zeros((self.sequence_length, self.database_index.d), dtype=np.float32)
+        self._buffer_head = -1
+        self._buffer_size = 0
+
+    def reset(self) -> None:
+        """Forget the previous queries, e.g. when a new sequence starts."""
+        self._buffer_head = -1
+        self._buffer_size = 0
+
+    def add_places(self, *args: Any, **kwargs: Any) -> np.ndarray:  # noqa: D102
+        new_ids = super().add_places(*args, **kwargs)
+        self._init_sequence_state()
+        return new_ids
+
+    def remove_places(self, *args: Any, **kwargs: Any) -> int:  # noqa: D102
+        num_removed = super().remove_places(*args, **kwargs)
+        self._init_sequence_state()
+        return num_removed
+
+    def save_database(self, database_dir: Optional[Union[str, PathLike]] = None) -> None:
+        """Persist the database to disk, see PlaceRecognitionPipeline.
+
+        The IVF index is saved with its original direct map type.
+
+        Args:
+            database_dir (Union[str, PathLike], optional): Output database directory.
+                If None, the database is saved in place. Defaults to None.
+        """
+        with self._database_lock:
+            direct_map_changed = self._ivf_direct_map_type is not None
+            self._restore_ivf_direct_map()
+            try:
+                super().save_database(database_dir)
+            finally:
+                if direct_map_changed:
+                    self._enable_ivf_reconstruction()
+
+    def _push_descriptor(self, descriptor: np.ndarray) -> None:
+        """Add the query descriptor and its distances to all database places to the ring buffer."""
+        self._buffer_head = (self._buffer_head + 1) % self.sequence_length
+        self._buffer_size = min(self._buffer_size + 1, self.sequence_length)
+        self._descriptors_buffer[self._buffer_head] = descriptor
+        self._distances_buffer[self._buffer_head] = self._compute_database_distances(descriptor)
+
+    def _get_buffer(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the buffered descriptors and distances ordered from the oldest to the newest query."""
+        order = (self._buffer_head - np.arange(self._buffer_size)[::-1]) % self.sequence_length
+        return self._descriptors_buffer[order], self._distances_buffer[order]
+
+    def _score_sequences(self, distances: np.ndarray) -> np.ndarray:
+        """Score the database places as the ends of the sequences matched to the queries.
+
+        Args:
+            distances (np.ndarray): Distances from the queries (oldest to newest) to the database places,
+                array of shape (n, N).
+
+        Returns:
+            np.ndarray: Mean distance along the best diagonal ending at each database place, shape (N,).
+        """
+        num_queries, num_places = distances.shape
+        query_steps = np.arange(num_queries) - (num_queries - 1)  # newest query is at step 0
+        best_scores = np.full(num_places, np.inf, dtype=np.float32)
+        for velocity in self.velocities:
+            offsets = np.round(velocity * query_steps).astype(np.int64)
+            columns = np.arange(num_places)[None, :] + offsets[:, None]  # (n, N)
+            valid = (columns >= 0) & (columns < num_places)
+            values = np.take_along_axis(distances, np.clip(columns, 0, num_places - 1), axis=1)
+            values = np.where(valid, values, 0.0)
+            scores = values.sum(axis=0) / valid.sum(axis=0)  # the newest query is always valid
+            best_scores = np.minimum(best_scores, scores)
+        return best_scores
+
+    def infer(
+        self,
+        input_data: Dict[str, Tensor],
+        k: int = 1,
+        prior_pose: Optional[np.ndarray] = None,
+        search_radius: Optional[float] = None,
+    ) -> Dict[str, np.ndarray]:
+        """Add the query to the sequence and match the sequence against the database.
+
+        Args:
+            input_data (Dict[str, Tensor]): Input data of the newest query. See the "infer" method of
+                the PlaceRecognitionPipeline for details.
+            k (int): Number of top candidates to retrieve. Defaults to 1.
+            prior_pose (np.ndarray, optional): Prior pose estimate of the newest query in the format
+                [tx, ty, tz, ...]. If given, only the sequences ending at the database places within
+                "search_radius" meters are scored. If there are no such places, all places are scored.
+                Defaults to None.
+            search_radius (float, optional): Search radius in meters around the prior pose.
+                Required if "prior_pose" is given. Defaults to None.
+
+        Returns:
+            Dict[str, np.ndarray]: Inference results. Dictionary with keys:
+
+                "idx" for predicted index of the database place matching the newest query,
+
+                "pose" for predicted pose in the format [tx, ty, tz, qx, qy, qz, qw],
+
+                "descriptor" for the newest query descriptor,
+
+                "topk_idxs" for indices of the top-k candidates, array of shape (k,). Missing results
+                have index -1 and infinite distance,
+
+                "topk_distances" for mean L2 distances along the matched sequences, array of shape (k,),
+
+                "topk_poses" for poses of the top-k candidates, array of shape (k, 7),
+
+                "sequence_descriptor" for the mean-pooled descriptor of the buffered queries,
+
+                "sequence_length" for the number of queries used for matching.
+        """
+        rows = self._get_search_rows(prior_pose, search_radius)
+        with self.profiler.stage("place_recognition/preprocess"):
+            input_data = self._preprocess_input(input_data)
+        with self.profiler.stage("place_recognition/forward"), torch.no_grad():
+            descriptor = self.model(input_data)["final_descriptor"].cpu().numpy()[0]
+        with self.profiler.stage("place_recognition/search"):
+            self._push_descriptor(descriptor)
+            descriptors, distances = self._get_buffer()
+            scores = self._score_sequences(distances)
+            if rows is not None:
+                restricted_scores = np.full_like(scores, np.inf)
+                restricted_scores[rows] = scores[rows]
+                scores = restricted_scores
+
+        k = min(k, len(scores))
+        topk_rows = np.argpartition(scores, k - 1)[:k]
+        topk_rows = topk_rows[np.argsort(scores[topk_rows])]
+        topk_idxs = np.where(np.isfinite(scores[topk_rows]), self.database_ids[topk_rows], -1)
+        topk_poses = self._lookup_poses(topk_idxs)
+
+        output = {}
+        output["idx"] = topk_idxs[0]
+        output["pose"] = topk_poses[0]
+        output["descriptor"] = descriptor
+        output["topk_idxs"] = topk_idxs
+        output["topk_distances"] = scores[topk_rows]
+        output["topk_poses"] = topk_poses
+        output["sequence_descriptor"] = descriptors.mean(axis=0)
+        output["sequence_length"] = np.array(self._buffer_size)
+        return output
@@ -0,0 +1,428 @@
+"""Place Recognition pipeline over a sharded multi-map database."""
+import logging
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os import PathLike
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import torch
+from torch import Tensor, nn
+
+from opr.pipelines.place_recognition.base import PlaceRecognitionPipeline
+from opr.profiling import StageProfiler
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedPlaceRecognitionPipeline(PlaceRecognitionPipeline):
+    """Place Recognition pipeline that searches several database shards, e.g. per-floor or per-building maps."""
+
+    def __init__(
+        self,
+        database_dir: Union[str, PathLike],
+        model: nn.Module,
+        model_weights_path: Optional[Union[str, PathLike]] = None,
+        device: Union[str, int, torch.device] = "cpu",
+        pointcloud_quantization_size: float = 0.5,
+        index_nprobe: Optional[int] = None,
+        index_ef_search: Optional[int] = None,
+        mmap_database: bool = False,
+        memory_budget: Optional[int] = None,
+        num_threads: Optional[int] = None,
+        profiler: Optional[StageProfiler] = None,
+    ) -> None:
+        """Place Recognition pipeline that searches several database shards, e.g. per-floor or per-building maps.
+
+        Every subdirectory of the database directory (at any depth) that contains "track.csv" and
+        "index.faiss" files is a shard, named by its relative path, e.g. "00_2023-10-25-night/floor_1".
+        Shards are loaded lazily when they are searched for the first time. A query descriptor is
+        computed once and searched in all shards in parallel (faiss releases the GIL), then the top-k
+        results of the shards are merged.
+
+        Args:
+            database_dir (Union[str, PathLike]): Path to the directory with database shards.
+            model (nn.Module): Model. The forward method must take a dictionary and return a dictionary
+                in the predefined format. See the "infer" method for details.
+            model_weights_path (Union[str, PathLike], optional): Path to the model weights.
+                If None, the weights are not loaded. Defaults to None.
+            device (Union[str, int, torch.device]): Device to use. Defaults to "cpu".
+            pointcloud_quantization_size (float): Pointcloud quantization size. Defaults to 0.5.
+            index_nprobe (int, optional): Number of clusters to visit for IVF-based indexes.
+                If None, the value stored in the index files is used. Defaults to None.
+            index_ef_search (int, optional): Search queue size for HNSW indexes.
+                If None, the value stored in the index files is used. Defaults to None.
+            mmap_database (bool): Whether to memory-map the shards. See PlaceRecognitionPipeline.
+                Defaults to False.
+            memory_budget (int, optional): Memory budget for the loaded shards in bytes. When it is exceeded,
+                the least recently used shards are evicted and reloaded on the next hit. Shards with
+                unsaved modifications are never evicted. If None, the shards are never evicted.
+                Defaults to None.
+            num_threads (int, optional): Number of threads for the parallel shards search.
+                The threads live for the duration of a search only. If None, the ThreadPoolExecutor
+                default is used. Defaults to None.
+            profiler (StageProfiler, optional): Profiler shared with the shard pipelines. See
+                PlaceRecognitionPipeline. Defaults to None.
+        """
+        self._memory_budget = memory_budget
+        self.num_threads = num_threads
+        super().__init__(
+            database_dir=database_dir,
+            model=model,
+            model_weights_path=model_weights_path,
+            device=device,
+            pointcloud_quantization_size=pointcloud_quantization_size,
+            index_nprobe=index_nprobe,
+            index_ef_search=index_ef_search,
+            mmap_database=mmap_database,
+            profiler=profiler,
+        )
+
+    def _init_database(self, database_dir: Union[str, PathLike]) -> None:
+        """Discover the database shards without loading them."""
+        self._database_dir = Path(database_dir)
+        self._shard_dirs: Dict[str, Path] = {}
+        for index_filepath in sorted(self._database_dir.rglob("index.faiss")):
+            shard_dir = index_filepath.parent
+            if (shard_dir / "track.csv").exists():
+                self._shard_dirs[shard_dir.relative_to(self._database_dir).as_posix()] = shard_dir
+        if len(self._shard_dirs) == 0:
+            raise FileNotFoundError(f"No database shards found in {self._database_dir}. Create them first.")
+        self._loaded_shards: "OrderedDict[str, PlaceRecognitionPipeline]" = OrderedDict()
+        self._shard_sizes: Dict[str, int] = {}
+        # guards the loaded shards bookkeeping only, the shards are loaded and modified under their own locks
+        self._shards_lock = threading.Lock()
+        self._shard_locks = {name: threading.RLock() for name in self._shard_dirs}
+
+    @property
+    def shard_names(self) -> List[str]:
+        """Names of all database shards."""
+        return list(self._shard_dirs)
+
+    @property
+    def loaded_shard_names(self) -> List[str]:
+        """Names of the currently loaded shards, from the least to the most recently used."""
+        with self._shards_lock:
+            return list(self._loaded_shards)
+
+    def get_shard(self, name: str) -> PlaceRecognitionPipeline:
+        """Get the shard pipeline, loading the shard if needed.
+
+        The shard pipeline shares the model with this pipeline. To modify the shard, use the "add_places"
+        and "remove_places" methods with the shard name, so the shard is not evicted meanwhile.
+
+        Args:
+            name (str): Shard name.
+
+        Returns:
+            PlaceRecognitionPipeline: Shard pipeline.
+
+        Raises:
+            KeyError: If there is no shard with the given name.
+        """
+        if name not in self._shard_dirs:
+            raise KeyError(f"Unknown shard: {name!r}. Available shards: {self.shard_names!r}")
+        shard = self._get_loaded_shard(name)
+        if shard is not None:
+            return shard
+        # load outside of the shared lock, so the searches of the other shards are not blocked
+        with self._shard_locks[name]:
+            shard = self._get_loaded_shard(name)
+            if shard is not None:
+                return shard
+            shard_dir = self._shard_dirs[name]
+            logger.debug(f"Loading database shard {name!r}")
+            shard = PlaceRecognitionPipeline(
+                database_dir=shard_dir,
+                model=self.model,
+                device=self.device,
+                pointcloud_quantization_size=self._pointcloud_quantization_size,
+                index_nprobe=self._index_nprobe,
+                index_ef_search=self._index_ef_search,
+                mmap_database=self._mmap_database,
+                profiler=self.profiler,
+            )
+            shard_size = (shard_dir / "index.faiss").stat().st_size + shard._database_poses.nbytes
+            with self._shards_lock:
+                self._loaded_shards[name] = shard
+                self._shard_sizes[name] = shard_size
+            return shard
+
+    def _get_loaded_shard(self, name: str) -> Optional[PlaceRecognitionPipeline]:
+        """Get the shard pipeline if it is loaded and mark it as the most recently used."""
+        with self._shards_lock:
+            shard = self._loaded_shards.get(name)
+            if shard is not None:
+                self._loaded_shards.move_to_end(name)
+            return shard
+
+    def _resolve_shard_name(self, shard: Optional[str]) -> str:
+        """Get the shard name to modify, the only shard may be omitted."""
+        if shard is None:
+            if len(self._shard_dirs) > 1:
+                raise ValueError(
+                    f"shard must be specified for a database with several shards: {self.shard_names!r}"
+                )
+            return self.shard_names[0]
+        if shard not in self._shard_dirs:
+            raise KeyError(f"Unknown shard: {shard!r}. Available shards: {self.shard_names!r}")
+        return shard
+
+    def add_places(  # type: ignore[override]
+        self,
+        descriptors: np.ndarray,
+        poses: np.ndarray,
+        metadata: Optional[Union[pd.DataFrame, Sequence[Dict[str, Any]]]] = None,
+        shard: Optional[str] = None,
+    ) -> np.ndarray:
+        """Add new places to a database shard without rebuilding it.
+
+        See the "add_places" method of PlaceRecognitionPipeline. The modified shard is not evicted
+        until the pipeline is deleted.
+
+        Args:
+            descriptors (np.ndarray): Descriptors of the new places, array of shape (M, D).
+            poses (np.ndarray): Poses of the new places in the format [tx, ty, tz, qx, qy, qz, qw],
+                array of shape (M, 7).
+            metadata (Union[pd.DataFrame, Sequence[Dict[str, Any]]], optional): Additional "track.csv"
+                columns for the new places, M rows. Defaults to None.
+            shard (str, optional): Shard name. May be omitted for a database with a single shard.
+                Defaults to None.
+
+        Returns:
+            np.ndarray: Assigned ids of the new places within the shard, array of shape (M,).
+        """
+        name = self._resolve_shard_name(shard)
+        with self._shard_locks[name]:
+            return self.get_shard(name).add_places(descriptors, poses, metadata)
+
+    def remove_places(  # type: ignore[override]
+        self, ids: Union[Sequence[int], np.ndarray], shard: Optional[str] = None
+    ) -> int:
+        """Remove places from a database shard without rebuilding it.
+
+        See the "remove_places" method of PlaceRecognitionPipeline.
+
+        Args:
+            ids (Union[Sequence[int], np.ndarray]): Ids of the places to remove within the shard.
+            shard (str, optional): Shard name. May be omitted for a database with a single shard.
+                Defaults to None.
+
+        Returns:
+            int: Number of removed places.
+        """
+        name = self._resolve_shard_name(shard)
+        with self._shard_locks[name]:
+            return self.get_shard(name).remove_places(ids)
+
+    def save_database(self, database_dir: Optional[Union[str, PathLike]] = None) -> None:
+        """Persist the database shards to disk.
+
+        Args:
+            database_dir (Union[str, PathLike], optional): Output database directory. The shards are saved
+                to their relative paths in it, the not loaded shards are copied as is. If None, the modified
+                shards are saved in place. Defaults to None.
+        """
+        out_dir = None if database_dir is None else Path(database_dir)
+        for name, shard_dir in self._shard_dirs.items():
+            with self._shard_locks[name]:
+                shard = self._get_loaded_shard(name)
+                if out_dir is None:
+                    if shard is not None and shard._database_index_is_mutable:
+                        shard.save_database()
+                elif shard is not None:
+                    shard.save_database(out_dir / name)
+                else:
+                    (out_dir / name).mkdir(parents=True, exist_ok=True)
+                    for path in shard_dir.iterdir():
+                        if path.is_file():
+                            shutil.copy2(path, out_dir / name / path.name)
+
+    def _evict_shards(self) -> None:
+        """Evict the least recently used unmodified shards until the loaded shards fit the memory budget."""
+        if self._memory_budget is None:
+            return
+        with self._shards_lock:
+            loaded_size = sum(self._shard_sizes[name] for name in self._loaded_shards)
+            for name in list(self._loaded_shards)[:-1]:  # keep at least the most recently used shard
+                if loaded_size <= self._memory_budget:
+                    break
+                if not self._shard_locks[name].acquire(blocking=False):
+                    continue  # the shard is being modified or saved
+                try:
+                    if self._loaded_shards[name]._database_index_is_mutable:
+                        continue  # evicting the shard would lose its unsaved modifications
+                    logger.debug(f"Evicting database shard {name!r}")
+                    del self._loaded_shards[name]
+                    loaded_size -= self._shard_sizes[name]
+                finally:
+                    self._shard_locks[name].release()
+
+    def _search_shard(
+        self,
+        name: str,
+        descriptors: np.ndarray,
+        k: int,
+        prior_poses: Optional[np.ndarray],
+        search_radius: Optional[float],
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Search one shard. Returns distances, indices and poses of shapes (B, k), (B, k) and (B, k, 7)."""
+        shard = self.get_shard(name)
+        if prior_poses is None:
+            distances, indices = shard._search(descriptors, k)
+        else:
+            distances = np.full((len(descriptors), k), np.inf, dtype=np.float32)
+            indices = np.full((len(descriptors), k), -1, dtype=np.int64)
+            for i, (descriptor, prior_pose) in enumerate(zip(descriptors, prior_poses)):
+                rows = shard._get_rows_near(prior_pose, search_radius)
+                if len(rows) > 0:
+                    shard_distances, shard_indices = shard._search(descriptor[None], k, rows)
+                    distances[i], indices[i] = shard_distances[0], shard_indices[0]
+        return distances, indices, shard._lookup_poses(indices)
+
+    def _search_shards(
+        self,
+        descriptors: np.ndarray,
+        k: int,
+        shards: Optional[Sequence[str]] = None,
+        prior_poses: Optional[np.ndarray] = None,
+        search_radius: Optional[float] = None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Search the shards in parallel and merge the results.
+
+        Args:
+            descriptors (np.ndarray): Query descriptors array of shape (B, D).
+            k (int): Number of nearest neighbors to retrieve.
+            shards (Sequence[str], optional): Names of the shards to search. If None, all shards are searched.
+                Defaults to None.
+            prior_poses (np.ndarray, optional): Prior poses of the queries, array of shape (B, 3+).
+                Defaults to None.
+            search_radius (float, optional): Search radius in meters around the prior poses. Defaults to None.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: Distances, indices, shard names and poses
+                of the merged top-k results, arrays of shapes (B, k), (B, k), (B, k) and (B, k, 7).
+
+        Raises:
+            ValueError: If prior poses are given without the search radius.
+            KeyError: If there is no shard with the given name.
+        """
+        if prior_poses is not None and search_radius is None:
+            raise ValueError("search_radius must be specified if prior_poses are given.")
+        shard_names = self.shard_names if shards is None else list(shards)
+        for name in shard_names:
+            if name not in self._shard_dirs:
+                raise KeyError(f"Unknown shard: {name!r}. Available shards: {self.shard_names!r}")
+        descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+        with ThreadPoolExecutor(max_workers=self.num_threads, thread_name_prefix="opr_shard") as executor:
+            futures = [
+                executor.submit(self._search_shard, name, descriptors, k, prior_poses, search_radius)
+                for name in shard_names
+            ]
+            results = [future.result() for future in futures]
+        self._evict_shards()
+
+        distances = np.concatenate([result[0] for result in results], axis=1)  # (B, S * k)
+        indices = np.concatenate([result[1] for result in results], axis=1)
+        poses = np.concatenate([result[2] for result in results], axis=1)
+        names = np.repeat(np.array(shard_names, dtype=object), k)[None].repeat(len(descriptors), axis=0)
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        distances = np.take_along_axis(distances, order, axis=1)
+        indices = np.take_along_axis(indices, order, axis=1)
+        names = np.take_along_axis(names, order, axis=1)
+        poses = np.take_along_axis(poses, order[:, :, None], axis=1)
+        names[indices < 0] = None
+        if prior_poses is not None:
+            # no database places near the prior pose in any shard, fall back to the global search
+            fallback = (indices < 0).all(axis=1)
+            if fallback.any():
+                fallback_results = self._search_shards(descriptors[fallback], k, shards)
+                distances[fallback], indices[fallback], names[fallback], poses[fallback] = fallback_results
+        return distances, indices, names, poses
+
+    def infer(  # type: ignore[override]
+        self,
+        input_data: Dict[str, Tensor],
+        k: int = 1,
+        prior_pose: Optional[np.ndarray] = None,
+        search_radius: Optional[float] = None,
+        shards: Optional[Sequence[str]] = None,
+    ) -> Dict[str, np.ndarray]:
+        """Single sample inference.
+
+        Args:
+            input_data (Dict[str, Tensor]): Input data. See the "infer" method of PlaceRecognitionPipeline.
+            k (int): Number of top candidates to retrieve. Defaults to 1.
+            prior_pose (np.ndarray, optional): Prior pose estimate in the format [tx, ty, tz, ...].
+                If given, only the database places within "search_radius" meters are searched in each
+                shard. If there are no such places in any shard, all places are searched. Defaults to None.
+            search_radius (float, optional): Search radius in meters around the prior pose.
+                Required if "prior_pose" is given. Defaults to None.
+            shards (Sequence[str], optional): Names of the shards to search. If None, all shards are searched.
+                Defaults to None.
+
+        Returns:
+            Dict[str, np.ndarray]: Inference results. Dictionary with the keys of the PlaceRecognitionPipeline
+                "infer" method output, where indices are the place ids within their shards, and keys:
+
+                "shard" for the shard name of the predicted place,
+
+                "topk_shards" for the shard names of the top-k candidates, array of shape (k,).
+        """
+        output = self.infer_batch(
+            [input_data],
+            k=k,
+            prior_poses=None if prior_pose is None else np.asarray(prior_pose)[None],
+            search_radius=search_radius,
+            shards=shards,
+        )
+        return {key: value[0] for key, value in output.items()}
+
+    def infer_batch(  # type: ignore[override]
+        self,
+        input_data: Union[List[Dict[str, Tensor]], Dict[str, Tensor]],
+        k: int = 1,
+        prior_poses: Optional[np.ndarray] = None,
+        search_radius: Optional[float] = None,
+        shards: Optional[Sequence[str]] = None,
+    ) -> Dict[str, np.ndarray]:
+        """Batched inference for multiple queries with a single forward pass.
+
+        Args:
+            input_data (Union[List[Dict[str, Tensor]], Dict[str, Tensor]]): List of samples or an already
+                collated batch. See the "infer_batch" method of PlaceRecognitionPipeline.
+            k (int): Number of top candidates to retrieve for each query. Defaults to 1.
+            prior_poses (np.ndarray, optional): Prior pose estimates for each query, array of shape (B, 3+).
+                See the "prior_pose" argument of the "infer" method. Defaults to None.
+            search_radius (float, optional): Search radius in meters around the prior poses.
+                Required if "prior_poses" is given. Defaults to None.
+            shards (Sequence[str], optional): Names of the shards to search. If None, all shards are searched.
+                Defaults to None.
+
+        Returns:
+            Dict[str, np.ndarray]: Inference results. Dictionary with the keys of the PlaceRecognitionPipeline
+                "infer_batch" method output, and "shard" and "topk_shards" keys with arrays of shapes (B,)
+                and (B, k). Missing candidates have None shard names.
+        """
+        with self.profiler.stage("place_recognition/preprocess"):
+            input_data = self._preprocess_batch(input_data)
+        output = {}
+        with self.profiler.stage("place_recognition/forward"), torch.no_grad():
+            descriptors = self.model(input_data)["final_descriptor"].cpu().numpy()
+        with self.profiler.stage("place_recognition/search"):
+            distances, pred_i, pred_shards, pred_poses = self._search_shards(
+                descriptors, k, shards, prior_poses, search_radius
+            )
+        output["idx"] = pred_i[:, 0]
+        output["pose"] = pred_poses[:, 0]
+        output["descriptor"] = descriptors
+        output["topk_idxs"] = pred_i
+        output["topk_distances"] = distances
+        output["topk_poses"] = pred_poses
+        output["shard"] = pred_shards[:, 0]
+        output["topk_shards"] = pred_shards
+        return output
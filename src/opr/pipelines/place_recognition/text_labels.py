@@ -1,16 +1,136 @@
 import json
-from typing import Dict, List, Tuple
+from collections import defaultdict
+from functools import partial
+from typing import Dict, List, Optional, Set, Tuple
 
 import numpy as np
 import torch
-from fuzzywuzzy import fuzz
 from torch import Tensor, nn
 
 from opr.pipelines.place_recognition.base import PlaceRecognitionPipeline
 
+try:
+    from rapidfuzz import fuzz, process
+    from rapidfuzz.utils import default_process as process_text
+except ImportError:  # slower pure Python fallback
+    from fuzzywuzzy import fuzz
+    from fuzzywuzzy.utils import full_process
+
+    process = None
+    # the same processing as in fuzzywuzzy token_set_ratio
+    process_text = partial(full_process, force_ascii=True)
+
+
+def char_ngrams(text: str, n: int = 3) -> Set[str]:
+    """Character n-grams of the words of the text, with the words padded by spaces.
+
+    Args:
+        text (str): Processed text.
+        n (int): N-gram size. Defaults to 3.
+
+    Returns:
+        Set[str]: Set of the n-grams.
+    """
+    ngrams = set()
+    for word in text.split():
+        word = f" {word} "
+        ngrams.update(word[i : i + n] for i in range(max(len(word) - n + 1, 1)))
+    return ngrams
+
+
+class TextLabelsIndex:
+    """Inverted index from the character n-grams of the database frames labels to the frames."""
+
+    def __init__(self, frames: Dict[str, List[str]], ngram_size: int = 3) -> None:
+        """Inverted index from the character n-grams of the database frames labels to the frames.
+
+        The labels of each frame are joined and processed for the fuzzy matching once here. A query is then
+        scored with "token_set_ratio" only against the frames that share at least one n-gram with it.
+
+        Args:
+            frames (Dict[str, List[str]]): Labels of the database frames by the frame IDs.
+            ngram_size (int): Character n-gram size. Defaults to 3.
+        """
+        self.frame_ids = list(frames.keys())
+        self.frame_labels = [frames[frame_id] for frame_id in self.frame_ids]
+        self.frame_texts = [process_text(" ".join(labels)) for labels in self.frame_labels]
+        self.ngram_size = ngram_size
+        postings = defaultdict(list)
+        for i, text in enumerate(self.frame_texts):
+            for ngram in char_ngrams(text, ngram_size):
+                postings[ngram].append(i)
+        self.postings = {ngram: np.array(frame_idxs) for ngram, frame_idxs in postings.items()}
+
+    def __len__(self) -> int:  # noqa: D105
+        return len(self.frame_ids)
+
+    def shortlist(self, query_text: str, max_candidates: Optional[int] = None) -> np.ndarray:
+        """Find the frames that share n-grams with the query.
+
+        Args:
+            query_text (str): Processed query text.
+            max_candidates (int, optional): Maximum number of the frames with the most shared n-grams
+                to return. If None, all frames with shared n-grams are returned. Defaults to None.
+
+        Returns:
+            np.ndarray: Indices of the candidate frames in the ascending order.
+        """
+        counts = np.zeros(len(self.frame_ids), dtype=np.int64)
+        for ngram in char_ngrams(query_text, self.ngram_size):
+            frame_idxs = self.postings.get(ngram)
+            if frame_idxs is not None:
+                counts[frame_idxs] += 1
+        candidates = np.flatnonzero(counts)
+        if max_candidates is not None and len(candidates) > max_candidates:
+            top = np.argsort(-counts[candidates], kind="stable")[:max_candidates]
+            candidates = np.sort(candidates[top])
+        return candidates
+
+    def search(
+        self, query: List[str], max_candidates: Optional[int] = None
+    ) -> Tuple[Optional[str], Optional[List[str]], int]:
+        """Find the frame with the labels most similar to the query.
+
+        Args:
+            query (List[str]): Query labels.
+            max_candidates (int, optional): Maximum number of the shortlisted frames to score,
+                see the "shortlist" method. Defaults to None.
+
+        Returns:
+            Tuple[Optional[str], Optional[List[str]], int]: The best match ID, its labels and the similarity score,
+                or (None, None, 0) if no frame is similar.
+        """
+        query_text = process_text(" ".join(query))
+        candidates = self.shortlist(query_text, max_candidates)
+        best_match, highest_similarity = None, 0
+        if process is not None:
+            result = process.extractOne(
+                query_text, {i: self.frame_texts[i] for i in candidates}, scorer=fuzz.token_set_ratio, score_cutoff=1
+            )
+            if result is not None:
+                best_match, highest_similarity = result[2], int(round(result[1]))
+        else:
+            for i in candidates:
+                similarity = fuzz.token_set_ratio(query_text, self.frame_texts[i])
+                if similarity > highest_similarity:
+                    best_match, highest_similarity = i, similarity
+        if best_match is None:
+            return None, None, 0
+        return self.frame_ids[best_match], self.frame_labels[best_match], highest_similarity
+
 
 class TextLabelsPlaceRecognitionPipeline(PlaceRecognitionPipeline):
-    def __init__(self, db_labels_path, *args, **kwargs):
+    def __init__(self, db_labels_path, *args, ngram_size: int = 3, max_candidates: Optional[int] = None, **kwargs):
+        """Place Recognition pipeline that matches the text labels on the cameras images first.
+
+        Args:
+            db_labels_path (Union[str, PathLike]): Path to the database frames text labels JSON file.
+            *args: PlaceRecognitionPipeline arguments.
+            ngram_size (int): Character n-gram size of the labels index, see TextLabelsIndex. Defaults to 3.
+            max_candidates (int, optional): Maximum number of the shortlisted frames to fuzzy match
+                the query with. If None, all frames that share n-grams with the query. Defaults to None.
+            **kwargs: PlaceRecognitionPipeline keyword arguments.
+        """
         super().__init__(*args, **kwargs)
 
         with open(db_labels_path, "rb") as f:
@@ -18,6 +138,33 @@ class TextLabelsPlaceRecognitionPipeline(PlaceRecognitionPipeline):
             db_labels = json.loads(db_labels)
 
         self.db_labels = db_labels
+        self.ngram_size = ngram_size
+        self.max_candidates = max_candidates
+        self._labels_indices: Dict[Tuple[bool, bool], TextLabelsIndex] = {}
+        self.get_labels_index(normalize_text=True, ignore_stopwords=True)  # the "infer" method options
+
+    def get_labels_index(self, normalize_text: bool = False, ignore_stopwords: bool = False) -> TextLabelsIndex:
+        """Get the index of the database labels preprocessed with the given options, built on the first call.
+
+        Args:
+            normalize_text (bool): Whether the labels are normalized. Defaults to False.
+            ignore_stopwords (bool): Whether the stopwords are removed from the labels. Defaults to False.
+
+        Returns:
+            TextLabelsIndex: Database labels index.
+        """
+        key = (normalize_text, ignore_stopwords)
+        if key not in self._labels_indices:
+            frames = {}
+            for db_key in self.db_labels.keys():
+                db_frame = self.get_labels_by_id(self.db_labels, db_key)
+                if normalize_text:
+                    db_frame = self.normalize_labels(db_frame)
+                if ignore_stopwords:
+                    db_frame = self.remove_stopwords(db_frame)
+                frames[db_key] = db_frame
+            self._labels_indices[key] = TextLabelsIndex(frames, self.ngram_size)
+        return self._labels_indices[key]
 
     @staticmethod
     def get_labels_by_id(labels: List[str], id: str) -> List[str]:
@@ -94,26 +241,9 @@ class TextLabelsPlaceRecognitionPipeline(PlaceRecognitionPipeline):
         if print_info:
             print(f"query: {query}")
 
-        best_match_id = None
-        best_match_annos = None
-        highest_similarity = 0
-
-        for db_key in self.db_labels.keys():
-            db_frame = self.get_labels_by_id(self.db_labels, db_key)
-
-            if normalize_text:
-                db_frame = self.normalize_labels(db_frame)
-            if ignore_stopwords:
-                db_frame = self.remove_stopwords(db_frame)
-
-            # Calculate the similarity between the database item and the query
-            similarity = fuzz.token_set_ratio(query, db_frame)
-
-            # Update the best match if the current comparison is better than the previous one
-            if similarity > highest_similarity:
-                highest_similarity = similarity
-                best_match_id = db_key
-                best_match_annos = db_frame
+        # Only the database frames that share n-grams with the query are scored
+        labels_index = self.get_labels_index(normalize_text=normalize_text, ignore_stopwords=ignore_stopwords)
+        best_match_id, best_match_annos, highest_similarity = labels_index.search(query, self.max_candidates)
 
         if print_info:
             print(f"best_match_annos: {best_match_annos}, highest_similarity: {highest_similarity}")
@@ -162,21 +292,20 @@ class TextLabelsPlaceRecognitionPipeline(PlaceRecognitionPipeline):
         if highest_similarity > text_similarity_thresh:
             search_df = self.database_df.reset_index() # в исходном датафрейме скипнуты индексы
             # pred_i = self.database_df[self.database_df["timestamp"] == int(best_match_id)].index[0]
-            pred_i = search_df[search_df["timestamp"] == int(best_match_id)].index[0]
+            pred_row = search_df[search_df["timestamp"] == int(best_match_id)].index[0]
+            pred_i = self.database_ids[pred_row]  # the row position to the stable place id
             if print_info:
                 print("Using text labels")
                 print(f"pred_i: {pred_i}, best_match_id: {best_match_id}")
                 print(f"best_match_annos: {best_match_annos}, highest_similarity: {highest_similarity}")
         else:
-            _, pred_i = self.database_index.search(descriptor, 1)
+            _, pred_i = self._search(descriptor, 1)
             pred_i = pred_i[0][0]
             if print_info:
                 print(f"pred_i: {pred_i}")
                 print("Using image descriptors")
 
-        pred_pose = self.database_df.iloc[pred_i][["tx", "ty", "tz", "qx", "qy", "qz", "qw"]].to_numpy(
-            dtype=float
-        )
+        pred_pose = self._lookup_poses(np.array([pred_i]))[0]
         output["idx"] = pred_i
         output["pose"] = pred_pose
         output["descriptor"] = descriptor[0]
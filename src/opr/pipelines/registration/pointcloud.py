@@ -1,13 +1,97 @@
 """Pointcloud registration pipeline."""
+import hashlib
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from os import PathLike
-from typing import List, Optional, Tuple, Union
+from typing import Any, Deque, Dict, List, Literal, NamedTuple, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import open3d as o3d
 import torch
+from scipy.spatial import cKDTree
 from torch import Tensor, nn
 
-from opr.utils import init_model, parse_device
+from opr.profiling import StageProfiler
+from opr.utils import LRUCache, init_model, parse_device
+
+
+DownsampleBackend = Literal["torch", "open3d"]
+DOWNSAMPLE_BACKENDS = ("torch", "open3d")
+FallbackStage = Literal["icp", "ransac"]
+FALLBACK_STAGES = ("icp", "ransac")
+
+_VOXEL_COORD_BITS = 21
+_VOXEL_COORD_OFFSET = 1 << (_VOXEL_COORD_BITS - 1)
+
+
+def _voxel_downsample_torch(pc: Tensor, voxel_size: float) -> Tensor:
+    """Voxel downsample the pointcloud with the centroid pooling in torch, on the pointcloud device."""
+    points = pc[:, :3].double()
+    if len(points) == 0:
+        return points.float()
+    # the same voxel grid as in Open3D: the lower bound is half a voxel below the minimum point
+    voxel_min_bound = points.min(dim=0).values - voxel_size * 0.5
+    voxel_coords = torch.floor((points - voxel_min_bound) / voxel_size).long()
+    grid_size = voxel_coords.max(dim=0).values + 1
+    voxel_keys = (voxel_coords[:, 0] * grid_size[1] + voxel_coords[:, 1]) * grid_size[2] + voxel_coords[:, 2]
+    _, inverse, counts = torch.unique(voxel_keys, return_inverse=True, return_counts=True)
+    centroids = torch.zeros((len(counts), 3), dtype=points.dtype, device=points.device)
+    centroids.index_add_(0, inverse, points)
+    return (centroids / counts[:, None]).float()
+
+
+def _voxel_keys(points: Tensor, voxel_size: float) -> Tensor:
+    """Pack the coordinates of the points voxels into int64 keys.
+
+    Unlike the downsampling one, the voxel grid is anchored at the origin, so the keys of the different
+    pointclouds in the same frame are comparable.
+
+    Args:
+        points (Tensor): Points coordinates array of shape (N, 3).
+        voxel_size (float): Voxel size. The voxel coordinates must be within +-2^20.
+
+    Returns:
+        Tensor: Voxel keys array of shape (N,).
+    """
+    coords = torch.floor(points / voxel_size).long() + _VOXEL_COORD_OFFSET
+    return (coords[:, 0] << (2 * _VOXEL_COORD_BITS)) | (coords[:, 1] << _VOXEL_COORD_BITS) | coords[:, 2]
+
+
+def _pool_voxels(keys: Tensor, points: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+    """Sum the points of each voxel key. Returns the unique keys, the points sums and the points counts."""
+    keys, inverse, counts = torch.unique(keys, return_inverse=True, return_counts=True)
+    sums = torch.zeros((len(keys), points.shape[1]), dtype=points.dtype, device=points.device)
+    return keys, sums.index_add_(0, inverse, points), counts
+
+
+def voxel_downsample_pointcloud(
+    pc: Tensor, voxel_size: float, backend: DownsampleBackend = "torch"
+) -> Tensor:
+    """Voxel downsample the pointcloud, replacing the points in each voxel with their centroid.
+
+    Args:
+        pc (Tensor): Pointcloud. Coordinates array of shape (N, 3).
+        voxel_size (float): Voxel size.
+        backend (DownsampleBackend): "torch" for the vectorized implementation that runs on the pointcloud
+            device without copies, or "open3d" for the Open3D one. Both use the same voxel grid, but
+            the order of the output points differs. Defaults to "torch".
+
+    Returns:
+        Tensor: Downsampled pointcloud. Coordinates array of shape (M, 3), where M <= N.
+            The "open3d" backend returns a CPU tensor.
+
+    Raises:
+        ValueError: If the backend is unknown.
+    """
+    if backend == "torch":
+        return _voxel_downsample_torch(pc, voxel_size)
+    if backend != "open3d":
+        raise ValueError(f"Unknown downsample backend: {backend!r}. Valid backends: {DOWNSAMPLE_BACKENDS!r}")
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(pc.cpu().numpy())
+    pcd = pcd.voxel_down_sample(voxel_size)
+    return torch.from_numpy(np.array(pcd.points).astype(np.float32)).float()
 
 
 class PointcloudRegistrationPipeline:
@@ -19,6 +103,10 @@ class PointcloudRegistrationPipeline:
         model_weights_path: Optional[Union[str, PathLike]] = None,
         device: Union[str, int, torch.device] = "cuda",
         voxel_downsample_size: Optional[float] = 0.3,
+        profiler: Optional[StageProfiler] = None,
+        downsample_backend: DownsampleBackend = "torch",
+        score_threshold: Optional[float] = None,
+        fallback_stages: Sequence[FallbackStage] = FALLBACK_STAGES,
     ) -> None:
         """Pointcloud registration pipeline.
 
@@ -28,10 +116,39 @@ class PointcloudRegistrationPipeline:
                 If None, the weights are not loaded. Defaults to None.
             device (Union[str, int, torch.device]): Device to use. Defaults to "cuda".
             voxel_downsample_size (Optional[float]): Voxel downsample size. Defaults to 0.3.
+            profiler (StageProfiler, optional): Profiler of the "registration/downsample",
+                "registration/forward" and "registration/overlap" stages. If None, a disabled profiler
+                is created. Defaults to None.
+            downsample_backend (DownsampleBackend): Voxel downsampling backend, see
+                the "voxel_downsample_pointcloud" function. The "torch" backend moves the pointcloud to
+                the pipeline device and returns it there, while "open3d", the only backend before, returns
+                a CPU tensor with another points order. Defaults to "torch".
+            score_threshold (float, optional): Minimum overlap of the registered pointclouds to accept
+                the model transform in the "infer_with_score" method. If the overlap is lower,
+                the fallback stages are tried until one clears the threshold. If None, the model
+                transform is always accepted. Defaults to None.
+            fallback_stages (Sequence[FallbackStage]): Fallback stages from the cheapest to the costliest:
+                "icp" for the point-to-plane ICP refinement of the best transform so far and "ransac" for
+                the FPFH RANSAC global registration refined with ICP. Defaults to ("icp", "ransac").
+
+        Raises:
+            ValueError: If a fallback stage is unknown.
         """
+        for stage in fallback_stages:
+            if stage not in FALLBACK_STAGES:
+                raise ValueError(f"Unknown fallback stage: {stage!r}. Valid stages: {FALLBACK_STAGES!r}")
+        self.profiler = profiler if profiler is not None else StageProfiler(enabled=False)
         self.device = parse_device(device)
         self.model = init_model(model, model_weights_path, self.device)
         self.voxel_downsample_size = voxel_downsample_size
+        self.downsample_backend = downsample_backend
+        self.score_threshold = score_threshold
+        self.fallback_stages = tuple(fallback_stages)
+        self.ransac_pipeline = RansacGlobalRegistrationPipeline(
+            voxel_downsample_size=0.5,  # handcrafted optimal value for fast inference
+            profiler=self.profiler,
+            downsample_backend=downsample_backend,
+        )
 
     def _downsample_pointcloud(self, pc: Tensor) -> Tensor:
         """Downsample the pointcloud.
@@ -41,28 +158,308 @@ class PointcloudRegistrationPipeline:
 
         Returns:
             Tensor: Downsampled pointcloud. Coordinates array of shape (M, 3), where M <= N.
+                The "torch" backend returns it on the pipeline device.
         """
-        pcd = o3d.geometry.PointCloud()
-        pcd.points = o3d.utility.Vector3dVector(pc.cpu().numpy())
-        pcd = pcd.voxel_down_sample(self.voxel_downsample_size)
-        pc = torch.from_numpy(np.array(pcd.points).astype(np.float32)).float()
-        return pc
+        with self.profiler.stage("registration/downsample"):
+            if self.downsample_backend == "torch":
+                pc = pc.to(self.device)
+            return voxel_downsample_pointcloud(pc, self.voxel_downsample_size, self.downsample_backend)
 
-    def infer(self, query_pc: Tensor, db_pc: Tensor) -> np.ndarray:
+    def calibrate(self, pointcloud_pairs: Sequence[Tuple[Tensor, Tensor]]) -> None:
+        """Calibrate the model input preprocessing once on representative pointclouds.
+
+        For the models with the "calibrate_neighbors" method (GeoTransformer), the KPConv neighbor limits
+        are then reused for every registration instead of being computed for each pair. Save the model
+        weights afterwards to reuse the calibration. Other models are left unchanged.
+
+        Args:
+            pointcloud_pairs (Sequence[Tuple[Tensor, Tensor]]): Query and database pointclouds pairs
+                in the "infer" method input format. They are downsampled with the pipeline voxel size.
+        """
+        if not hasattr(self.model, "calibrate_neighbors"):
+            return
+        self.model.calibrate_neighbors(
+            [
+                (self._downsample_pointcloud(query_pc), self._downsample_pointcloud(db_pc))
+                for query_pc, db_pc in pointcloud_pairs
+            ]
+        )
+
+    def infer(
+        self,
+        query_pc: Tensor,
+        db_pc: Tensor,
+        downsample_db_pc: bool = True,
+        downsample_query_pc: bool = True,
+    ) -> np.ndarray:
         """Infer the transformation between the query and the database pointclouds.
 
         Args:
             query_pc (Tensor): Query pointcloud. Coordinates array of shape (N, 3).
             db_pc (Tensor): Database pointcloud. Coordinates array of shape (M, 3).
+            downsample_db_pc (bool): Whether to downsample the database pointcloud. Set to False if it was
+                already downsampled with the "_downsample_pointcloud" method, e.g. cached. Defaults to True.
+            downsample_query_pc (bool): Whether to downsample the query pointcloud. Set to False if it was
+                already downsampled, e.g. to register it against several candidates. Defaults to True.
+
+        Returns:
+            np.ndarray: Transformation matrix.
+        """
+        if downsample_query_pc:
+            query_pc = self._downsample_pointcloud(query_pc)
+        if downsample_db_pc:
+            db_pc = self._downsample_pointcloud(db_pc)
+        with self.profiler.stage("registration/forward"), torch.no_grad():
+            transform = self.model(query_pc, db_pc)["estimated_transform"].cpu().numpy()
+        return transform
+
+    @property
+    def supports_batching(self) -> bool:
+        """Whether the model registers several pairs at once with the "forward_batch" method."""
+        return hasattr(self.model, "forward_batch")
+
+    def infer_batch(
+        self,
+        query_pcs: Sequence[Tensor],
+        db_pcs: Sequence[Tensor],
+        downsample_db_pc: bool = True,
+        downsample_query_pc: bool = True,
+        batch_size: int = 16,
+    ) -> np.ndarray:
+        """Infer the transformations between several query and database pointclouds pairs.
+
+        If the model supports batching (e.g. GeoTransformer), the pairs are registered in batches with
+        a single input preprocessing and backbone pass per batch. Otherwise, the pairs are registered one by one.
+
+        Args:
+            query_pcs (Sequence[Tensor]): Query pointclouds. Coordinates arrays of shape (N_i, 3).
+            db_pcs (Sequence[Tensor]): Database pointclouds. Coordinates arrays of shape (M_i, 3).
+            downsample_db_pc (bool): Whether to downsample the database pointclouds. Defaults to True.
+            downsample_query_pc (bool): Whether to downsample the query pointclouds. Defaults to True.
+            batch_size (int): Maximum number of pairs in one model call. Defaults to 16.
+
+        Returns:
+            np.ndarray: Transformation matrices, array of shape (B, 4, 4).
+
+        Raises:
+            ValueError: If the numbers of query and database pointclouds differ.
+        """
+        if len(query_pcs) != len(db_pcs):
+            raise ValueError(f"Got {len(query_pcs)} query and {len(db_pcs)} database pointclouds.")
+        if downsample_query_pc:
+            query_pcs = [self._downsample_pointcloud(pc) for pc in query_pcs]
+        if downsample_db_pc:
+            db_pcs = [self._downsample_pointcloud(pc) for pc in db_pcs]
+        transforms = [np.zeros((0, 4, 4), dtype=np.float32)]
+        with self.profiler.stage("registration/forward"), torch.no_grad():
+            for start in range(0, len(query_pcs), batch_size):
+                batch_query_pcs = query_pcs[start : start + batch_size]
+                batch_db_pcs = db_pcs[start : start + batch_size]
+                if self.supports_batching:
+                    batch_transforms = self.model.forward_batch(batch_query_pcs, batch_db_pcs)
+                    transforms.append(batch_transforms["estimated_transform"].cpu().numpy())
+                else:
+                    transforms.extend(
+                        self.model(query_pc, db_pc)["estimated_transform"].cpu().numpy()[None]
+                        for query_pc, db_pc in zip(batch_query_pcs, batch_db_pcs)
+                    )
+        return np.concatenate(transforms)
+
+    @property
+    def supports_reference_encoding(self) -> bool:
+        """Whether the model can encode the database pointcloud once for many queries."""
+        return hasattr(self.model, "encode_reference") and hasattr(self.model, "forward_with_reference")
+
+    def encode_reference(self, db_pc: Tensor, downsample_db_pc: bool = True) -> Dict[str, Tensor]:
+        """Encode the database pointcloud for the "infer_with_reference" method.
+
+        Args:
+            db_pc (Tensor): Database pointcloud. Coordinates array of shape (M, 3).
+            downsample_db_pc (bool): Whether to downsample the database pointcloud. Defaults to True.
+
+        Returns:
+            Dict[str, Tensor]: Database pointcloud encoding, see the model "encode_reference" method.
+        """
+        if downsample_db_pc:
+            db_pc = self._downsample_pointcloud(db_pc)
+        with self.profiler.stage("registration/encode_reference"), torch.no_grad():
+            return self.model.encode_reference(db_pc)
+
+    def infer_with_reference(
+        self, query_pc: Tensor, reference: Dict[str, Tensor], downsample_query_pc: bool = True
+    ) -> np.ndarray:
+        """Infer the transformation between the query and the encoded database pointclouds.
+
+        Only the query pointcloud is encoded, so the database pointcloud encoding can be cached.
+
+        Args:
+            query_pc (Tensor): Query pointcloud. Coordinates array of shape (N, 3).
+            reference (Dict[str, Tensor]): Database pointcloud encoding, the "encode_reference" method output.
+            downsample_query_pc (bool): Whether to downsample the query pointcloud. Defaults to True.
 
         Returns:
             np.ndarray: Transformation matrix.
         """
-        query_pc = self._downsample_pointcloud(query_pc)
-        db_pc = self._downsample_pointcloud(db_pc)
-        with torch.no_grad():
-            transform = self.model(query_pc, db_pc)["estimated_transform"]
-        return transform.cpu().numpy()
+        if downsample_query_pc:
+            query_pc = self._downsample_pointcloud(query_pc)
+        with self.profiler.stage("registration/forward"), torch.no_grad():
+            transform = self.model.forward_with_reference(query_pc, reference)["estimated_transform"]
+            return transform.cpu().numpy()
+
+    def compute_overlap(
+        self,
+        query_pc: Tensor,
+        db_pc: Tensor,
+        transform: np.ndarray,
+        distance_threshold: Optional[float] = None,
+    ) -> float:
+        """Compute the registration score as the overlap of the registered pointclouds.
+
+        Args:
+            query_pc (Tensor): Query pointcloud. Coordinates array of shape (N, 3).
+            db_pc (Tensor): Database pointcloud. Coordinates array of shape (M, 3).
+            transform (np.ndarray): Transformation matrix from the query to the database frame.
+            distance_threshold (float, optional): Maximum distance between the registered query point and
+                its nearest database point to count it as overlapping. If None, 1.5 voxel sizes are used.
+                Defaults to None.
+
+        Returns:
+            float: Fraction of the query points that overlap the database pointcloud after registration.
+        """
+        if distance_threshold is None:
+            distance_threshold = self._distance_threshold()
+        query_points = query_pc.cpu().numpy()
+        db_points = db_pc.cpu().numpy()
+        if len(query_points) == 0 or len(db_points) == 0:
+            return 0.0
+        with self.profiler.stage("registration/overlap"):
+            transform = np.asarray(transform)
+            registered_points = query_points @ transform[:3, :3].T + transform[:3, 3]
+            distances, _ = cKDTree(db_points).query(
+                registered_points, distance_upper_bound=distance_threshold
+            )
+        return float(np.isfinite(distances).mean())
+
+    def _distance_threshold(self) -> float:
+        return 1.5 * (self.voxel_downsample_size or 0.3)
+
+    def compute_inlier_ratio(
+        self,
+        ref_corr_points: Tensor,
+        src_corr_points: Tensor,
+        transform: np.ndarray,
+        distance_threshold: Optional[float] = None,
+    ) -> float:
+        """Compute the fraction of the model point correspondences that agree with the transform.
+
+        Args:
+            ref_corr_points (Tensor): Database (reference) points of the correspondences, shape (C, 3).
+            src_corr_points (Tensor): Query (source) points of the correspondences, shape (C, 3).
+            transform (np.ndarray): Transformation matrix from the query to the database frame.
+            distance_threshold (float, optional): Maximum distance between the registered query point and
+                its database point to count the correspondence as an inlier. If None, 1.5 voxel sizes are
+                used. Defaults to None.
+
+        Returns:
+            float: Inlier ratio, or 0 if there are no correspondences.
+        """
+        if distance_threshold is None:
+            distance_threshold = self._distance_threshold()
+        if len(src_corr_points) == 0:
+            return 0.0
+        transform = torch.as_tensor(transform, dtype=src_corr_points.dtype, device=src_corr_points.device)
+        registered_points = src_corr_points @ transform[:3, :3].T + transform[:3, 3]
+        distances = torch.linalg.norm(registered_points - ref_corr_points, dim=1)
+        return float((distances < distance_threshold).float().mean())
+
+    def _refine_icp(self, query_pc: Tensor, db_pc: Tensor, transform: np.ndarray) -> np.ndarray:
+        """Refine the transform with the point-to-plane ICP."""
+        with self.profiler.stage("registration/icp"):
+            source, target = o3d.geometry.PointCloud(), o3d.geometry.PointCloud()
+            source.points = o3d.utility.Vector3dVector(query_pc.cpu().numpy().astype(np.float64))
+            target.points = o3d.utility.Vector3dVector(db_pc.cpu().numpy().astype(np.float64))
+            target.estimate_normals(
+                o3d.geometry.KDTreeSearchParamHybrid(radius=2 * self._distance_threshold(), max_nn=30)
+            )
+            result = o3d.pipelines.registration.registration_icp(
+                source,
+                target,
+                self._distance_threshold(),
+                np.asarray(transform, dtype=np.float64),
+                o3d.pipelines.registration.TransformationEstimationPointToPlane(),
+                o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=30),
+            )
+        return result.transformation
+
+    def infer_with_score(
+        self,
+        query_pc: Tensor,
+        db_pc: Tensor,
+        downsample_db_pc: bool = True,
+        downsample_query_pc: bool = True,
+    ) -> Dict[str, Any]:
+        """Infer the transformation with its quality scores, escalating to the fallback stages if needed.
+
+        The model transform is scored with the overlap of the registered pointclouds. If the overlap is
+        lower than "score_threshold", the "fallback_stages" are tried in order and the first transform
+        that clears the threshold is returned, so the easy pairs cost a single model pass. If none does,
+        the transform with the best overlap is returned.
+
+        Args:
+            query_pc (Tensor): Query pointcloud. Coordinates array of shape (N, 3).
+            db_pc (Tensor): Database pointcloud. Coordinates array of shape (M, 3).
+            downsample_db_pc (bool): Whether to downsample the database pointcloud. Defaults to True.
+            downsample_query_pc (bool): Whether to downsample the query pointcloud. Defaults to True.
+
+        Returns:
+            Dict[str, Any]: Inference results. Dictionary with keys:
+
+                "estimated_transform" for the transformation matrix,
+
+                "overlap" for the fraction of the registered query points that overlap the database pointcloud,
+
+                "inlier_ratio" for the fraction of the model point correspondences that agree with
+                the transform, NaN if the model does not return the correspondences (GeoTransformer does),
+
+                "stage" for the stage that produced the transform: "model", "icp" or "ransac".
+        """
+        if downsample_query_pc:
+            query_pc = self._downsample_pointcloud(query_pc)
+        if downsample_db_pc:
+            db_pc = self._downsample_pointcloud(db_pc)
+        with self.profiler.stage("registration/forward"), torch.no_grad():
+            model_output = self.model(query_pc, db_pc)
+        transform = model_output["estimated_transform"].cpu().numpy()
+        best = {"estimated_transform": transform, "overlap": self.compute_overlap(query_pc, db_pc, transform)}
+        best["stage"] = "model"
+        if self.score_threshold is not None:
+            for stage in self.fallback_stages:
+                if best["overlap"] >= self.score_threshold:
+                    break
+                if stage == "icp":
+                    transform = self._refine_icp(query_pc, db_pc, best["estimated_transform"])
+                else:
+                    transform = self.ransac_pipeline.infer(query_pc, db_pc)
+                    transform = self._refine_icp(query_pc, db_pc, transform)
+                overlap = self.compute_overlap(query_pc, db_pc, transform)
+                if overlap > best["overlap"]:
+                    best = {"estimated_transform": transform, "overlap": overlap, "stage": stage}
+        best["inlier_ratio"] = float("nan")
+        if "src_corr_points" in model_output:
+            best["inlier_ratio"] = self.compute_inlier_ratio(
+                model_output["ref_corr_points"], model_output["src_corr_points"], best["estimated_transform"]
+            )
+        return best
+
+
+class _SubmapScan(NamedTuple):
+    """Scan of the streaming submap: its points or its contribution to the submap voxels, in the submap frame."""
+
+    scan_id: int
+    points: Optional[Tensor]
+    voxel_keys: Optional[Tensor]
+    voxel_sums: Optional[Tensor]
+    voxel_counts: Optional[Tensor]
 
 
 class SequencePointcloudRegistrationPipeline(PointcloudRegistrationPipeline):
@@ -74,20 +471,51 @@ class SequencePointcloudRegistrationPipeline(PointcloudRegistrationPipeline):
         model_weights_path: Optional[Union[str, PathLike]] = None,
         device: Union[str, int, torch.device] = "cuda",
         voxel_downsample_size: Optional[float] = 0.3,
+        profiler: Optional[StageProfiler] = None,
+        downsample_backend: DownsampleBackend = "torch",
+        stream_window_size: int = 10,
+        ransac_feature_cache_size: int = 0,
     ) -> None:
         """Pointcloud registration pipeline that supports sequences.
 
+        The "infer" method accumulates the whole given query sequence on every call. For a stream of
+        the query scans, use the "infer_stream" method instead: it keeps a submap of the most recent
+        scans and registers each new scan only once, against the submap. The submap voxels and
+        the RANSAC features are updated incrementally when a scan is added to or evicted from the window.
+
         Args:
             model (nn.Module): Model.
             model_weights_path (Union[str, PathLike], optional): Path to the model weights.
                 If None, the weights are not loaded. Defaults to None.
             device (Union[str, int, torch.device]): Device to use. Defaults to "cuda".
             voxel_downsample_size (Optional[float]): Voxel downsample size. Defaults to 0.3.
+            profiler (StageProfiler, optional): Stages profiler shared with the RANSAC pipeline, see
+                PointcloudRegistrationPipeline. The query sequence accumulation is recorded as
+                the "registration/accumulate" stage. Defaults to None.
+            downsample_backend (DownsampleBackend): Voxel downsampling backend, shared with the RANSAC
+                pipeline. Defaults to "torch".
+            stream_window_size (int): Maximum number of the most recent scans in the streaming submap.
+                Defaults to 10.
+            ransac_feature_cache_size (int): Number of the query scans to cache the RANSAC features of,
+                so the "infer" method does not recompute them for the scans of the overlapping sequences.
+                See RansacGlobalRegistrationPipeline. Defaults to 0.
+
+        Raises:
+            ValueError: If stream_window_size is not positive.
         """
-        super().__init__(model, model_weights_path, device, voxel_downsample_size)
+        if stream_window_size < 1:
+            raise ValueError(f"stream_window_size must be positive, but {stream_window_size!r} given.")
+        super().__init__(
+            model, model_weights_path, device, voxel_downsample_size, profiler, downsample_backend
+        )
         self.ransac_pipeline = RansacGlobalRegistrationPipeline(
-            voxel_downsample_size=0.5  # handcrafted optimal value for fast inference
+            voxel_downsample_size=0.5,  # handcrafted optimal value for fast inference
+            profiler=self.profiler,
+            downsample_backend=downsample_backend,
+            feature_cache_size=ransac_feature_cache_size,
         )
+        self.stream_window_size = stream_window_size
+        self.reset_stream()
 
     def _transform_points(self, points: Tensor, transform: Tensor) -> Tensor:
         points_hom = torch.cat((points, torch.ones((points.shape[0], 1), device=points.device)), dim=1)
@@ -97,47 +525,211 @@ class SequencePointcloudRegistrationPipeline(PointcloudRegistrationPipeline):
         points_transformed = points_transformed_hom[:, :3] / points_transformed_hom[:, 3].unsqueeze(-1)
         return points_transformed
 
-    def infer(self, query_pc_list: List[Tensor], db_pc: Tensor) -> np.ndarray:
+    def infer(self, query_pc_list: List[Tensor], db_pc: Tensor, downsample_db_pc: bool = True) -> np.ndarray:
         """Infer the transformation between the query sequence and the database pointclouds.
 
         Args:
             query_pc_list (List[Tensor]): Sequence of query pointclouds. Coordinates arrays of shape (N, 3).
             db_pc (Tensor): Database pointcloud. Coordinates array of shape (M, 3).
+            downsample_db_pc (bool): Whether to downsample the database pointcloud. Defaults to True.
 
         Returns:
             np.ndarray: Transformation matrix.
         """
-        if len(query_pc_list) > 1:
-            accumulated_query_pc = query_pc_list[-1]
-            for pc in query_pc_list[-2::-1]:
-                transform = torch.tensor(
-                    self.ransac_pipeline.infer(accumulated_query_pc, pc), dtype=torch.float32
+        with self.profiler.stage("registration/accumulate"):
+            if len(query_pc_list) > 1:
+                accumulated_query_pc = query_pc_list[-1]
+                for pc in query_pc_list[-2::-1]:
+                    transform = torch.tensor(
+                        self.ransac_pipeline.infer(accumulated_query_pc, pc), dtype=torch.float32
+                    )
+                    accumulated_query_pc = torch.cat(
+                        [accumulated_query_pc, self._transform_points(pc, transform)], dim=0
+                    )
+            else:
+                accumulated_query_pc = query_pc_list[0]
+        return super().infer(accumulated_query_pc, db_pc, downsample_db_pc=downsample_db_pc)
+
+    def reset_stream(self) -> None:
+        """Clear the streaming submap, e.g. before a new query sequence."""
+        self._stream_scans: Deque[_SubmapScan] = deque()
+        self._stream_pose = np.eye(4)
+        self._num_stream_scans = 0
+        # voxel centroids of the submap scans points, as the points sums and counts per voxel
+        self._submap_keys = torch.zeros(0, dtype=torch.int64, device=self.device)
+        self._submap_sums = torch.zeros((0, 3), dtype=torch.float64, device=self.device)
+        self._submap_counts = torch.zeros(0, dtype=torch.int64, device=self.device)
+        # RANSAC points and features of the submap, a RANSAC voxel keeps the ones of the newest scan in it
+        self._ransac_keys = np.zeros(0, dtype=np.int64)
+        self._ransac_scan_ids = np.zeros(0, dtype=np.int64)
+        self._ransac_points = np.zeros((0, 3))
+        self._ransac_feats = np.zeros((0, 33))
+
+    def _merge_submap_voxels(self, keys: Tensor, sums: Tensor, counts: Tensor) -> None:
+        """Add the scan voxels to the submap ones. The negated sums and counts remove them."""
+        keys, inverse = torch.unique(torch.cat([self._submap_keys, keys]), return_inverse=True)
+        merged_sums = torch.zeros((len(keys), 3), dtype=torch.float64, device=keys.device)
+        merged_sums.index_add_(0, inverse, torch.cat([self._submap_sums, sums]))
+        merged_counts = torch.zeros(len(keys), dtype=torch.int64, device=keys.device)
+        merged_counts.index_add_(0, inverse, torch.cat([self._submap_counts, counts]))
+        nonempty = merged_counts > 0
+        self._submap_keys = keys[nonempty]
+        self._submap_sums = merged_sums[nonempty]
+        self._submap_counts = merged_counts[nonempty]
+
+    def _merge_ransac_features(
+        self, scan_id: int, points: np.ndarray, feats: np.ndarray, evicted_scan_id: Optional[int]
+    ) -> None:
+        """Replace the RANSAC points and features of the voxels seen by the new scan with the scan ones."""
+        keys = _voxel_keys(torch.from_numpy(points), self.ransac_pipeline.voxel_downsample_size).numpy()
+        keep = ~np.isin(self._ransac_keys, keys)
+        if evicted_scan_id is not None:
+            keep &= self._ransac_scan_ids != evicted_scan_id
+        self._ransac_keys = np.concatenate([self._ransac_keys[keep], keys])
+        self._ransac_scan_ids = np.concatenate([self._ransac_scan_ids[keep], np.full(len(keys), scan_id)])
+        self._ransac_points = np.concatenate([self._ransac_points[keep], points])
+        self._ransac_feats = np.concatenate([self._ransac_feats[keep], feats])
+
+    def add_scan(self, query_pc: Tensor) -> np.ndarray:
+        """Register the new query scan against the streaming submap and merge it into the submap.
+
+        The submap is kept in the frame of the first scan after the last "reset_stream" call. The scan
+        points are pooled into the submap voxels, which are anchored at the submap frame origin, and
+        the oldest scan points are removed from them once the window is full. The scan FPFH features are
+        computed once and replace the features of the older scans in the same RANSAC voxels.
+
+        Args:
+            query_pc (Tensor): Query pointcloud. Coordinates array of shape (N, 3).
+
+        Returns:
+            np.ndarray: Transformation matrix from the scan to the submap frame.
+        """
+        with self.profiler.stage("registration/accumulate"):
+            ransac_points, ransac_feats = self.ransac_pipeline.compute_features(query_pc)
+            pose = np.eye(4)
+            if len(self._stream_scans) > 0:
+                pose = self.ransac_pipeline.register_features(
+                    ransac_points, ransac_feats, self._ransac_points, self._ransac_feats
                 )
-                accumulated_query_pc = torch.cat(
-                    [accumulated_query_pc, self._transform_points(pc, transform)], dim=0
+            evicted_scan = None
+            if len(self._stream_scans) == self.stream_window_size:
+                evicted_scan = self._stream_scans.popleft()
+                if evicted_scan.points is None:
+                    self._merge_submap_voxels(
+                        evicted_scan.voxel_keys, -evicted_scan.voxel_sums, -evicted_scan.voxel_counts
+                    )
+
+            scan_id = self._num_stream_scans
+            self._num_stream_scans += 1
+            transform = torch.tensor(pose, dtype=torch.float64, device=self.device)
+            points = query_pc[:, :3].to(self.device).double() @ transform[:3, :3].T + transform[:3, 3]
+            if self.voxel_downsample_size is None:
+                scan = _SubmapScan(scan_id, points.float(), None, None, None)
+            else:
+                scan = _SubmapScan(
+                    scan_id, None, *_pool_voxels(_voxel_keys(points, self.voxel_downsample_size), points)
                 )
+                self._merge_submap_voxels(scan.voxel_keys, scan.voxel_sums, scan.voxel_counts)
+            self._stream_scans.append(scan)
+            self._merge_ransac_features(
+                scan_id,
+                ransac_points @ pose[:3, :3].T + pose[:3, 3],
+                ransac_feats,
+                None if evicted_scan is None else evicted_scan.scan_id,
+            )
+            self._stream_pose = pose
+        return pose
+
+    def get_submap(self) -> Tensor:
+        """Streaming submap in the frame of the most recent scan.
+
+        Returns:
+            Tensor: Submap pointcloud, the centroids of the submap voxels if the pipeline voxel size is set.
+                Coordinates array of shape (N, 3).
+        """
+        if self.voxel_downsample_size is None:
+            submap = torch.cat([scan.points for scan in self._stream_scans]).double()
         else:
-            accumulated_query_pc = query_pc_list[0]
-        return super().infer(accumulated_query_pc, db_pc)
+            submap = self._submap_sums / self._submap_counts[:, None]
+        inv_pose = torch.tensor(np.linalg.inv(self._stream_pose), dtype=torch.float64, device=submap.device)
+        return (submap @ inv_pose[:3, :3].T + inv_pose[:3, 3]).float()
+
+    def infer_stream(self, query_pc: Tensor, db_pc: Tensor, downsample_db_pc: bool = True) -> np.ndarray:
+        """Infer the transformation between the new query scan and the database pointclouds.
+
+        The scan is added to the streaming submap with the "add_scan" method, and the submap of
+        the "stream_window_size" most recent scans is registered against the database pointcloud.
+
+        Args:
+            query_pc (Tensor): Query pointcloud. Coordinates array of shape (N, 3).
+            db_pc (Tensor): Database pointcloud. Coordinates array of shape (M, 3).
+            downsample_db_pc (bool): Whether to downsample the database pointcloud. Defaults to True.
+
+        Returns:
+            np.ndarray: Transformation matrix from the query scan to the database frame.
+        """
+        self.add_scan(query_pc)
+        return super().infer(
+            self.get_submap(), db_pc, downsample_db_pc=downsample_db_pc, downsample_query_pc=False
+        )
 
 
 class RansacGlobalRegistrationPipeline:
     """Pointcloud registration pipeline using RANSAC."""
 
-    def __init__(self, voxel_downsample_size: float = 0.5) -> None:
+    def __init__(
+        self,
+        voxel_downsample_size: float = 0.5,
+        profiler: Optional[StageProfiler] = None,
+        downsample_backend: DownsampleBackend = "torch",
+        max_iteration: int = 100000,
+        confidence: float = 0.999,
+        feature_cache_size: int = 0,
+        num_workers: int = 1,
+    ) -> None:
         """Pointcloud registration pipeline using RANSAC.
 
         Args:
             voxel_downsample_size (float): Voxel downsample size. Defaults to 0.5.
+            profiler (StageProfiler, optional): Profiler of the "registration/ransac_features" and
+                "registration/ransac" stages. If None, a disabled profiler is created. Defaults to None.
+            downsample_backend (DownsampleBackend): Voxel downsampling backend, see
+                the "voxel_downsample_pointcloud" function. Defaults to "torch".
+            max_iteration (int): Maximum number of the RANSAC iterations. Defaults to 100000.
+            confidence (float): RANSAC confidence to stop early. Defaults to 0.999.
+            feature_cache_size (int): Maximum number of the pointclouds to cache the downsampled points and
+                FPFH features of, keyed by the pointcloud contents. If 0, nothing is cached. Defaults to 0.
+            num_workers (int): Number of threads to register the pairs of the "infer_batch" method
+                in parallel. Defaults to 1.
+
+        Raises:
+            ValueError: If confidence is not in (0, 1] or max_iteration is not positive.
         """
+        if not 0 < confidence <= 1:
+            raise ValueError(f"confidence must be in (0, 1], but {confidence!r} given.")
+        if max_iteration < 1:
+            raise ValueError(f"max_iteration must be positive, but {max_iteration!r} given.")
         self.voxel_downsample_size = voxel_downsample_size
+        self.profiler = profiler if profiler is not None else StageProfiler(enabled=False)
+        self.downsample_backend = downsample_backend
+        self.max_iteration = max_iteration
+        self.confidence = confidence
+        self.feature_cache = LRUCache(max_size=feature_cache_size)
+        self.num_workers = num_workers
 
     def _preprocess_point_cloud(
         self, points: Tensor
     ) -> Tuple[o3d.geometry.PointCloud, o3d.pipelines.registration.Feature]:
-        pcd = o3d.geometry.PointCloud()
-        pcd.points = o3d.utility.Vector3dVector(points)
-        pcd_down = pcd.voxel_down_sample(self.voxel_downsample_size)
+        if self.downsample_backend == "open3d":
+            pcd = o3d.geometry.PointCloud()
+            pcd.points = o3d.utility.Vector3dVector(points)
+            pcd_down = pcd.voxel_down_sample(self.voxel_downsample_size)
+        else:
+            points_down = voxel_downsample_pointcloud(
+                torch.as_tensor(points), self.voxel_downsample_size, self.downsample_backend
+            )
+            pcd_down = o3d.geometry.PointCloud()
+            pcd_down.points = o3d.utility.Vector3dVector(points_down.numpy().astype(np.float64))
         radius_normal = self.voxel_downsample_size * 2
         pcd_down.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=radius_normal, max_nn=30))
         radius_feature = self.voxel_downsample_size * 5
@@ -167,10 +759,64 @@ class RansacGlobalRegistrationPipeline:
                 o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(0.9),
                 o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(distance_threshold),
             ],
-            o3d.pipelines.registration.RANSACConvergenceCriteria(100000, 0.999),
+            o3d.pipelines.registration.RANSACConvergenceCriteria(self.max_iteration, self.confidence),
         )
         return result
 
+    def compute_features(self, pc: Tensor) -> Tuple[np.ndarray, np.ndarray]:
+        """Downsample the pointcloud and compute the FPFH features of the downsampled points.
+
+        The FPFH features are invariant to rigid transforms, so they can be computed once per pointcloud
+        and reused after moving the points to another frame, see the "register_features" method.
+
+        Args:
+            pc (Tensor): Pointcloud. Coordinates array of shape (N, 3).
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Downsampled points, array of shape (M, 3),
+                and their FPFH features, array of shape (M, 33).
+        """
+        points = pc.detach().cpu().numpy()
+        if self.feature_cache.max_size == 0:
+            return self._compute_features(points)
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(str((points.dtype, points.shape)).encode())
+        hasher.update(np.ascontiguousarray(points).tobytes())
+        return self.feature_cache.get_or_compute(hasher.hexdigest(), lambda: self._compute_features(points))
+
+    def _compute_features(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        with self.profiler.stage("registration/ransac_features"):
+            pcd_down, pcd_fpfh = self._preprocess_point_cloud(points)
+            return np.asarray(pcd_down.points), np.asarray(pcd_fpfh.data).T
+
+    def register_features(
+        self,
+        query_points: np.ndarray,
+        query_feats: np.ndarray,
+        db_points: np.ndarray,
+        db_feats: np.ndarray,
+    ) -> np.ndarray:
+        """Infer the transformation between the pointclouds with precomputed features.
+
+        Args:
+            query_points (np.ndarray): Downsampled query points, array of shape (N, 3).
+            query_feats (np.ndarray): Query FPFH features, array of shape (N, 33).
+            db_points (np.ndarray): Downsampled database points, array of shape (M, 3).
+            db_feats (np.ndarray): Database FPFH features, array of shape (M, 33).
+
+        Returns:
+            np.ndarray: Transformation matrix.
+        """
+        with self.profiler.stage("registration/ransac"):
+            source_down, source_fpfh = o3d.geometry.PointCloud(), o3d.pipelines.registration.Feature()
+            source_down.points = o3d.utility.Vector3dVector(query_points)
+            source_fpfh.data = np.ascontiguousarray(query_feats.T, dtype=np.float64)
+            target_down, target_fpfh = o3d.geometry.PointCloud(), o3d.pipelines.registration.Feature()
+            target_down.points = o3d.utility.Vector3dVector(db_points)
+            target_fpfh.data = np.ascontiguousarray(db_feats.T, dtype=np.float64)
+            result = self._execute_global_registration(source_down, target_down, source_fpfh, target_fpfh)
+        return result.transformation
+
     def infer(self, query_pc: Tensor, db_pc: Tensor) -> np.ndarray:
         """Infer the transformation between the query and the database pointclouds.
 
@@ -181,9 +827,41 @@ class RansacGlobalRegistrationPipeline:
         Returns:
             np.ndarray: Transformation matrix.
         """
-        query_pc = query_pc.cpu().numpy()
-        db_pc = db_pc.cpu().numpy()
-        source_down, source_fpfh = self._preprocess_point_cloud(query_pc)
-        target_down, target_fpfh = self._preprocess_point_cloud(db_pc)
-        result = self._execute_global_registration(source_down, target_down, source_fpfh, target_fpfh)
-        return result.transformation
+        query_points, query_feats = self.compute_features(query_pc)
+        db_points, db_feats = self.compute_features(db_pc)
+        return self.register_features(query_points, query_feats, db_points, db_feats)
+
+    def _timed_infer(self, query_pc: Tensor, db_pc: Tensor) -> Tuple[np.ndarray, float]:
+        t_start = time.perf_counter()
+        transform = self.infer(query_pc, db_pc)
+        return transform, time.perf_counter() - t_start
+
+    def infer_batch(
+        self, query_pcs: Sequence[Tensor], db_pcs: Sequence[Tensor]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Infer the transformations between several query and database pointclouds pairs.
+
+        The pairs are registered concurrently by the "num_workers" threads, if more than one. The threads
+        are started for the call and joined before it returns.
+
+        Args:
+            query_pcs (Sequence[Tensor]): Query pointclouds. Coordinates arrays of shape (N_i, 3).
+            db_pcs (Sequence[Tensor]): Database pointclouds. Coordinates arrays of shape (M_i, 3).
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Transformation matrices, array of shape (B, 4, 4),
+                and the wall time of each pair registration in seconds, array of shape (B,).
+
+        Raises:
+            ValueError: If the numbers of query and database pointclouds differ.
+        """
+        if len(query_pcs) != len(db_pcs):
+            raise ValueError(f"Got {len(query_pcs)} query and {len(db_pcs)} database pointclouds.")
+        num_workers = min(self.num_workers, len(query_pcs))
+        if num_workers <= 1:
+            results = [self._timed_infer(query_pc, db_pc) for query_pc, db_pc in zip(query_pcs, db_pcs)]
+        else:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                results = list(executor.map(self._timed_infer, query_pcs, db_pcs))
+        transforms = np.array([result[0] for result in results], dtype=np.float64).reshape(-1, 4, 4)
+        return transforms, np.array([result[1] for result in results])
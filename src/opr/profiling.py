@@ -0,0 +1,205 @@
+"""Per-stage latency profiling for the pipelines."""
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from os import PathLike
+from typing import ContextManager, Deque, Dict, Iterator, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+_NULL_CONTEXT = nullcontext()
+
+
+class _StageStats:
+    """Call counter, total time and the rolling window of the recent durations of a stage."""
+
+    __slots__ = ("count", "total", "durations")
+
+    def __init__(self, window_size: int) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.durations: Deque[float] = deque(maxlen=window_size)
+
+
+class StageProfiler:
+    """Thread-safe wall time profiler of the named pipeline stages.
+
+    The pipelines wrap their stages in the "stage" context manager, e.g. "place_recognition/forward" or
+    "registration/downsample". A disabled profiler adds no synchronization and a negligible overhead,
+    so every pipeline has one. To profile several pipelines together, e.g. the Place Recognition and
+    the registration pipelines of a LocalizationPipeline, pass the same profiler to all of them.
+
+    Example:
+        >>> profiler = StageProfiler()
+        >>> pipe = PlaceRecognitionPipeline(database_dir, model, profiler=profiler)
+        >>> output = pipe.infer(sample)
+        >>> profiler.summary()["place_recognition/forward"]["p90"]
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        window_size: int = 1000,
+        cuda_sync: bool = True,
+        max_trace_events: int = 100000,
+    ) -> None:
+        """Thread-safe wall time profiler of the named pipeline stages.
+
+        Args:
+            enabled (bool): Whether to record the stages. Defaults to True.
+            window_size (int): Number of the most recent calls of each stage to compute the percentiles on.
+                Defaults to 1000.
+            cuda_sync (bool): Whether to synchronize CUDA before and after each stage, so the asynchronous
+                kernels are timed in the stage that launched them. Only applies if CUDA is initialized.
+                Defaults to True.
+            max_trace_events (int): Maximum number of the most recent calls to keep for the Chrome trace.
+                Defaults to 100000.
+
+        Raises:
+            ValueError: If window_size or max_trace_events is not positive.
+        """
+        if window_size < 1:
+            raise ValueError(f"window_size must be positive, but {window_size!r} given.")
+        if max_trace_events < 1:
+            raise ValueError(f"max_trace_events must be positive, but {max_trace_events!r} given.")
+        self.enabled = enabled
+        self.window_size = window_size
+        self.cuda_sync = cuda_sync
+        self._stats: Dict[str, _StageStats] = {}
+        self._trace_events: Deque[Tuple[str, float, float, int]] = deque(maxlen=max_trace_events)
+        self._lock = threading.Lock()
+        self._start_time = time.perf_counter()
+
+    def _synchronize(self) -> None:
+        if self.cuda_sync and torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+
+    @contextmanager
+    def _timed(self, name: str) -> Iterator[None]:
+        self._synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._synchronize()
+            self.record(name, time.perf_counter() - start, start=start)
+
+    def stage(self, name: str) -> ContextManager[None]:
+        """Context manager that records the wall time of the wrapped code as the given stage.
+
+        Args:
+            name (str): Stage name. Nested stages are recorded independently.
+
+        Returns:
+            ContextManager[None]: Timing context manager, or a no-op one if the profiler is disabled.
+        """
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._timed(name)
+
+    def record(self, name: str, duration: float, start: Optional[float] = None) -> None:
+        """Record a call of the stage measured outside of the profiler. Does nothing if the profiler is disabled.
+
+        Args:
+            name (str): Stage name.
+            duration (float): Stage wall time in seconds.
+            start (float, optional): Stage start time, the "time.perf_counter" value. If None, the stage is
+                assumed to have just finished. Defaults to None.
+        """
+        if not self.enabled:
+            return
+        if start is None:
+            start = time.perf_counter() - duration
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = _StageStats(self.window_size)
+            stats.count += 1
+            stats.total += duration
+            stats.durations.append(duration)
+            self._trace_events.append((name, start, duration, threading.get_ident()))
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Statistics of the recorded stages.
+
+        Returns:
+            Dict[str, Dict[str, float]]: Dictionary with the stage names as keys and dictionaries with keys:
+
+                "count" for the number of calls,
+
+                "total" for the total time in seconds,
+
+                "mean" for the mean time of all calls in seconds,
+
+                "p50", "p90", "p99" and "max" for the percentiles and the maximum of the time
+                of the most recent "window_size" calls in seconds.
+        """
+        with self._lock:
+            stats_items = [
+                (name, stats.count, stats.total, list(stats.durations)) for name, stats in self._stats.items()
+            ]
+        summary = {}
+        for name, count, total, durations in stats_items:
+            p50, p90, p99 = np.percentile(durations, [50, 90, 99])
+            summary[name] = {
+                "count": count,
+                "total": total,
+                "mean": total / count,
+                "p50": float(p50),
+                "p90": float(p90),
+                "p99": float(p99),
+                "max": float(max(durations)),
+            }
+        return summary
+
+    def chrome_trace(self) -> Dict[str, list]:
+        """Recent stage calls in the Chrome trace event format.
+
+        Returns:
+            Dict[str, list]: Trace that can be opened in "chrome://tracing" or Perfetto.
+        """
+        pid = os.getpid()
+        with self._lock:
+            trace_events = list(self._trace_events)
+        events = [
+            {
+                "name": name,
+                "cat": "opr",
+                "ph": "X",
+                "ts": (start - self._start_time) * 1e6,
+                "dur": duration * 1e6,
+                "pid": pid,
+                "tid": tid,
+            }
+            for name, start, duration, tid in trace_events
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save_json(self, path: Union[str, PathLike]) -> None:
+        """Save the "summary" method output as a JSON file.
+
+        Args:
+            path (Union[str, PathLike]): Output file path.
+        """
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def save_chrome_trace(self, path: Union[str, PathLike]) -> None:
+        """Save the "chrome_trace" method output as a JSON file.
+
+        Args:
+            path (Union[str, PathLike]): Output file path.
+        """
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def reset(self) -> None:
+        """Remove all recorded calls."""
+        with self._lock:
+            self._stats.clear()
+            self._trace_events.clear()
+            self._start_time = time.perf_counter()
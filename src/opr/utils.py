@@ -1,7 +1,9 @@
 """Package-level utility functions."""
 import random
+import threading
+from collections import OrderedDict
 from os import PathLike
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
@@ -301,3 +303,62 @@ def get_start_end_indices_of_local_batch(
         start_end_indices.append((start_index, end_index))
         start_index = end_index
     return start_end_indices[rank]
+
+
+class LRUCache:
+    """Thread-safe bounded cache with the least recently used eviction policy."""
+
+    def __init__(self, max_size: int = 128) -> None:
+        """Thread-safe bounded cache with the least recently used eviction policy.
+
+        Args:
+            max_size (int): Maximum number of cached items. If 0, nothing is cached. Defaults to 128.
+
+        Raises:
+            ValueError: If max_size is negative.
+        """
+        if max_size < 0:
+            raise ValueError(f"max_size must be non-negative, but {max_size!r} given.")
+        self.max_size = max_size
+        self._items: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:  # noqa: D105
+        return len(self._items)
+
+    def __contains__(self, key: Hashable) -> bool:  # noqa: D105
+        return key in self._items
+
+    def get_or_compute(self, key: Hashable, compute_fn: Callable[[], Any]) -> Any:
+        """Get the cached value or compute and cache it.
+
+        The value is computed outside of the lock, so concurrent misses of the same key may compute it twice.
+
+        Args:
+            key (Hashable): Cache key.
+            compute_fn (Callable[[], Any]): Function that computes the value on cache miss.
+
+        Returns:
+            Any: Cached or computed value.
+        """
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+        value = compute_fn()
+        if self.max_size > 0:
+            with self._lock:
+                self._items[key] = value
+                self._items.move_to_end(key)
+                while len(self._items) > self.max_size:
+                    self._items.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        """Remove all cached items. The counters are kept."""
+        with self._lock:
+            self._items.clear()
@@ -0,0 +1 @@
+"""Test cases for opr.models.registration module."""
@@ -0,0 +1,83 @@
+"""Test cases for opr.models.registration.geotransformer module."""
+from typing import List, Tuple
+
+import pytest
+import torch
+from hydra.utils import instantiate
+from torch import Tensor
+
+from tests.utils import load_config
+
+pytest.importorskip("geotransformer.modules.geotransformer")
+
+from opr.models.registration.geotransformer import GeoTransformer  # noqa: E402
+
+
+def make_model() -> GeoTransformer:
+    """Instantiate the GeoTransformer model with random weights."""
+    return instantiate(load_config("configs/model/registration/geotransformer_kitti.yaml")).eval()
+
+
+def make_pairs() -> List[Tuple[Tensor, Tensor]]:
+    """Make two query and database pointclouds pairs of different sizes, 100 m apart from each other."""
+    generator = torch.Generator().manual_seed(0)
+    pairs = []
+    for i, num_points in enumerate((1500, 2500)):
+        db_pc = torch.rand((num_points, 3), generator=generator) * torch.tensor([30.0, 30.0, 5.0])
+        db_pc[:, 0] += 100.0 * i
+        query_pc = db_pc[: num_points - 200 * (i + 1)] + torch.tensor([1.0, 0.0, 0.0])
+        pairs.append((query_pc, db_pc))
+    return pairs
+
+
+def test_pair_slices_split_stacked_lengths() -> None:
+    """Should slice the reference points of the pair among the first ones and the source points after them."""
+    lengths = torch.tensor([3, 5, 2, 4])  # ref 0, ref 1, src 0, src 1
+    assert GeoTransformer._pair_slices(lengths, 0, 2) == (slice(0, 3), slice(8, 10))
+    assert GeoTransformer._pair_slices(lengths, 1, 2) == (slice(3, 8), slice(10, 14))
+    assert GeoTransformer._pair_slices(torch.tensor([3, 2]), 0, 1) == (slice(0, 3), slice(3, 5))
+
+
+def test_collate_stacks_all_references_then_all_sources() -> None:
+    """Should stack the database pointclouds of all pairs first and then the query ones at every stage."""
+    model = make_model()
+    pairs = make_pairs()
+    data_dict = model._collate([model._make_data_dict(query_pc, db_pc) for query_pc, db_pc in pairs])
+    expected_lengths = [len(db_pc) for _, db_pc in pairs] + [len(query_pc) for query_pc, _ in pairs]
+    assert data_dict["lengths"][0].tolist() == expected_lengths
+    for i, (query_pc, db_pc) in enumerate(pairs):
+        ref_slice, src_slice = model._pair_slices(data_dict["lengths"][0], i, len(pairs))
+        torch.testing.assert_close(data_dict["points"][0][ref_slice], db_pc)
+        torch.testing.assert_close(data_dict["points"][0][src_slice], query_pc)
+        # the subsampled points of every stage stay within their own pair
+        for lengths, points in zip(data_dict["lengths"][1:], data_dict["points"][1:]):
+            for pair_slice in model._pair_slices(lengths, i, len(pairs)):
+                x = points[pair_slice][:, 0]
+                assert len(x) > 0
+                assert ((x >= 100.0 * i - 1.0) & (x <= 100.0 * i + 32.0)).all()
+
+
+def test_forward_batch_of_single_pair_matches_forward() -> None:
+    """Should give the same transform for a batch of one pair as the forward method."""
+    model = make_model()
+    query_pc, db_pc = make_pairs()[0]
+    with torch.no_grad():
+        expected = model(query_pc, db_pc)["estimated_transform"]
+        output = model.forward_batch([query_pc], [db_pc])["estimated_transform"]
+    assert output.shape == (1, 4, 4)
+    torch.testing.assert_close(output[0], expected)
+
+
+def test_forward_batch_returns_transform_per_pair() -> None:
+    """Should return a rigid transform for every pair of the batch."""
+    model = make_model()
+    pairs = make_pairs()
+    with torch.no_grad():
+        output = model.forward_batch([query_pc for query_pc, _ in pairs], [db_pc for _, db_pc in pairs])
+    transforms = output["estimated_transform"]
+    assert transforms.shape == (2, 4, 4)
+    torch.testing.assert_close(transforms[:, 3], torch.tensor([[0.0, 0.0, 0.0, 1.0]] * 2))
+    rotations = transforms[:, :3, :3]
+    torch.testing.assert_close(
+        rotations @ rotations.transpose(1, 2), torch.eye(3).expand(2, 3, 3), atol=1e-4, rtol=0
+    )
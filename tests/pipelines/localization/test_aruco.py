@@ -0,0 +1,178 @@
+"""Test cases for opr.pipelines.localization.aruco module."""
+import threading
+import time
+from typing import Any, Dict, Tuple
+
+import cv2
+import numpy as np
+import pytest
+import torch
+from torch import Tensor
+
+from opr.pipelines.localization.aruco import ArucoLocalizationPipeline, estimate_markers_poses
+from opr.pipelines.registration import PointcloudRegistrationPipeline
+from tests.utils import CentroidRegistrationModel, FixedRankingPipeline, ToyDatabase
+
+CAMERA_MATRIX = np.array([[500.0, 0.0, 320.0], [0.0, 500.0, 240.0], [0.0, 0.0, 1.0]])
+
+
+def test_estimate_markers_poses_recovers_projected_markers() -> None:
+    """Should recover the poses of all markers from their projected corners."""
+    half_size = 0.1
+    object_points = np.array(
+        [
+            [-half_size, half_size, 0],
+            [half_size, half_size, 0],
+            [half_size, -half_size, 0],
+            [-half_size, -half_size, 0],
+        ]
+    )
+    rvecs = np.array([[0.1, -0.2, 0.05], [-0.3, 0.1, 0.2]])
+    tvecs = np.array([[0.2, -0.1, 2.0], [-0.5, 0.3, 3.0]])
+    corners = [
+        cv2.projectPoints(object_points, rvec, tvec, CAMERA_MATRIX, np.zeros(5))[0].reshape(1, 4, 2)
+        for rvec, tvec in zip(rvecs, tvecs)
+    ]
+    transforms = estimate_markers_poses(corners, 2 * half_size, CAMERA_MATRIX, np.zeros(5))
+    assert transforms.shape == (2, 4, 4)
+    np.testing.assert_allclose(transforms[:, :3, 3], tvecs, atol=1e-4)
+    for transform, rvec in zip(transforms, rvecs):
+        np.testing.assert_allclose(transform[:3, :3], cv2.Rodrigues(rvec)[0], atol=1e-4)
+    assert estimate_markers_poses([], 0.2, CAMERA_MATRIX, np.zeros(5)).shape == (0, 4, 4)
+
+
+class SlowRankingPipeline(FixedRankingPipeline):
+    """Toy Place Recognition pipeline that takes the given time to infer and counts the calls."""
+
+    def __init__(self, ranking: np.ndarray, delay: float) -> None:  # noqa: D107
+        super().__init__(ranking)
+        self.delay = delay
+        self.num_calls = 0
+
+    def infer(self, input_data: Dict[str, Tensor], k: int = 1) -> Dict[str, np.ndarray]:  # noqa: D102
+        self.num_calls += 1
+        time.sleep(self.delay)
+        return super().infer(input_data, k)
+
+
+def make_pipeline(
+    pr_delay: float = 0.0, **kwargs: Any
+) -> Tuple[ArucoLocalizationPipeline, Dict[str, Tensor]]:
+    """Create the pipeline and the input with markers 1 m and 2 m away from the front and back cameras."""
+    aruco_type = cv2.aruco.DICT_4X4_50
+    dictionary = cv2.aruco.getPredefinedDictionary(aruco_type)
+    input_data = {}
+    for camera_name, marker_id, side_pixels in (("front_cam", 3, 100), ("back_cam", 7, 50)):
+        image = np.full((480, 640), 255, dtype=np.uint8)
+        image[
+            240 - side_pixels // 2 : 240 + side_pixels // 2, 320 - side_pixels // 2 : 320 + side_pixels // 2
+        ] = cv2.aruco.generateImageMarker(dictionary, marker_id, side_pixels)
+        input_data[f"image_{camera_name}"] = torch.from_numpy(np.repeat(image[None], 3, axis=0))
+    aruco_metadata = {
+        "aruco_type": aruco_type,
+        "aruco_size": 0.2,
+        "aruco_gt_pose_by_id": {
+            3: [10.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0],
+            7: [-10.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0],
+        },
+    }
+    camera_metadata = {}
+    for camera_name in ("front_cam", "back_cam"):
+        camera_metadata[f"{camera_name}_intrinsics"] = CAMERA_MATRIX.tolist()
+        camera_metadata[f"{camera_name}_distortion"] = [0.0] * 5
+        camera_metadata[f"{camera_name}2baselink"] = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0]
+    db_dataset = ToyDatabase((100, 100))
+    reg_pipe = PointcloudRegistrationPipeline(
+        CentroidRegistrationModel(), device="cpu", voxel_downsample_size=0.05
+    )
+    pipe = ArucoLocalizationPipeline(
+        SlowRankingPipeline(np.array([0, 1]), pr_delay),
+        reg_pipe,
+        db_dataset,
+        aruco_metadata,
+        camera_metadata,
+        **kwargs,
+    )
+    input_data["pointcloud_lidar_coords"] = db_dataset.pointclouds[0]
+    return pipe, input_data
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_infer_estimates_pose_by_nearest_marker(num_workers: int) -> None:
+    """Should localize by the nearest known marker among all cameras and join the detection threads."""
+    num_threads = threading.active_count()
+    pipe, input_data = make_pipeline(num_workers=num_workers)
+    output = pipe.infer(input_data)
+    assert threading.active_count() == num_threads  # the detection threads do not outlive the call
+    # the front camera marker is nearer; it faces the camera, so the marker frame is flipped around x
+    np.testing.assert_allclose(output["pose_by_aruco"][:3], [10.0, 0.0, 1.0], atol=0.05)
+    np.testing.assert_allclose(np.abs(output["pose_by_aruco"][3:]), [1.0, 0.0, 0.0, 0.0], atol=0.02)
+    assert output["pose_by_place_recognition"] is not None
+
+
+@pytest.mark.parametrize("max_marker_distance, expected_num_calls", [(1.5, 0), (0.5, 1)])
+def test_short_circuit_skips_place_recognition_near_marker(
+    max_marker_distance: float, expected_num_calls: int
+) -> None:
+    """Should run the Place Recognition branch only if no marker is near enough."""
+    pipe, input_data = make_pipeline(policy="short_circuit", max_marker_distance=max_marker_distance)
+    output = pipe.infer(input_data)
+    assert output["pose_by_aruco"] is not None
+    assert pipe.pr_pipe.num_calls == expected_num_calls
+    assert (output["pose_by_place_recognition"] is not None) == (expected_num_calls == 1)
+
+
+def test_race_returns_first_trusted_pose() -> None:
+    """Should return the near marker pose without waiting for the slow Place Recognition branch."""
+    pipe, input_data = make_pipeline(pr_delay=2.0, policy="race", max_marker_distance=1.5)
+    t_start = time.perf_counter()
+    output = pipe.infer(input_data)
+    assert time.perf_counter() - t_start < 1.5
+    assert output["pose_by_aruco"] is not None
+    assert output["pose_by_place_recognition"] is None
+
+
+def test_race_waits_for_place_recognition_until_deadline() -> None:
+    """Should wait for the Place Recognition branch if the markers are far, but not past the deadline."""
+    pipe, input_data = make_pipeline(policy="race", max_marker_distance=0.5, deadline=5.0)
+    output = pipe.infer(input_data)
+    assert output["pose_by_place_recognition"] is not None
+    pipe, input_data = make_pipeline(pr_delay=2.0, policy="race", max_marker_distance=0.5, deadline=0.5)
+    output = pipe.infer(input_data)
+    assert output["pose_by_place_recognition"] is None
+
+
+def test_unknown_policy_raises() -> None:
+    """Should raise ValueError for an unknown policy."""
+    with pytest.raises(ValueError):
+        make_pipeline(policy="fastest")
+
+
+def test_race_does_not_queue_place_recognition_behind_previous_frames() -> None:
+    """Should keep the ArUco frame rate while the learned branch is slower than the frame period."""
+    pipe, input_data = make_pipeline(pr_delay=1.0, policy="race", max_marker_distance=1.5)
+    for _ in range(5):
+        t_start = time.perf_counter()
+        output = pipe.infer(input_data)
+        assert time.perf_counter() - t_start < 0.5
+        assert output["pose_by_aruco"] is not None
+        time.sleep(0.1)
+    # the learned branch was not started again while the first one was running
+    assert pipe.pr_pipe.num_calls == 1
+
+
+def test_close_waits_for_abandoned_place_recognition_branch() -> None:
+    """Should wait for the learned branch that missed the race and release its thread on close."""
+    threads = set(threading.enumerate())
+    pipe, input_data = make_pipeline(pr_delay=1.0, policy="race", max_marker_distance=1.5)
+    with pipe:
+        output = pipe.infer(input_data)
+        assert output["pose_by_place_recognition"] is None
+        future = pipe._place_recognition_future
+        assert not future.done()  # the abandoned branch keeps running
+    assert future.done()
+    assert set(threading.enumerate()) <= threads  # the branch thread is joined
+    # the pipeline can be used after closing
+    assert pipe.infer(input_data)["pose_by_aruco"] is not None
+    pipe.close()
+    assert pipe.pr_pipe.num_calls == 2
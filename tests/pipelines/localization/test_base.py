@@ -0,0 +1,192 @@
+"""Test cases for opr.pipelines.localization.base module."""
+import threading
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+import pytest
+import torch
+from torch import Tensor
+
+from opr.pipelines.localization import LocalizationPipeline
+from opr.pipelines.registration import PointcloudRegistrationPipeline
+from tests.utils import CentroidRegistrationModel, FixedRankingPipeline, ToyDatabase
+
+
+def test_infer_selects_best_registered_candidate() -> None:
+    """Should register all top-k candidates in parallel and select the one with the best overlap."""
+    num_threads = threading.active_count()
+    db_dataset = ToyDatabase((300, 300, 300))
+    query_pc = db_dataset.pointclouds[2] * torch.tensor([1.0, 1.0, 0.0]) + torch.tensor([0.5, 0.5, 0.0])
+    db_dataset.pointclouds[2] = query_pc - 0.5 * torch.tensor([1.0, 1.0, 0.0])
+    db_dataset.pointclouds[0] = db_dataset.pointclouds[0] * 5.0
+    reg_pipe = PointcloudRegistrationPipeline(
+        CentroidRegistrationModel(), device="cpu", voxel_downsample_size=0.05
+    )
+    pipe = LocalizationPipeline(
+        FixedRankingPipeline(np.array([0, 2, 1])), reg_pipe, db_dataset, num_candidates=2, num_workers=2
+    )
+    output = pipe.infer({"pointcloud_lidar_coords": query_pc})
+    assert threading.active_count() == num_threads  # the worker threads do not outlive the call
+    np.testing.assert_array_equal(output["candidate_idxs"], [0, 2])
+    assert output["db_match_idx"] == 2
+    assert output["candidate_scores"][1] == 1.0
+    assert output["candidate_scores"][0] < 0.5
+    assert output["candidate_times"].shape == (2, 3)
+    np.testing.assert_allclose(output["estimated_pose"][:3], [1.5, -0.5, 0.0], atol=1e-2)
+    assert len(pipe.db_cache) == 2
+
+
+def test_infer_skips_scoring_single_candidate(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Should not compute the overlap score if there is only one candidate to select from."""
+    db_dataset = ToyDatabase((300, 300))
+    query_pc = db_dataset.pointclouds[1] + torch.tensor([0.5, 0.0, 0.0])
+    reg_pipe = PointcloudRegistrationPipeline(
+        CentroidRegistrationModel(), device="cpu", voxel_downsample_size=0.05
+    )
+
+    def fail_compute_overlap(*args: Any, **kwargs: Any) -> float:
+        raise AssertionError("compute_overlap must not be called for a single candidate")
+
+    monkeypatch.setattr(reg_pipe, "compute_overlap", fail_compute_overlap)
+    pipe = LocalizationPipeline(
+        FixedRankingPipeline(np.array([1, 0])), reg_pipe, db_dataset, num_candidates=1
+    )
+    output = pipe.infer({"pointcloud_lidar_coords": query_pc})
+    assert output["db_match_idx"] == 1
+    assert np.isnan(output["candidate_scores"]).all()
+    np.testing.assert_allclose(output["estimated_pose"][:3], [0.5, 0.0, 0.0], atol=1e-2)
+
+
+class BatchCentroidRegistrationModel(CentroidRegistrationModel):
+    """Toy registration model that also registers batches of pairs."""
+
+    def __init__(self) -> None:  # noqa: D107
+        super().__init__()
+        self.batch_sizes: List[int] = []
+
+    def forward_batch(  # noqa: D102
+        self, query_pcs: Sequence[Tensor], db_pcs: Sequence[Tensor]
+    ) -> Dict[str, Tensor]:
+        self.batch_sizes.append(len(query_pcs))
+        transforms = [
+            self(query_pc, db_pc)["estimated_transform"] for query_pc, db_pc in zip(query_pcs, db_pcs)
+        ]
+        return {"estimated_transform": torch.stack(transforms)}
+
+
+def test_infer_registers_candidates_in_batch() -> None:
+    """Should register all candidates in one batch with the same results as one by one."""
+    db_dataset = ToyDatabase((300, 300, 300))
+    query_pc = db_dataset.pointclouds[1] + torch.tensor([0.5, 0.0, 0.0])
+    ranking = np.array([0, 1, 2])
+    outputs = []
+    for model in (CentroidRegistrationModel(), BatchCentroidRegistrationModel()):
+        reg_pipe = PointcloudRegistrationPipeline(model, device="cpu", voxel_downsample_size=0.05)
+        pipe = LocalizationPipeline(
+            FixedRankingPipeline(ranking), reg_pipe, db_dataset, num_candidates=3, batch_candidates=True
+        )
+        outputs.append(pipe.infer({"pointcloud_lidar_coords": query_pc}))
+    assert model.batch_sizes == [3]
+    assert np.isnan(outputs[1]["candidate_times"][:, 1]).all()  # the batch time is not split
+    assert not np.isnan(outputs[0]["candidate_times"]).any()
+    assert outputs[1]["db_match_idx"] == outputs[0]["db_match_idx"] == 1
+    np.testing.assert_allclose(outputs[1]["candidate_scores"], outputs[0]["candidate_scores"])
+    np.testing.assert_allclose(outputs[1]["estimated_pose"], outputs[0]["estimated_pose"], atol=1e-6)
+
+
+def test_infer_without_candidates_is_not_localized() -> None:
+    """Should return NaN poses and no selected candidate if Place Recognition found no candidates."""
+    db_dataset = ToyDatabase((300, 300))
+    reg_pipe = PointcloudRegistrationPipeline(
+        CentroidRegistrationModel(), device="cpu", voxel_downsample_size=0.05
+    )
+    pipe = LocalizationPipeline(
+        FixedRankingPipeline(np.array([-1, -1])), reg_pipe, db_dataset, num_candidates=2
+    )
+    output = pipe.infer({"pointcloud_lidar_coords": db_dataset.pointclouds[0]})
+    assert output["db_match_idx"] == -1
+    assert np.isnan(output["estimated_pose"]).all()
+    assert np.isnan(output["db_match_pose"]).all()
+    assert output["candidate_idxs"].shape == output["candidate_scores"].shape == (0,)
+    assert output["candidate_times"].shape == (0, 3)
+
+
+def test_infer_rejects_places_without_pointclouds() -> None:
+    """Should raise ValueError for the place ids that are not rows of the database dataset."""
+    db_dataset = ToyDatabase((300, 300))
+    reg_pipe = PointcloudRegistrationPipeline(
+        CentroidRegistrationModel(), device="cpu", voxel_downsample_size=0.05
+    )
+    pipe = LocalizationPipeline(FixedRankingPipeline(np.array([2, 0])), reg_pipe, db_dataset)
+    with pytest.raises(ValueError):
+        pipe.infer({"pointcloud_lidar_coords": db_dataset.pointclouds[0]})
+
+
+def test_infer_registers_candidates_per_pair_by_default() -> None:
+    """Should not batch the candidates unless the batching is enabled explicitly."""
+    db_dataset = ToyDatabase((300, 300, 300))
+    model = BatchCentroidRegistrationModel()
+    reg_pipe = PointcloudRegistrationPipeline(model, device="cpu", voxel_downsample_size=0.05)
+    pipe = LocalizationPipeline(
+        FixedRankingPipeline(np.array([0, 1, 2])), reg_pipe, db_dataset, num_candidates=3
+    )
+    pipe.infer({"pointcloud_lidar_coords": db_dataset.pointclouds[1]})
+    assert model.batch_sizes == []
+
+
+def test_registration_infer_batch_splits_batches() -> None:
+    """Should register the pairs in batches of the given size in the input order."""
+    model = BatchCentroidRegistrationModel()
+    reg_pipe = PointcloudRegistrationPipeline(model, device="cpu", voxel_downsample_size=None)
+    query_pcs = [torch.zeros((1, 3)) for _ in range(5)]
+    db_pcs = [torch.tensor([[float(i), 0.0, 0.0]]) for i in range(5)]
+    transforms = reg_pipe.infer_batch(
+        query_pcs, db_pcs, downsample_db_pc=False, downsample_query_pc=False, batch_size=2
+    )
+    assert model.batch_sizes == [2, 2, 1]
+    assert transforms.shape == (5, 4, 4)
+    np.testing.assert_allclose(transforms[:, 0, 3], np.arange(5))
+
+
+class ReferenceCentroidRegistrationModel(CentroidRegistrationModel):
+    """Toy registration model that encodes the database pointcloud as its centroid."""
+
+    def __init__(self) -> None:  # noqa: D107
+        super().__init__()
+        self.num_encoded = 0
+
+    def encode_reference(self, db_pc: Tensor) -> Dict[str, Tensor]:  # noqa: D102
+        self.num_encoded += 1
+        return {"centroid": db_pc.mean(dim=0)}
+
+    def forward_with_reference(  # noqa: D102
+        self, query_pc: Tensor, reference: Dict[str, Tensor]
+    ) -> Dict[str, Tensor]:
+        transform = torch.eye(4)
+        transform[:3, 3] = reference["centroid"] - query_pc.mean(dim=0)
+        return {"estimated_transform": transform}
+
+
+def test_infer_reuses_cached_database_encodings() -> None:
+    """Should encode each database candidate once and give the same results as the joint registration."""
+    db_dataset = ToyDatabase((300, 300, 300))
+    query_pc = db_dataset.pointclouds[1] + torch.tensor([0.5, 0.0, 0.0])
+    model = ReferenceCentroidRegistrationModel()
+    reg_pipe = PointcloudRegistrationPipeline(model, device="cpu", voxel_downsample_size=0.05)
+    pipe = LocalizationPipeline(
+        FixedRankingPipeline(np.array([0, 1, 2])),
+        reg_pipe,
+        db_dataset,
+        num_candidates=2,
+        db_feature_cache_size=8,
+    )
+    joint_pipe = LocalizationPipeline(
+        FixedRankingPipeline(np.array([0, 1, 2])), reg_pipe, db_dataset, num_candidates=2
+    )
+    expected = joint_pipe.infer({"pointcloud_lidar_coords": query_pc})
+    for _ in range(3):
+        output = pipe.infer({"pointcloud_lidar_coords": query_pc})
+    assert model.num_encoded == 2
+    assert len(pipe.db_feature_cache) == 2
+    assert output["db_match_idx"] == expected["db_match_idx"] == 1
+    np.testing.assert_allclose(output["estimated_pose"], expected["estimated_pose"], atol=1e-5)
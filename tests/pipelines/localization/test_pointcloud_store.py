@@ -0,0 +1,36 @@
+"""Test cases for opr.pipelines.localization.pointcloud_store module."""
+from pathlib import Path
+
+import pytest
+import torch
+
+from opr.pipelines.localization import PointcloudStore
+from tests.utils import ToyDatabase
+
+
+def test_store_round_trip(tmp_path: Path) -> None:
+    """Should return the same pointclouds and poses as the dataset."""
+    dataset = ToyDatabase((5, 0, 3))
+    store = PointcloudStore.build(dataset, tmp_path, voxel_downsample_size=None)
+    assert store.voxel_downsample_size is None
+    store = PointcloudStore(tmp_path)
+    assert len(store) == 3
+    for idx in range(len(dataset)):
+        pc, pose = store[idx]
+        torch.testing.assert_close(pc, dataset[idx]["pointcloud_lidar_coords"])
+        torch.testing.assert_close(pose, dataset[idx]["pose"])
+
+
+def test_store_downsamples_pointclouds(tmp_path: Path) -> None:
+    """Should store the pointclouds downsampled with the given voxel size."""
+    dataset = ToyDatabase((1000,))
+    store = PointcloudStore.build(dataset, tmp_path, voxel_downsample_size=0.5)
+    pc, _ = store[0]
+    assert 0 < len(pc) <= 27  # the voxel grid starts half a voxel below the minimum point
+    assert PointcloudStore(tmp_path).voxel_downsample_size == 0.5
+
+
+def test_missing_store_raises(tmp_path: Path) -> None:
+    """Should raise FileNotFoundError if the store was not built."""
+    with pytest.raises(FileNotFoundError):
+        PointcloudStore(tmp_path)
@@ -0,0 +1,87 @@
+"""Test cases for opr.pipelines.localization.streaming module."""
+import threading
+from typing import Dict, Iterator
+
+import numpy as np
+import pytest
+import torch
+from torch import Tensor
+
+from opr.pipelines.localization import LocalizationPipeline, StreamingLocalizationRunner
+from opr.pipelines.registration import PointcloudRegistrationPipeline
+from tests.utils import CentroidRegistrationModel, FixedRankingPipeline, ToyDatabase
+
+
+@pytest.fixture
+def pipeline() -> LocalizationPipeline:
+    """Create a toy localization pipeline over a database of 3 places."""
+    reg_pipe = PointcloudRegistrationPipeline(
+        CentroidRegistrationModel(), device="cpu", voxel_downsample_size=0.05
+    )
+    return LocalizationPipeline(
+        FixedRankingPipeline(np.array([1, 0, 2])), reg_pipe, ToyDatabase((100, 100, 100))
+    )
+
+
+def make_frames(num_frames: int) -> Iterator[Dict[str, Tensor]]:
+    """Generate frames with the query pointcloud shifted by the frame index along the x axis."""
+    rng = np.random.default_rng(0)
+    for frame_idx in range(num_frames):
+        pc = torch.tensor(rng.random((100, 3)), dtype=torch.float32)
+        yield {"pointcloud_lidar_coords": pc + torch.tensor([frame_idx, 0.0, 0.0])}
+
+
+def test_run_matches_infer(pipeline: LocalizationPipeline) -> None:
+    """Should yield the same results as the sequential inference in the stream order."""
+    runner = StreamingLocalizationRunner(pipeline, queue_size=1)
+    outputs = list(runner.run(make_frames(5)))
+    assert [output["frame_idx"] for output in outputs] == list(range(5))
+    assert runner.num_dropped == 0
+    for output, frame in zip(outputs, make_frames(5)):
+        expected = pipeline.infer(frame)
+        np.testing.assert_allclose(output["estimated_pose"], expected["estimated_pose"], atol=1e-6)
+        assert output["db_match_idx"] == expected["db_match_idx"]
+
+
+def test_drop_newest_skips_frames(pipeline: LocalizationPipeline) -> None:
+    """Should drop the frames that arrive while the input queue is full and keep the stream order."""
+    release = threading.Event()
+    infer = pipeline.pr_pipe.infer
+
+    def slow_infer(input_data: Dict[str, Tensor], k: int = 1) -> Dict[str, np.ndarray]:
+        release.wait()
+        return infer(input_data, k=k)
+
+    pipeline.pr_pipe.infer = slow_infer
+
+    def frames() -> Iterator[Dict[str, Tensor]]:
+        yield from make_frames(10)
+        release.set()
+
+    runner = StreamingLocalizationRunner(pipeline, queue_size=1, drop_policy="drop_newest")
+    frame_idxs = [output["frame_idx"] for output in runner.run(frames())]
+    assert runner.num_dropped == 10 - len(frame_idxs)
+    assert runner.num_dropped >= 8
+    assert frame_idxs == sorted(frame_idxs)
+    assert frame_idxs[0] == 0
+
+
+def test_stage_error_is_raised(pipeline: LocalizationPipeline) -> None:
+    """Should stop the stream and raise the error of the failed stage."""
+
+    def failing_infer(input_data: Dict[str, Tensor], k: int = 1) -> Dict[str, np.ndarray]:
+        raise KeyError("boom")
+
+    pipeline.pr_pipe.infer = failing_infer
+    runner = StreamingLocalizationRunner(pipeline)
+    with pytest.raises(RuntimeError) as exc_info:
+        list(runner.run(make_frames(3)))
+    assert isinstance(exc_info.value.__cause__, KeyError)
+
+
+def test_invalid_arguments_raise(pipeline: LocalizationPipeline) -> None:
+    """Should raise ValueError for an unknown drop policy or a non-positive queue size."""
+    with pytest.raises(ValueError):
+        StreamingLocalizationRunner(pipeline, drop_policy="drop_all")
+    with pytest.raises(ValueError):
+        StreamingLocalizationRunner(pipeline, queue_size=0)
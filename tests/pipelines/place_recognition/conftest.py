@@ -0,0 +1,26 @@
+"""Place Recognition pipelines test fixtures."""
+from pathlib import Path
+
+import faiss
+import numpy as np
+import pandas as pd
+import pytest
+
+from opr.pipelines.place_recognition.database import POSE_COLUMNS
+
+
+@pytest.fixture
+def database_dir(tmp_path: Path) -> Path:
+    """Create a toy database with 5 places."""
+    descriptors = np.eye(5, 3, dtype=np.float32) + np.arange(5, dtype=np.float32)[:, None]
+    poses = np.zeros((5, 7))
+    poses[:, 0] = np.arange(5) * 10.0
+    poses[:, -1] = 1.0
+    track_df = pd.DataFrame(poses, columns=POSE_COLUMNS)
+    track_df.insert(0, "timestamp", np.arange(5) + 1000)
+    track_df.to_csv(tmp_path / "track.csv")
+    index = faiss.IndexFlatL2(descriptors.shape[1])
+    index.add(descriptors)
+    faiss.write_index(index, str(tmp_path / "index.faiss"))
+    np.save(tmp_path / "descriptors.npy", descriptors)
+    return tmp_path
@@ -0,0 +1,210 @@
+"""Test cases for opr.pipelines.place_recognition.base module."""
+from pathlib import Path
+
+import faiss
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+from opr.pipelines.place_recognition import PlaceRecognitionPipeline
+from opr.pipelines.place_recognition.database import INDEX_TYPES, POSE_COLUMNS, build_index
+from opr.profiling import StageProfiler
+from tests.utils import MeanColorModel, make_sample
+
+
+def test_infer_returns_nearest_place(database_dir: Path) -> None:
+    """Should return the index and pose of the nearest database place."""
+    descriptors = np.load(database_dir / "descriptors.npy")
+    pipe = PlaceRecognitionPipeline(database_dir, MeanColorModel(), device="cpu")
+    output = pipe.infer(make_sample(descriptors[3]))
+    assert output["idx"] == 3
+    np.testing.assert_allclose(output["pose"][:3], [30.0, 0.0, 0.0])
+    np.testing.assert_allclose(output["descriptor"], descriptors[3])
+
+
+def test_infer_batch_matches_single_inference(database_dir: Path) -> None:
+    """Should return the same results as per-sample inference for each query in the batch."""
+    descriptors = np.load(database_dir / "descriptors.npy")
+    pipe = PlaceRecognitionPipeline(database_dir, MeanColorModel(), device="cpu")
+    samples = [make_sample(descriptors[i]) for i in (4, 0, 2)]
+    output = pipe.infer_batch(samples)
+    assert output["idx"].shape == (3,)
+    assert output["pose"].shape == (3, 7)
+    assert output["descriptor"].shape == (3, 3)
+    for i, sample in enumerate(samples):
+        single_output = pipe.infer(sample)
+        assert output["idx"][i] == single_output["idx"]
+        np.testing.assert_allclose(output["pose"][i], single_output["pose"])
+
+
+def test_infer_batch_accepts_collated_input(database_dir: Path) -> None:
+    """Should accept a batch in the dataset collate_fn output format."""
+    descriptors = np.load(database_dir / "descriptors.npy")
+    pipe = PlaceRecognitionPipeline(database_dir, MeanColorModel(), device="cpu")
+    images = torch.stack([make_sample(descriptors[i])["image_front_cam"] for i in (1, 3)])
+    output = pipe.infer_batch({"images_front_cam": images, "idxs": torch.tensor([0, 1])})
+    np.testing.assert_array_equal(output["idx"], [1, 3])
+
+
+def test_infer_returns_topk_candidates(database_dir: Path) -> None:
+    """Should return top-k indices, L2 distances and poses sorted by distance."""
+    descriptors = np.load(database_dir / "descriptors.npy")
+    pipe = PlaceRecognitionPipeline(database_dir, MeanColorModel(), device="cpu")
+    output = pipe.infer(make_sample(descriptors[2]), k=3)
+    assert output["topk_idxs"].shape == (3,)
+    assert output["topk_poses"].shape == (3, 7)
+    assert output["topk_idxs"][0] == 2
+    expected_distances = np.linalg.norm(descriptors[output["topk_idxs"]] - descriptors[2], axis=1)
+    np.testing.assert_allclose(output["topk_distances"], expected_distances, atol=1e-5)
+    np.testing.assert_allclose(output["topk_poses"][:, 0], output["topk_idxs"] * 10.0)
+
+
+def test_mmap_database_matches_in_memory_database(database_dir: Path) -> None:
+    """Should give the same results with a memory-mapped database and create the poses file."""
+    descriptors = np.load(database_dir / "descriptors.npy")
+    pipe = PlaceRecognitionPipeline(database_dir, MeanColorModel(), device="cpu")
+    mmap_pipe = PlaceRecognitionPipeline(database_dir, MeanColorModel(), device="cpu", mmap_database=True)
+    assert (database_dir / "track_poses.npy").exists()
+    output = pipe.infer(make_sample(descriptors[1]), k=2)
+    mmap_output = mmap_pipe.infer(make_sample(descriptors[1]), k=2)
+    np.testing.assert_array_equal(output["topk_idxs"], mmap_output["topk_idxs"])
+    np.testing.assert_allclose(output["topk_poses"], mmap_output["topk_poses"])
+    assert len(mmap_pipe.database_df) == 5
+
+
+def test_mmap_quantized_database_supports_adding_places(database_dir: Path) -> None:
+    """Should search and update a memory-mapped int8 quantized database."""
+    descriptors = np.load(database_dir / "descriptors.npy")
+    faiss.write_index(build_index(descriptors, index_type="sq_int8"), str(database_dir / "index.faiss"))
+    pipe = PlaceRecognitionPipeline(database_dir, MeanColorModel(), device="cpu", mmap_database=True)
+    assert pipe.infer(make_sample(descriptors[2]))["idx"] == 2
+    new_descriptor = np.array([[2.0, 2.5, 2.0]], dtype=np.float32)
+    new_pose = np.array([[100.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0]])
+    new_ids = pipe.add_places(new_descriptor, new_pose)
+    assert pipe.infer(make_sample(new_descriptor[0]))["idx"] == new_ids[0]
+
+
+def test_add_places_makes_them_searchable(database_dir: Path) -> None:
+    """Should find a newly added place and return its pose."""
+    pipe = PlaceRecognitionPipeline(database_dir, MeanColorModel(), device="cpu")
+    new_descriptor = np.array([[10.0, 10.0, 10.0]], dtype=np.float32)
+    new_pose = np.array([[100.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0]])
+    new_ids = pipe.add_places(new_descriptor, new_pose, metadata=[{"timestamp": 2000}])
+    np.testing.assert_array_equal(new_ids, [5])
+    output = pipe.infer(make_sample(new_descriptor[0]))
+    assert output["idx"] == 5
+    np.testing.assert_allclose(output["pose"], new_pose[0])
+    assert len(pipe.database_df) == 6
+    assert pipe.database_df.index.is_unique
+    assert pipe.database_df.index[-1] == 5
+
+
+def test_add_places_after_removal_keeps_track_labels_unique(database_dir: Path, tmp_path: Path) -> None:
+    """Should label the added "track.csv" rows by the new ids, also after saving and loading."""
+    pipe = PlaceRecognitionPipeline(database_dir, MeanColorModel(), device="cpu")
+    pipe.remove_places([0, 1])
+    new_ids = pipe.add_places(np.full((2, 3), 10.0), np.tile([100.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0], (2, 1)))
+    np.testing.assert_array_equal(pipe.database_df.index, [2, 3, 4, 5, 6])
+    pipe.save_database(tmp_path / "updated_database")
+    loaded_pipe = PlaceRecognitionPipeline(tmp_path / "updated_database", MeanColorModel(), device="cpu")
+    assert loaded_pipe.database_df.index.is_unique
+    np.testing.assert_array_equal(loaded_pipe.database_df.index[-2:], new_ids)
+
+
+def test_remove_places_from_hnsw_database_raises(database_dir: Path) -> None:
+    """Should raise ValueError instead of the faiss error for the HNSW database."""
+    descriptors = np.load(database_dir / "descriptors.npy")
+    faiss.write_index(build_index(descriptors, index_type="hnsw"), str(database_dir / "index.faiss"))
+    pipe = PlaceRecognitionPipeline(database_dir, MeanColorModel(), device="cpu")
+    pipe.add_places(np.full((1, 3), 10.0), np.array([[100.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0]]))
+    with pytest.raises(ValueError):
+        pipe.remove_places([0])
+    assert len(pipe.database_ids) == 6
+
+
+def test_remove_places_keeps_ids_stable(database_dir: Path) -> None:
+    """Should not return removed places and keep the ids of the remaining ones."""
+    descriptors = np.load(database_dir / "descriptors.npy")
+    pipe = PlaceRecognitionPipeline(database_dir, MeanColorModel(), device="cpu")
+    assert pipe.remove_places([1, 2]) == 2
+    np.testing.assert_array_equal(pipe.database_ids, [0, 3, 4])
+    output = pipe.infer(make_sample(descriptors[4]), k=3)
+    assert output["idx"] == 4
+    assert 1 not in output["topk_idxs"] and 2 not in output["topk_idxs"]
+    np.testing.assert_allclose(output["pose"][:3], [40.0, 0.0, 0.0])
+
+
+def test_save_database_persists_changes(database_dir: Path, tmp_path: Path) -> None:
+    """Should restore the modified database from disk."""
+    descriptors = np.load(database_dir / "descriptors.npy")
+    pipe = PlaceRecognitionPipeline(database_dir, MeanColorModel(), device="cpu")
+    pipe.remove_places([0])
+    pipe.add_places(np.full((1, 3), 10.0), np.array([[100.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0]]))
+    out_dir = tmp_path / "updated_database"
+    pipe.save_database(out_dir)
+    for mmap_database in (False, True):
+        loaded_pipe = PlaceRecognitionPipeline(
+            out_dir, MeanColorModel(), device="cpu", mmap_database=mmap_database
+        )
+        np.testing.assert_array_equal(loaded_pipe.database_ids, [1, 2, 3, 4, 5])
+        output = loaded_pipe.infer(make_sample(descriptors[3]))
+        assert output["idx"] == 3
+        np.testing.assert_allclose(output["pose"][:3], [30.0, 0.0, 0.0])
+
+
+def test_infer_with_prior_pose_searches_only_nearby_places(database_dir: Path) -> None:
+    """Should return the best match among the places within the search radius of the prior pose."""
+    descriptors = np.load(database_dir / "descriptors.npy")
+    pipe = PlaceRecognitionPipeline(database_dir, MeanColorModel(), device="cpu")
+    prior_pose = np.array([0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0])
+    output = pipe.infer(make_sample(descriptors[4]), k=3, prior_pose=prior_pose, search_radius=15.0)
+    assert output["idx"] == 1
+    np.testing.assert_array_equal(output["topk_idxs"], [1, 0, -1])
+    assert np.isinf(output["topk_distances"][-1])
+    assert np.isnan(output["topk_poses"][-1]).all()
+
+
+def test_infer_with_prior_pose_far_from_database_searches_everything(database_dir: Path) -> None:
+    """Should fall back to the global search if there are no places within the search radius."""
+    descriptors = np.load(database_dir / "descriptors.npy")
+    pipe = PlaceRecognitionPipeline(database_dir, MeanColorModel(), device="cpu")
+    prior_pose = np.array([1000.0, 0.0, 0.0])
+    output = pipe.infer(make_sample(descriptors[4]), prior_pose=prior_pose, search_radius=15.0)
+    assert output["idx"] == 4
+
+
+def test_profiler_records_pipeline_stages(database_dir: Path) -> None:
+    """Should record the preprocessing, forward and search stages of every query."""
+    profiler = StageProfiler()
+    pipe = PlaceRecognitionPipeline(database_dir, MeanColorModel(), device="cpu", profiler=profiler)
+    pipe.infer(make_sample(np.array([1.0, 1.0, 1.0])))
+    pipe.infer_batch([make_sample(np.array([1.0, 1.0, 1.0]))] * 2)
+    summary = profiler.summary()
+    for stage in ("preprocess", "forward", "search"):
+        assert summary[f"place_recognition/{stage}"]["count"] == 2
+
+
+@pytest.mark.parametrize("index_type", INDEX_TYPES)
+@pytest.mark.parametrize("add_places", [False, True])
+def test_infer_with_prior_pose_supports_all_index_types(
+    tmp_path: Path, index_type: str, add_places: bool
+) -> None:
+    """Should search only the nearby places with every index type, also after the ids mapping is added."""
+    rng = np.random.default_rng(0)
+    descriptors = rng.random((400, 16), dtype=np.float32)
+    poses = np.zeros((400, 7))
+    poses[:, 0] = np.arange(400)
+    poses[:, -1] = 1.0
+    pd.DataFrame(poses, columns=POSE_COLUMNS).to_csv(tmp_path / "track.csv")
+    index = build_index(descriptors, index_type=index_type, nlist=4, pq_m=4)
+    faiss.write_index(index, str(tmp_path / "index.faiss"))
+    pipe = PlaceRecognitionPipeline(tmp_path, MeanColorModel(), device="cpu")
+    if add_places:
+        new_poses = poses[:4].copy()
+        new_poses[:, 0] += 1000.0
+        pipe.add_places(rng.random((4, 16), dtype=np.float32), new_poses)
+    image = torch.tensor(descriptors[150])[:, None, None].expand(16, 8, 8).clone()
+    output = pipe.infer({"image_front_cam": image}, k=5, prior_pose=poses[100], search_radius=10.5)
+    assert np.all((output["topk_idxs"] >= 90) & (output["topk_idxs"] <= 110))
+    assert np.isfinite(output["topk_distances"]).all()
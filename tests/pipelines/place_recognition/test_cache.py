@@ -0,0 +1,52 @@
+"""Test cases for opr.pipelines.place_recognition.cache module."""
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from opr.pipelines.place_recognition import PlaceRecognitionPipeline
+from opr.pipelines.place_recognition.cache import QueryCache, input_checksum
+from tests.utils import MeanColorModel, make_sample
+
+
+def test_query_cache_matches_within_tolerance() -> None:
+    """Should return cached results for close descriptors with the same params and evict old entries."""
+    cache = QueryCache(max_size=2, tolerance=0.1)
+    cache.put(np.zeros(3), 1, {"idx": 0})
+    cache.put(np.ones(3), 1, {"idx": 1})
+    assert cache.get(np.full(3, 0.01), 1) == {"idx": 0}
+    assert cache.get(np.full(3, 0.01), 2) is None
+    assert cache.get(np.full(3, 0.5), 1) is None
+    cache.put(np.full(3, 2.0), 1, {"idx": 2})  # evicts the least recently used entry
+    assert cache.get(np.ones(3), 1) is None
+    assert cache.get(np.zeros(3), 1) == {"idx": 0}
+    assert cache.stats == {"hits": 2, "misses": 3, "input_hits": 0, "input_misses": 0}
+
+
+def test_input_checksum_depends_on_contents() -> None:
+    """Should give equal checksums for equal inputs only."""
+    image = torch.rand(3, 8, 8)
+    assert input_checksum({"image_front_cam": image}) == input_checksum({"image_front_cam": image.clone()})
+    assert input_checksum({"image_front_cam": image}) != input_checksum({"image_front_cam": image + 1e-3})
+
+
+def test_pipeline_reuses_cached_results(database_dir: Path) -> None:
+    """Should skip the model and the search for repeated queries and invalidate on database changes."""
+    descriptors = np.load(database_dir / "descriptors.npy")
+    model = MeanColorModel()
+    pipe = PlaceRecognitionPipeline(database_dir, model, query_cache_size=4, query_cache_inputs=True)
+    num_forwards = []
+    model.register_forward_hook(lambda *_: num_forwards.append(1))
+    sample = make_sample(descriptors[3])
+    first_output = pipe.infer(sample)
+    output = pipe.infer(sample)
+    assert len(num_forwards) == 1
+    assert output["idx"] == first_output["idx"] == 3
+    output = pipe.infer(make_sample(descriptors[3] + 1e-4))
+    assert len(num_forwards) == 2
+    assert output["idx"] == 3
+    assert pipe.query_cache.stats == {"hits": 2, "misses": 1, "input_hits": 1, "input_misses": 2}
+    assert pipe.infer(sample, k=2)["topk_idxs"].shape == (2,)
+    assert pipe.query_cache.misses == 2
+    pipe.remove_places([3])
+    assert pipe.infer(sample)["idx"] == 2
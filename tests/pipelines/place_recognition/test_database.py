@@ -0,0 +1,52 @@
+"""Test cases for opr.pipelines.place_recognition.database module."""
+import numpy as np
+import pytest
+
+from opr.pipelines.place_recognition.database import (
+    INDEX_TYPES,
+    build_index,
+    evaluate_index_recall,
+    evaluate_quantization,
+    make_index_factory_string,
+    set_search_params,
+)
+
+
+@pytest.mark.parametrize("index_type", INDEX_TYPES)
+def test_build_index_contains_all_descriptors(index_type: str) -> None:
+    """Should build a trained index of every supported type with all descriptors added."""
+    rng = np.random.default_rng(42)
+    descriptors = rng.random((2000, 32), dtype=np.float32)
+    index = build_index(descriptors, index_type=index_type, nlist=16, pq_m=8, pq_nbits=4, hnsw_m=16)
+    set_search_params(index, nprobe=16, ef_search=64)
+    assert index.is_trained
+    assert index.ntotal == 2000
+
+
+def test_make_index_factory_string_rejects_invalid_pq_m() -> None:
+    """Should raise ValueError if the descriptor dimension is not divisible by pq_m."""
+    with pytest.raises(ValueError):
+        make_index_factory_string("ivf_pq", dim=30, pq_m=16)
+
+
+def test_evaluate_index_recall_of_flat_index_is_exact() -> None:
+    """Should report perfect recall for the flat index."""
+    rng = np.random.default_rng(42)
+    descriptors = rng.random((500, 16), dtype=np.float32)
+    index = build_index(descriptors, index_type="flat")
+    report = evaluate_index_recall(index, descriptors, queries=descriptors[:50], k=5)
+    assert report["recall@1"] == 1.0
+    assert report["recall@k"] == 1.0
+
+
+def test_evaluate_quantization_reports_compression() -> None:
+    """Should report smaller quantized indexes with near-lossless fp16 storage."""
+    rng = np.random.default_rng(42)
+    descriptors = rng.random((1000, 32), dtype=np.float32)
+    reports = evaluate_quantization(descriptors, train_descriptors=descriptors[:300], pq_m=8, pq_nbits=4, k=5)
+    assert set(reports) == {"sq_fp16", "sq_int8", "pq"}
+    assert reports["sq_fp16"]["compression"] > 1.9
+    assert reports["sq_int8"]["compression"] > 3.5
+    assert reports["pq"]["compression"] > reports["sq_int8"]["compression"]
+    assert reports["sq_fp16"]["recall@1"] == 1.0
+    assert reports["sq_fp16"]["reconstruction_mse"] < reports["sq_int8"]["reconstruction_mse"]
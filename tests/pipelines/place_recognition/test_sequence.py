@@ -0,0 +1,139 @@
+"""Test cases for opr.pipelines.place_recognition.sequence module."""
+from pathlib import Path
+
+import faiss
+import numpy as np
+import pandas as pd
+import pytest
+
+from opr.pipelines.place_recognition import SequencePlaceRecognitionPipeline
+from opr.pipelines.place_recognition.database import POSE_COLUMNS, build_index
+from tests.utils import MeanColorModel, make_sample
+
+
+@pytest.fixture
+def track_database_dir(tmp_path: Path) -> Path:
+    """Create a toy database with 10 places along a track, the last one aliased with the 6th one."""
+    descriptors = np.zeros((10, 3), dtype=np.float32)
+    descriptors[:, 0] = np.arange(10)
+    descriptors[9, 0] = 6.3
+    poses = np.zeros((10, 7))
+    poses[:, 0] = np.arange(10) * 10.0
+    poses[:, -1] = 1.0
+    pd.DataFrame(poses, columns=POSE_COLUMNS).to_csv(tmp_path / "track.csv")
+    index = faiss.IndexFlatL2(descriptors.shape[1])
+    index.add(descriptors)
+    faiss.write_index(index, str(tmp_path / "index.faiss"))
+    return tmp_path
+
+
+def make_query(value: float) -> dict:
+    """Make a query sample with the given first descriptor component."""
+    return make_sample(np.array([value, 0.0, 0.0]))
+
+
+def test_sequence_resolves_perceptual_aliasing(track_database_dir: Path) -> None:
+    """Should match the place that the whole query sequence agrees with."""
+    pipe = SequencePlaceRecognitionPipeline(track_database_dir, MeanColorModel(), sequence_length=5)
+    for value in (2.0, 3.0, 4.0, 5.0):
+        pipe.infer(make_query(value))
+    output = pipe.infer(make_query(6.2), k=2)
+    assert output["idx"] == 6
+    assert output["sequence_length"] == 5
+    np.testing.assert_allclose(output["pose"][:3], [60.0, 0.0, 0.0])
+    np.testing.assert_allclose(output["topk_distances"][0], 0.04, atol=1e-5)
+    np.testing.assert_allclose(output["sequence_descriptor"], [4.04, 0.0, 0.0], atol=1e-5)
+
+
+def test_buffer_keeps_last_queries_only(track_database_dir: Path) -> None:
+    """Should forget queries older than the sequence length and after reset."""
+    pipe = SequencePlaceRecognitionPipeline(track_database_dir, MeanColorModel(), sequence_length=2)
+    for value in (0.0, 9.0, 5.0):
+        pipe.infer(make_query(value))
+    output = pipe.infer(make_query(6.2))
+    assert output["sequence_length"] == 2
+    assert output["idx"] == 6
+    pipe.reset()
+    output = pipe.infer(make_query(6.2))
+    assert output["sequence_length"] == 1
+    assert output["idx"] == 9
+
+
+def test_negative_velocity_matches_reverse_traversal(track_database_dir: Path) -> None:
+    """Should match the database track traversed backwards when negative velocity is allowed."""
+    pipe = SequencePlaceRecognitionPipeline(
+        track_database_dir, MeanColorModel(), sequence_length=3, velocities=(1.0, -1.0)
+    )
+    for value in (8.0, 7.0, 6.2):
+        output = pipe.infer(make_query(value))
+    assert output["idx"] == 6
+
+
+@pytest.mark.parametrize("mmap_database", [False, True])
+def test_distances_are_read_from_index_in_chunks(track_database_dir: Path, mmap_database: bool) -> None:
+    """Should decode the descriptors once in RAM or read the memory-mapped ones by chunks on every query."""
+    pipe = SequencePlaceRecognitionPipeline(
+        track_database_dir, MeanColorModel(), mmap_database=mmap_database, distances_chunk_size=3
+    )
+    assert (pipe._database_vectors is None) == mmap_database
+    descriptors = faiss.read_index(str(track_database_dir / "index.faiss")).reconstruct_n(0, 10)
+    query = np.array([6.2, 0.0, 0.0], dtype=np.float32)
+    np.testing.assert_allclose(
+        pipe._compute_database_distances(query), np.linalg.norm(descriptors - query, axis=1), atol=1e-4
+    )
+
+
+def test_prior_pose_restricts_sequence_ends(track_database_dir: Path) -> None:
+    """Should score only the sequences ending within the search radius of the prior pose."""
+    pipe = SequencePlaceRecognitionPipeline(track_database_dir, MeanColorModel(), sequence_length=1)
+    assert pipe.infer(make_query(6.2))["idx"] == 9
+    pipe.reset()
+    output = pipe.infer(make_query(6.2), k=2, prior_pose=np.array([60.0, 0.0, 0.0]), search_radius=5.0)
+    assert output["idx"] == 6
+    np.testing.assert_array_equal(output["topk_idxs"], [6, -1])
+    assert np.isinf(output["topk_distances"][1])
+    assert np.isnan(output["topk_poses"][1]).all()
+    with pytest.raises(ValueError):
+        pipe.infer(make_query(6.2), prior_pose=np.array([60.0, 0.0, 0.0]))
+
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf_flat", "pq"])
+def test_sequence_supports_modifying_compressed_databases(tmp_path: Path, index_type: str) -> None:
+    """Should match the queries after adding and removing places for the IVF and quantized databases."""
+    descriptors = np.random.default_rng(0).random((400, 3), dtype=np.float32) * 10.0
+    poses = np.zeros((400, 7))
+    poses[:, 0] = np.arange(400)
+    poses[:, -1] = 1.0
+    pd.DataFrame(poses, columns=POSE_COLUMNS).to_csv(tmp_path / "track.csv")
+    faiss.write_index(
+        build_index(descriptors, index_type=index_type, nlist=4, pq_m=3), str(tmp_path / "index.faiss")
+    )
+    pipe = SequencePlaceRecognitionPipeline(tmp_path, MeanColorModel(), sequence_length=1)
+    new_ids = pipe.add_places(np.full((1, 3), 20.0), poses[:1])
+    assert pipe.remove_places([0]) == 1
+    assert pipe.infer(make_query(20.0))["sequence_length"] == 1
+    output = pipe.infer(make_sample(np.full(3, 20.0)))
+    assert output["idx"] == new_ids[0]
+
+
+@pytest.mark.parametrize("mmap_database", [False, True])
+def test_save_database_keeps_ivf_direct_map_type(tmp_path: Path, mmap_database: bool) -> None:
+    """Should save the IVF index with its original direct map type after the places are modified."""
+    descriptors = np.random.default_rng(0).random((400, 3), dtype=np.float32) * 10.0
+    poses = np.zeros((400, 7))
+    poses[:, -1] = 1.0
+    database_dir = tmp_path / "database"
+    database_dir.mkdir()
+    pd.DataFrame(poses, columns=POSE_COLUMNS).to_csv(database_dir / "track.csv")
+    faiss.write_index(
+        build_index(descriptors, index_type="ivf_flat", nlist=4), str(database_dir / "index.faiss")
+    )
+    pipe = SequencePlaceRecognitionPipeline(
+        database_dir, MeanColorModel(), sequence_length=1, mmap_database=mmap_database
+    )
+    new_ids = pipe.add_places(np.full((1, 3), 20.0), poses[:1])
+    pipe.save_database(tmp_path / "saved")
+    saved_index = faiss.extract_index_ivf(faiss.read_index(str(tmp_path / "saved" / "index.faiss")))
+    assert saved_index.direct_map.type == faiss.DirectMap.NoMap
+    assert saved_index.ntotal == 401
+    assert pipe.infer(make_sample(np.full(3, 20.0)))["idx"] == new_ids[0]
@@ -0,0 +1,121 @@
+"""Test cases for opr.pipelines.place_recognition.sharded module."""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import faiss
+import numpy as np
+import pandas as pd
+import pytest
+
+from opr.pipelines.place_recognition import ShardedPlaceRecognitionPipeline
+from opr.pipelines.place_recognition.database import POSE_COLUMNS
+from tests.utils import MeanColorModel, make_sample
+
+
+def write_shard(shard_dir: Path, descriptors: np.ndarray, x_offset: float) -> None:
+    """Write a database shard with places every 10 meters along the x axis."""
+    shard_dir.mkdir(parents=True)
+    poses = np.zeros((len(descriptors), 7))
+    poses[:, 0] = x_offset + np.arange(len(descriptors)) * 10.0
+    poses[:, -1] = 1.0
+    pd.DataFrame(poses, columns=POSE_COLUMNS).to_csv(shard_dir / "track.csv")
+    index = faiss.IndexFlatL2(descriptors.shape[1])
+    index.add(descriptors.astype(np.float32))
+    faiss.write_index(index, str(shard_dir / "index.faiss"))
+
+
+@pytest.fixture
+def sharded_database_dir(tmp_path: Path) -> Path:
+    """Create a toy database with two floor shards of 3 places each."""
+    write_shard(tmp_path / "floor_1", np.array([[0, 0, 0], [1, 0, 0], [2, 0, 0]]), x_offset=0.0)
+    write_shard(tmp_path / "floor_2", np.array([[0, 1, 0], [1, 1, 0], [2, 1, 0]]), x_offset=100.0)
+    return tmp_path
+
+
+def test_infer_merges_shards_results(sharded_database_dir: Path) -> None:
+    """Should merge the top-k candidates of all shards by distance and join the search threads."""
+    num_threads = threading.active_count()
+    pipe = ShardedPlaceRecognitionPipeline(sharded_database_dir, MeanColorModel(), num_threads=2)
+    assert pipe.shard_names == ["floor_1", "floor_2"]
+    assert pipe.loaded_shard_names == []
+    output = pipe.infer(make_sample(np.array([1.0, 0.9, 0.0])), k=3)
+    assert threading.active_count() == num_threads  # the search threads do not outlive the call
+    assert output["shard"] == "floor_2"
+    assert output["idx"] == 1
+    np.testing.assert_allclose(output["pose"][:3], [110.0, 0.0, 0.0])
+    assert list(output["topk_shards"]) == ["floor_2", "floor_1", "floor_2"]
+    np.testing.assert_array_equal(output["topk_idxs"], [1, 1, 0])
+    np.testing.assert_allclose(output["topk_distances"], [0.1, 0.9, np.sqrt(1.01)], atol=1e-5)
+
+
+def test_infer_searches_selected_shards_only(sharded_database_dir: Path) -> None:
+    """Should search and load only the selected shards."""
+    pipe = ShardedPlaceRecognitionPipeline(sharded_database_dir, MeanColorModel())
+    output = pipe.infer(make_sample(np.array([2.0, 1.0, 0.0])), k=4, shards=["floor_1"])
+    assert output["shard"] == "floor_1"
+    assert output["idx"] == 2
+    assert output["topk_shards"][-1] is None
+    assert output["topk_idxs"][-1] == -1
+    assert pipe.loaded_shard_names == ["floor_1"]
+
+
+def test_shards_are_evicted_under_memory_budget(sharded_database_dir: Path) -> None:
+    """Should keep only the most recently used shard if the budget fits one shard."""
+    pipe = ShardedPlaceRecognitionPipeline(sharded_database_dir, MeanColorModel(), memory_budget=1)
+    sample = make_sample(np.array([0.0, 0.0, 0.0]))
+    pipe.infer(sample, shards=["floor_2"])
+    pipe.infer(sample, shards=["floor_1"])
+    assert pipe.loaded_shard_names == ["floor_1"]
+    assert pipe.infer(sample, shards=["floor_2"])["shard"] == "floor_2"
+
+
+def test_prior_pose_prunes_shards(sharded_database_dir: Path) -> None:
+    """Should search only the places near the prior pose and fall back to all places if there are none."""
+    pipe = ShardedPlaceRecognitionPipeline(sharded_database_dir, MeanColorModel())
+    sample = make_sample(np.array([1.0, 0.9, 0.0]))
+    output = pipe.infer(sample, prior_pose=np.array([5.0, 0.0, 0.0]), search_radius=6.0)
+    assert output["shard"] == "floor_1"
+    assert output["idx"] == 1
+    output = pipe.infer(sample, prior_pose=np.array([-500.0, 0.0, 0.0]), search_radius=6.0)
+    assert output["shard"] == "floor_2"
+
+
+def test_prior_pose_falls_back_per_query(sharded_database_dir: Path) -> None:
+    """Should fall back to the global search only for the queries without places near their prior poses."""
+    pipe = ShardedPlaceRecognitionPipeline(sharded_database_dir, MeanColorModel())
+    samples = [make_sample(np.array([1.0, 0.9, 0.0]))] * 2
+    prior_poses = np.array([[5.0, 0.0, 0.0], [-500.0, 0.0, 0.0]])
+    output = pipe.infer_batch(samples, prior_poses=prior_poses, search_radius=6.0)
+    assert list(output["shard"]) == ["floor_1", "floor_2"]
+    np.testing.assert_array_equal(output["idx"], [1, 1])
+
+
+def test_modifications_are_routed_to_shards(sharded_database_dir: Path, tmp_path: Path) -> None:
+    """Should add, remove and save the places of the given shard."""
+    pipe = ShardedPlaceRecognitionPipeline(sharded_database_dir, MeanColorModel(), memory_budget=1)
+    new_pose = np.array([[200.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0]])
+    with pytest.raises(ValueError):
+        pipe.add_places(np.array([[5.0, 5.0, 5.0]]), new_pose)
+    new_ids = pipe.add_places(np.array([[5.0, 5.0, 5.0]]), new_pose, shard="floor_2")
+    assert pipe.remove_places([0], shard="floor_2") == 1
+    sample = make_sample(np.array([5.0, 5.0, 5.0]))
+    pipe.infer(sample, shards=["floor_1"])
+    assert "floor_2" in pipe.loaded_shard_names  # modified shards are not evicted
+    out_dir = tmp_path / "updated_database"
+    pipe.save_database(out_dir)
+    loaded_pipe = ShardedPlaceRecognitionPipeline(out_dir, MeanColorModel())
+    assert loaded_pipe.shard_names == ["floor_1", "floor_2"]
+    output = loaded_pipe.infer(sample, k=4)
+    assert output["shard"] == "floor_2"
+    assert output["idx"] == new_ids[0]
+    assert 0 not in output["topk_idxs"][output["topk_shards"] == "floor_2"]
+
+
+def test_concurrent_get_shard_loads_shard_once(sharded_database_dir: Path) -> None:
+    """Should load a shard once when it is requested from several threads at the same time."""
+    pipe = ShardedPlaceRecognitionPipeline(sharded_database_dir, MeanColorModel())
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        shards = list(executor.map(pipe.get_shard, ["floor_1"] * 8))
+    assert all(shard is shards[0] for shard in shards)
+    assert pipe.loaded_shard_names == ["floor_1"]
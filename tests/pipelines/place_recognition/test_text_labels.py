@@ -0,0 +1,91 @@
+"""Test cases for opr.pipelines.place_recognition.text_labels module."""
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+from fuzzywuzzy import fuzz
+
+from opr.pipelines.place_recognition.text_labels import (
+    TextLabelsIndex,
+    TextLabelsPlaceRecognitionPipeline,
+    char_ngrams,
+)
+from tests.utils import MeanColorModel, make_sample
+
+FRAMES = {
+    "1000": ["Exit", "Room 101"],
+    "1001": ["Cafe", "Library"],
+    "1002": ["Room 102", "Stairs"],
+    "1003": ["Library", "Room 101"],
+    "1004": [],
+}
+
+
+def test_char_ngrams_pads_words() -> None:
+    """Should split the words into n-grams padded with spaces."""
+    assert char_ngrams("ab cde") == {" ab", "ab ", " cd", "cde", "de "}
+    assert char_ngrams("") == set()
+
+
+@pytest.mark.parametrize(
+    "query", [["room 101"], ["libary"], ["cafe", "library"], ["stairs", "room 102"], ["zzz"], []]
+)
+def test_search_matches_brute_force(query: list) -> None:
+    """Should find the same best match as scoring all frames."""
+    index = TextLabelsIndex(FRAMES)
+    best_id, best_labels, similarity = index.search(query)
+    scores = [fuzz.token_set_ratio(" ".join(query), " ".join(labels)) for labels in FRAMES.values()]
+    if max(scores) == 0:
+        assert (best_id, best_labels, similarity) == (None, None, 0)
+    else:
+        assert best_id == list(FRAMES)[int(np.argmax(scores))]
+        assert best_labels == FRAMES[best_id]
+        assert abs(similarity - max(scores)) <= 1
+
+
+def test_shortlist_skips_frames_without_common_ngrams() -> None:
+    """Should shortlist only the frames that share n-grams with the query, at most max_candidates."""
+    index = TextLabelsIndex(FRAMES)
+    np.testing.assert_array_equal(index.shortlist("library"), [1, 3])
+    np.testing.assert_array_equal(index.shortlist("room 101", max_candidates=2), [0, 3])
+
+
+def write_labels(database_dir: Path) -> Path:
+    """Write the FRAMES labels of the front camera and a common back camera label to the database."""
+    db_labels = {
+        timestamp: {
+            "front_cam_anno": [{"value": {"text": labels}}],
+            "back_cam_anno": [{"value": {"text": ["МФТИ"]}}],
+        }
+        for timestamp, labels in FRAMES.items()
+    }
+    labels_path = database_dir / "labels.json"
+    with open(labels_path, "w") as f:
+        json.dump(json.dumps(db_labels), f)
+    return labels_path
+
+
+def test_pipeline_uses_text_labels(database_dir: Path) -> None:
+    """Should return the database frame with the most similar labels if the similarity is high enough."""
+    labels_path = write_labels(database_dir)
+    pipe = TextLabelsPlaceRecognitionPipeline(labels_path, database_dir, MeanColorModel(), device="cpu")
+    descriptors = np.load(database_dir / "descriptors.npy")
+    output = pipe.infer(make_sample(descriptors[0]), query_labels=["  Stairs", "Room 102", "мфти"])
+    assert output["idx"] == 2
+    output = pipe.infer(make_sample(descriptors[0]), query_labels=["zzz"])
+    assert output["idx"] == 0
+
+
+def test_pipeline_returns_place_ids_after_removal(database_dir: Path) -> None:
+    """Should return the stable place ids and their poses in both branches after places are removed."""
+    labels_path = write_labels(database_dir)
+    pipe = TextLabelsPlaceRecognitionPipeline(labels_path, database_dir, MeanColorModel(), device="cpu")
+    pipe.remove_places([0, 1])
+    descriptors = np.load(database_dir / "descriptors.npy")
+    output = pipe.infer(make_sample(descriptors[0]), query_labels=["Stairs", "Room 102"])
+    assert output["idx"] == 2
+    np.testing.assert_allclose(output["pose"][:3], [20.0, 0.0, 0.0])
+    output = pipe.infer(make_sample(descriptors[4]), query_labels=["zzz"])
+    assert output["idx"] == 4
+    np.testing.assert_allclose(output["pose"][:3], [40.0, 0.0, 0.0])
@@ -0,0 +1,85 @@
+"""Test cases for the GeoTransformer neighbor limits calibration in opr.pipelines.registration.pointcloud."""
+from typing import Any, List, Tuple
+
+import pytest
+import torch
+from hydra.utils import instantiate
+from torch import Tensor
+
+from tests.utils import load_config
+
+pytest.importorskip("geotransformer.modules.geotransformer")
+
+from opr.models.registration.geotransformer import GeoTransformer  # noqa: E402
+from opr.pipelines.registration import PointcloudRegistrationPipeline  # noqa: E402
+
+CONFIG_PATH = "configs/model/registration/geotransformer_kitti.yaml"
+
+
+def make_model() -> GeoTransformer:
+    """Instantiate the GeoTransformer model with random weights."""
+    return instantiate(load_config(CONFIG_PATH)).eval()
+
+
+def make_pairs(num_pairs: int = 2) -> List[Tuple[Tensor, Tensor]]:
+    """Make toy query and database pointclouds pairs shifted by 1 m."""
+    generator = torch.Generator().manual_seed(0)
+    pairs = []
+    for _ in range(num_pairs):
+        db_pc = torch.rand((3000, 3), generator=generator) * torch.tensor([30.0, 30.0, 5.0])
+        pairs.append((db_pc + torch.tensor([1.0, 0.0, 0.0]), db_pc))
+    return pairs
+
+
+def test_calibrate_stores_neighbor_limits() -> None:
+    """Should calibrate the neighbor limits on the downsampled pairs and store them in the buffer."""
+    model = make_model()
+    assert not model.is_calibrated
+    pipe = PointcloudRegistrationPipeline(model, device="cpu", voxel_downsample_size=0.3)
+    pairs = make_pairs()
+    pipe.calibrate(pairs)
+    assert model.is_calibrated
+    assert model.neighbor_limits.shape == (model.backbone_cfg.num_stages,)
+    expected = model._calibrate_neighbors(
+        [
+            model._make_data_dict(pipe._downsample_pointcloud(query_pc), pipe._downsample_pointcloud(db_pc))
+            for query_pc, db_pc in pairs
+        ]
+    )
+    torch.testing.assert_close(model.neighbor_limits, expected)
+    torch.testing.assert_close(model.state_dict()["neighbor_limits"], expected)
+
+
+def test_calibrated_model_skips_per_pair_calibration(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Should reuse the stored neighbor limits instead of calibrating every registered pair."""
+    model = make_model()
+    pipe = PointcloudRegistrationPipeline(model, device="cpu", voxel_downsample_size=0.3)
+    pairs = make_pairs()
+    pipe.calibrate(pairs)
+
+    def fail_calibrate(*args: Any, **kwargs: Any) -> Tensor:
+        raise AssertionError("the calibrated model must not calibrate the neighbor limits again")
+
+    monkeypatch.setattr(model, "_calibrate_neighbors", fail_calibrate)
+    query_pc, db_pc = pairs[0]
+    data_dict = model._preprocess_input(
+        pipe._downsample_pointcloud(query_pc), pipe._downsample_pointcloud(db_pc)
+    )
+    assert len(data_dict["neighbors"]) == model.backbone_cfg.num_stages
+
+
+def test_state_dict_without_neighbor_limits_loads_uncalibrated() -> None:
+    """Should load the weights saved before the calibration as an uncalibrated model."""
+    model = make_model()
+    PointcloudRegistrationPipeline(model, device="cpu", voxel_downsample_size=0.3).calibrate(make_pairs(1))
+    state_dict = model.state_dict()
+
+    calibrated_model = make_model()
+    calibrated_model.load_state_dict(state_dict)
+    torch.testing.assert_close(calibrated_model.neighbor_limits, model.neighbor_limits)
+
+    del state_dict["neighbor_limits"]
+    old_model = make_model()
+    old_model.load_state_dict(state_dict)
+    assert not old_model.is_calibrated
+    assert (old_model.neighbor_limits == 0).all()
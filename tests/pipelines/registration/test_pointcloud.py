@@ -0,0 +1,273 @@
+"""Test cases for opr.pipelines.registration.pointcloud module."""
+import threading
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import pytest
+import torch
+from torch import Tensor
+
+from opr.pipelines.registration import (
+    PointcloudRegistrationPipeline,
+    RansacGlobalRegistrationPipeline,
+    SequencePointcloudRegistrationPipeline,
+)
+from opr.pipelines.registration.pointcloud import voxel_downsample_pointcloud
+from tests.utils import CentroidRegistrationModel
+
+
+def reference_voxel_downsample(
+    points: np.ndarray, voxel_size: float, voxel_min_bound: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Voxel downsample the points with a loop over the voxel grid, sorted by coordinates.
+
+    Args:
+        points (np.ndarray): Points array of shape (N, 3).
+        voxel_size (float): Voxel size.
+        voxel_min_bound (np.ndarray, optional): Voxel grid origin. If None, the Open3D one is used:
+            half a voxel below the minimum point. Defaults to None.
+
+    Returns:
+        np.ndarray: Voxel centroids sorted by coordinates.
+    """
+    if voxel_min_bound is None:
+        voxel_min_bound = points.min(axis=0) - voxel_size * 0.5
+    voxels = defaultdict(list)
+    for point in points:
+        voxels[tuple(np.floor((point - voxel_min_bound) / voxel_size).astype(int))].append(point)
+    centroids = np.array([np.mean(voxel_points, axis=0) for voxel_points in voxels.values()])
+    return centroids[np.lexsort(centroids.T[::-1])]
+
+
+def sort_points(points: np.ndarray) -> np.ndarray:
+    """Sort the points by coordinates."""
+    return points[np.lexsort(points.T[::-1])]
+
+
+@pytest.mark.parametrize("voxel_size", [0.05, 0.3, 2.0])
+def test_torch_backend_matches_reference(voxel_size: float) -> None:
+    """Should pool the points of each Open3D grid voxel into their centroid."""
+    points = np.random.default_rng(0).normal(scale=3.0, size=(2000, 3)).astype(np.float32)
+    downsampled = voxel_downsample_pointcloud(torch.from_numpy(points), voxel_size, backend="torch")
+    assert downsampled.dtype == torch.float32
+    np.testing.assert_allclose(
+        sort_points(downsampled.numpy()),
+        reference_voxel_downsample(points.astype(np.float64), voxel_size),
+        atol=1e-5,
+    )
+
+
+def test_torch_backend_matches_open3d_backend() -> None:
+    """Should return the same points as the Open3D backend up to the order."""
+    points = torch.rand((1000, 3)) * 10.0
+    torch_points = voxel_downsample_pointcloud(points, 0.5, backend="torch").numpy()
+    open3d_points = voxel_downsample_pointcloud(points, 0.5, backend="open3d").numpy()
+    np.testing.assert_allclose(sort_points(torch_points), sort_points(open3d_points), atol=1e-5)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is not available")
+def test_torch_backend_downsamples_on_pipeline_device() -> None:
+    """Should move the CPU pointcloud to the pipeline device before downsampling."""
+    pipe = PointcloudRegistrationPipeline(
+        CentroidRegistrationModel(), device="cuda", voxel_downsample_size=0.5
+    )
+    assert pipe._downsample_pointcloud(torch.rand((100, 3)) * 10.0).device.type == "cuda"
+
+
+def test_torch_backend_handles_empty_pointcloud() -> None:
+    """Should return an empty pointcloud for an empty input."""
+    assert voxel_downsample_pointcloud(torch.zeros((0, 3)), 0.5).shape == (0, 3)
+
+
+def test_unknown_backend_raises() -> None:
+    """Should raise ValueError for an unknown backend."""
+    with pytest.raises(ValueError):
+        voxel_downsample_pointcloud(torch.zeros((1, 3)), 0.5, backend="pcl")
+
+
+class CentroidRansacPipeline:
+    """Toy RANSAC pipeline that aligns the pointclouds centroids and counts the features computations."""
+
+    def __init__(self) -> None:  # noqa: D107
+        self.num_features = 0
+        self.voxel_downsample_size = 0.5
+
+    def compute_features(self, pc: Tensor) -> Tuple[np.ndarray, np.ndarray]:  # noqa: D102
+        self.num_features += 1
+        points = pc.numpy().astype(np.float64)
+        return points, np.zeros((len(points), 33))
+
+    def register_features(  # noqa: D102
+        self, query_points: np.ndarray, query_feats: np.ndarray, db_points: np.ndarray, db_feats: np.ndarray
+    ) -> np.ndarray:
+        transform = np.eye(4)
+        transform[:3, 3] = db_points.mean(axis=0) - query_points.mean(axis=0)
+        return transform
+
+
+def test_infer_stream_keeps_bounded_submap() -> None:
+    """Should register each scan once against the bounded submap and return the scan registration."""
+    base_pc = torch.rand((500, 3), generator=torch.Generator().manual_seed(0)) * 10.0
+    db_pc = base_pc + torch.tensor([1.0, 2.0, 0.0])
+    pipe = SequencePointcloudRegistrationPipeline(
+        CentroidRegistrationModel(), device="cpu", voxel_downsample_size=0.5, stream_window_size=3
+    )
+    pipe.ransac_pipeline = ransac_pipeline = CentroidRansacPipeline()
+    single_pipe = PointcloudRegistrationPipeline(
+        CentroidRegistrationModel(), device="cpu", voxel_downsample_size=0.5
+    )
+    for i in range(6):
+        query_pc = base_pc + torch.tensor([0.5 * i, 0.0, 0.0])
+        transform = pipe.infer_stream(query_pc, db_pc)
+        expected = single_pipe.infer(pipe.get_submap(), db_pc, downsample_query_pc=False)
+        np.testing.assert_allclose(transform, expected, atol=1e-4)
+        np.testing.assert_allclose(transform[:3, 3], [1.0 - 0.5 * i, 2.0, 0.0], atol=0.1)
+    assert ransac_pipeline.num_features == 6
+    assert len(pipe._stream_scans) == 3
+    # the evicted scans are removed from the submap voxels and the RANSAC features
+    assert pipe._submap_counts.sum() == 3 * len(base_pc)
+    assert len(pipe._ransac_points) == len(base_pc)
+    # the registered scans coincide, so the submap voxels are the ones of a single scan
+    np.testing.assert_allclose(
+        sort_points(pipe.get_submap().numpy()),
+        reference_voxel_downsample(base_pc.double().numpy(), 0.5, np.zeros(3)) + [2.5, 0.0, 0.0],
+        atol=1e-4,
+    )
+    pipe.reset_stream()
+    assert len(pipe._stream_scans) == 0
+
+
+def test_submap_voxels_follow_window() -> None:
+    """Should keep the submap voxels of the window scans only while the scans are added and evicted."""
+    generator = torch.Generator().manual_seed(0)
+    pipe = SequencePointcloudRegistrationPipeline(
+        CentroidRegistrationModel(), device="cpu", voxel_downsample_size=0.5, stream_window_size=2
+    )
+    pipe.ransac_pipeline = CentroidRansacPipeline()
+    scans, poses = [], []
+    for _ in range(5):
+        scans.append(torch.rand((300, 3), generator=generator) * 5.0)
+        poses.append(pipe.add_scan(scans[-1]))
+    window_points = np.concatenate(
+        [scan.double().numpy() @ pose[:3, :3].T + pose[:3, 3] for scan, pose in zip(scans[-2:], poses[-2:])]
+    )
+    expected = reference_voxel_downsample(window_points, 0.5, np.zeros(3)) - poses[-1][:3, 3]
+    np.testing.assert_allclose(sort_points(pipe.get_submap().numpy()), sort_points(expected), atol=1e-4)
+
+
+class CountingFeaturesRansacPipeline(RansacGlobalRegistrationPipeline):
+    """RANSAC pipeline with toy features that counts the features computations."""
+
+    num_features = 0
+
+    def _preprocess_point_cloud(self, points: np.ndarray) -> Tuple[Any, Any]:
+        self.num_features += 1
+        return SimpleNamespace(points=points), SimpleNamespace(data=np.zeros((33, len(points))))
+
+
+def test_compute_features_caches_by_content() -> None:
+    """Should compute the features once for the pointclouds with the same contents."""
+    pipe = CountingFeaturesRansacPipeline(feature_cache_size=2)
+    pc = torch.rand((100, 3))
+    points, feats = pipe.compute_features(pc)
+    assert feats.shape == (100, 33)
+    cached_points, _ = pipe.compute_features(pc.clone())
+    assert pipe.num_features == 1
+    assert cached_points is points
+    pipe.compute_features(pc + 1.0)
+    assert pipe.num_features == 2
+    assert len(pipe.feature_cache) == 2
+
+
+class CentroidInferRansacPipeline(RansacGlobalRegistrationPipeline):
+    """RANSAC pipeline that aligns the pointclouds centroids instead of the RANSAC registration."""
+
+    def infer(self, query_pc: Tensor, db_pc: Tensor) -> np.ndarray:  # noqa: D102
+        transform = np.eye(4)
+        transform[:3, 3] = (db_pc.mean(dim=0) - query_pc.mean(dim=0)).numpy()
+        return transform
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_ransac_infer_batch_reports_times(num_workers: int) -> None:
+    """Should register the pairs in the input order, report the time of each pair and join the threads."""
+    num_threads = threading.active_count()
+    pipe = CentroidInferRansacPipeline(num_workers=num_workers)
+    query_pcs = [torch.zeros((1, 3)) for _ in range(5)]
+    db_pcs = [torch.tensor([[float(i), 0.0, 0.0]]) for i in range(5)]
+    transforms, times = pipe.infer_batch(query_pcs, db_pcs)
+    assert threading.active_count() == num_threads  # the worker threads do not outlive the call
+    assert transforms.shape == (5, 4, 4)
+    np.testing.assert_allclose(transforms[:, 0, 3], np.arange(5))
+    assert times.shape == (5,)
+    assert (times >= 0).all()
+
+
+def test_ransac_invalid_confidence_raises() -> None:
+    """Should raise ValueError for the confidence outside of (0, 1]."""
+    with pytest.raises(ValueError):
+        RansacGlobalRegistrationPipeline(confidence=1.5)
+
+
+class CorrespondencesModel(CentroidRegistrationModel):
+    """Toy registration model that returns the identity transform and the point correspondences."""
+
+    def forward(self, query_pc: Tensor, db_pc: Tensor) -> Dict[str, Tensor]:  # noqa: D102
+        return {
+            "estimated_transform": torch.eye(4),
+            "ref_corr_points": db_pc[:4],
+            "src_corr_points": query_pc[:4],
+        }
+
+
+def test_infer_with_score_reports_inlier_ratio_and_overlap() -> None:
+    """Should score the model transform with its correspondences and the pointclouds overlap."""
+    pipe = PointcloudRegistrationPipeline(CorrespondencesModel(), device="cpu")
+    query_pc = torch.tensor([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [2.0, 0.0, 0.0], [3.0, 0.0, 0.0]])
+    db_pc = query_pc.clone()
+    db_pc[:2, 2] += 10.0
+    output = pipe.infer_with_score(query_pc, db_pc, downsample_db_pc=False, downsample_query_pc=False)
+    assert output["stage"] == "model"
+    assert output["inlier_ratio"] == 0.5
+    assert output["overlap"] == 0.5
+    np.testing.assert_array_equal(output["estimated_transform"], np.eye(4))
+
+
+class FallbackPipeline(PointcloudRegistrationPipeline):
+    """Registration pipeline with the ICP refinement replaced by a fixed transform."""
+
+    def __init__(self, icp_transform: Optional[np.ndarray], *args: Any, **kwargs: Any) -> None:  # noqa: D107
+        super().__init__(*args, **kwargs)
+        self.icp_transform = icp_transform
+        self.num_icp = 0
+
+    def _refine_icp(self, query_pc: Tensor, db_pc: Tensor, transform: np.ndarray) -> np.ndarray:
+        self.num_icp += 1
+        return transform if self.icp_transform is None else self.icp_transform
+
+
+@pytest.mark.parametrize(
+    "score_threshold, icp_shift, expected_stage, expected_num_icp",
+    [(None, 1.5, "model", 0), (0.9, 1.5, "icp", 1), (0.9, None, "ransac", 2)],
+)
+def test_infer_with_score_escalates_until_threshold(
+    score_threshold: Optional[float], icp_shift: Optional[float], expected_stage: str, expected_num_icp: int
+) -> None:
+    """Should try the fallback stages only until the overlap clears the threshold."""
+    query_pc = torch.zeros((100, 3))
+    query_pc[:, 0] = torch.arange(100) * 3.0
+    db_pc = query_pc + torch.tensor([1.5, 0.0, 0.0])
+    icp_transform = None
+    if icp_shift is not None:
+        icp_transform = np.eye(4)
+        icp_transform[0, 3] = icp_shift
+    pipe = FallbackPipeline(
+        icp_transform, CorrespondencesModel(), device="cpu", score_threshold=score_threshold
+    )
+    pipe.ransac_pipeline = CentroidInferRansacPipeline()
+    output = pipe.infer_with_score(query_pc, db_pc, downsample_db_pc=False, downsample_query_pc=False)
+    assert output["stage"] == expected_stage
+    assert pipe.num_icp == expected_num_icp
+    assert output["overlap"] == (0.0 if expected_stage == "model" else 1.0)
@@ -0,0 +1,61 @@
+"""Test cases for opr.profiling module."""
+import json
+import threading
+from pathlib import Path
+
+import pytest
+
+from opr.profiling import StageProfiler
+
+
+def test_stage_records_counts_and_percentiles() -> None:
+    """Should count the stage calls and compute the percentiles over the rolling window."""
+    profiler = StageProfiler(window_size=10)
+    for duration in range(1, 21):
+        profiler.record("search", duration)
+    with profiler.stage("forward"):
+        pass
+    summary = profiler.summary()
+    assert summary["search"]["count"] == 20
+    assert summary["search"]["total"] == 210
+    assert summary["search"]["mean"] == 10.5
+    assert summary["search"]["p50"] == pytest.approx(15.5)
+    assert summary["search"]["max"] == 20
+    assert summary["forward"]["count"] == 1
+    profiler.reset()
+    assert profiler.summary() == {}
+
+
+def test_disabled_profiler_records_nothing() -> None:
+    """Should not record the stages if the profiler is disabled."""
+    profiler = StageProfiler(enabled=False)
+    with profiler.stage("forward"):
+        pass
+    profiler.record("search", 1.0)
+    assert profiler.summary() == {}
+
+
+def test_profiler_dumps_json_and_chrome_trace(tmp_path: Path) -> None:
+    """Should save the summary and the trace events of all threads."""
+    profiler = StageProfiler()
+
+    def run_stage() -> None:
+        with profiler.stage("load"):
+            pass
+
+    threads = [threading.Thread(target=run_stage) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    run_stage()
+    profiler.save_json(tmp_path / "summary.json")
+    profiler.save_chrome_trace(tmp_path / "trace.json")
+    with open(tmp_path / "summary.json") as f:
+        assert json.load(f)["load"]["count"] == 3
+    with open(tmp_path / "trace.json") as f:
+        events = json.load(f)["traceEvents"]
+    assert len(events) == 3
+    assert {event["ph"] for event in events} == {"X"}
+    assert events[-1]["tid"] == threading.get_ident()
+    assert all(event["ts"] >= 0 and event["dur"] >= 0 for event in events)
@@ -1,7 +1,7 @@
 import numpy as np
 import torch
 
-from opr.utils import set_seed
+from opr.utils import LRUCache, set_seed
 
 
 def test_set_seed():
@@ -24,3 +24,21 @@ def test_set_seed():
     set_seed(42, make_deterministic=True)
     assert torch.backends.cudnn.benchmark is False
     assert torch.backends.cudnn.deterministic is True
+
+
+def test_lru_cache_evicts_least_recently_used() -> None:
+    """Should compute missing values once and evict the least recently used ones."""
+    cache = LRUCache(max_size=2)
+    computed = []
+
+    def compute(key: int) -> int:
+        computed.append(key)
+        return key * 10
+
+    assert cache.get_or_compute(1, lambda: compute(1)) == 10
+    assert cache.get_or_compute(2, lambda: compute(2)) == 20
+    assert cache.get_or_compute(1, lambda: compute(1)) == 10
+    cache.get_or_compute(3, lambda: compute(3))
+    assert 2 not in cache and 1 in cache and 3 in cache
+    assert computed == [1, 2, 3]
+    assert (cache.hits, cache.misses) == (1, 3)
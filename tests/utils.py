@@ -1,8 +1,12 @@
-"""Utility functions for tests."""
+"""Utility functions and toy models for tests."""
 from pathlib import Path
-from typing import Union
+from typing import Dict, Tuple, Union
 
+import numpy as np
+import torch
 from omegaconf import DictConfig, ListConfig, OmegaConf
+from torch import Tensor, nn
+from torch.utils.data import Dataset
 
 
 def load_config(config_path: Union[str, Path]) -> Union[DictConfig, ListConfig]:
@@ -16,3 +20,50 @@ def load_config(config_path: Union[str, Path]) -> Union[DictConfig, ListConfig]:
     """
     config = OmegaConf.load(config_path)
     return config
+
+
+class ToyDatabase(Dataset):
+    """Toy database with pointclouds of different sizes."""
+
+    def __init__(self, sizes: Tuple[int, ...]) -> None:  # noqa: D107
+        rng = np.random.default_rng(42)
+        self.pointclouds = [torch.tensor(rng.random((size, 3)), dtype=torch.float32) for size in sizes]
+
+    def __len__(self) -> int:  # noqa: D105
+        return len(self.pointclouds)
+
+    def __getitem__(self, idx: int) -> Dict[str, Tensor]:  # noqa: D105
+        pose = torch.tensor([idx, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0])
+        return {"pointcloud_lidar_coords": self.pointclouds[idx], "pose": pose}
+
+
+class CentroidRegistrationModel(nn.Module):
+    """Toy registration model that aligns the pointclouds centroids."""
+
+    def forward(self, query_pc: Tensor, db_pc: Tensor) -> Dict[str, Tensor]:  # noqa: D102
+        transform = torch.eye(4)
+        transform[:3, 3] = db_pc.mean(dim=0) - query_pc.mean(dim=0)
+        return {"estimated_transform": transform}
+
+
+class FixedRankingPipeline:
+    """Toy Place Recognition pipeline that always returns the same candidates ranking."""
+
+    def __init__(self, ranking: np.ndarray) -> None:  # noqa: D107
+        self.ranking = ranking
+
+    def infer(self, input_data: Dict[str, Tensor], k: int = 1) -> Dict[str, np.ndarray]:  # noqa: D102
+        return {"idx": self.ranking[0], "topk_idxs": self.ranking[:k]}
+
+
+class MeanColorModel(nn.Module):
+    """Toy model that uses the mean image color as a descriptor."""
+
+    def forward(self, batch: Dict[str, Tensor]) -> Dict[str, Tensor]:  # noqa: D102
+        return {"final_descriptor": batch["images_front_cam"].mean(dim=(2, 3))}
+
+
+def make_sample(color: np.ndarray) -> Dict[str, Tensor]:
+    """Make a single query sample with a constant-colored image."""
+    image = torch.tensor(color, dtype=torch.float32)[:, None, None].expand(3, 8, 8).clone()
+    return {"image_front_cam": image}